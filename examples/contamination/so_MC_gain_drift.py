@@ -245,8 +245,7 @@ if __name__ == "__main__":
         ## Scan input map to get TODs
         for pair in tod.pair_list:
             tod.set_detector_gains_perpair(new_gains=new_gains_gen.next())
-            d = np.array([
-                tod.map2tod(det) for det in pair])
+            d = tod.map2tod_block(pair)
 
             ## Project TOD to maps
             tod.tod2map(d, sky_out_tot)
@@ -254,12 +253,12 @@ if __name__ == "__main__":
     MPI.COMM_WORLD.barrier()
 
     ## Coaddition over all processors.
-    ## Note that all processors will then have the coadded data.
+    ## Note that only the processor 0 will then have the coadded data.
     ## If you want informations at the level of each CES (or group of),
     ## use instead:
     ## final_map = OutputSkyMap(nside=nside_out, obspix=tod.obspix)
     ## final_map.coadd_MPI(sky_out_tot, MPI=MPI)
-    sky_out_tot.coadd_MPI(sky_out_tot, MPI=MPI)
+    sky_out_tot.coadd_MPI(sky_out_tot, MPI=MPI, root=0)
 
     if rank == 0:
         if params.projection == 'flat':
@@ -203,8 +203,7 @@ if __name__ == "__main__":
                                        pixel_size=tod.pixel_size)
 
         ## Scan input map to get TODs
-        d = np.array([
-            tod.map2tod(det) for det in range(inst.focal_plane.nbolometer)])
+        d = tod.map2tod_block(range(inst.focal_plane.nbolometer))
 
         ## Inject crosstalk
         inject_crosstalk_inside_SQUID(d,
@@ -222,12 +221,12 @@ if __name__ == "__main__":
     MPI.COMM_WORLD.barrier()
 
     ## Coaddition over all processors.
-    ## Note that all processors will then have the coadded data.
+    ## Note that only the processor 0 will then have the coadded data.
     ## If you want informations at the level of each CES (or group of),
     ## use instead:
     ## final_map = OutputSkyMap(nside=nside_out, obspix=tod.obspix)
     ## final_map.coadd_MPI(sky_out_tot, MPI=MPI)
-    sky_out_tot.coadd_MPI(sky_out_tot, MPI=MPI)
+    sky_out_tot.coadd_MPI(sky_out_tot, MPI=MPI, root=0)
 
     if rank == 0:
         ## Save data on disk into fits file for later use in xpure
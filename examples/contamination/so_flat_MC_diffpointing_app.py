@@ -215,7 +215,9 @@ if __name__ == "__main__":
             width=params.width,
             array_noise_level=params.array_noise_level,
             array_noise_seed=seeds_for_noise[CESnumber],
-            mapping_perpair=params.mapping_perpair)
+            mapping_perpair=params.mapping_perpair,
+            mapping_group_size=params.mapping_group_size,
+            memory_budget=params.memory_budget)
 
         ## Initialise map containers for each processor
         if pos_CES == 0:
@@ -226,9 +228,8 @@ if __name__ == "__main__":
                                        pixel_size=tod.pixel_size)
 
         ## Scan input map to get TODs with original beam offsets
-        for pair in tod.pair_list:
-            d = np.array([
-                tod.map2tod(det) for det in pair])
+        for block in tod.get_mapping_blocks():
+            d = tod.map2tod_block(block)
 
             ## Project TOD to maps with modified beam offsets
             tod.tod2map(d, sky_out_tot)
@@ -236,12 +237,12 @@ if __name__ == "__main__":
     MPI.COMM_WORLD.barrier()
 
     ## Coaddition over all processors.
-    ## Note that all processors will then have the coadded data.
+    ## Note that only the processor 0 will then have the coadded data.
     ## If you want informations at the level of each CES (or group of),
     ## use instead:
     ## final_map = OutputSkyMap(nside=nside_out, obspix=tod.obspix)
     ## final_map.coadd_MPI(sky_out_tot, MPI=MPI)
-    sky_out_tot.coadd_MPI(sky_out_tot, MPI=MPI)
+    sky_out_tot.coadd_MPI(sky_out_tot, MPI=MPI, root=0)
 
     if rank == 0:
         name_out = '{}_{}_{}'.format(params.tag,
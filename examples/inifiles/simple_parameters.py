@@ -140,12 +140,23 @@ pixel_size = None
 ## if width > len(input scan), you will
 ## have your entire scan + plenty of zeros.
 ## A choice has to be made.
+## Use width = 'auto' to derive the tightest patch from the scans.
 width = 20.
 
 ## Project time-domain data detector-by-detector to save a lot of memory.
 ## Use this only if you do not have detector-to-detector correlation!
 mapping_perpair = False
 
+## Process pairs by groups in the map-making, in between mapping_perpair
+## and whole-array mapping: number of pairs per group, or a component of
+## the focal plane among ['Cr', 'Sq', 'Df'] to group pairs by crate,
+## SQUID or DfMUX. None to follow mapping_perpair.
+mapping_group_size = None
+
+## If mapping_group_size is None, choose the largest groups of pairs whose
+## map-making buffers fit in memory_budget MB. None for no limit.
+memory_budget = None
+
 #####################################################################
 ######################### Misc ######################################
 #####################################################################
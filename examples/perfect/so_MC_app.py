@@ -19,6 +19,7 @@ from s4cmb.scanning_strategy import ScanningStrategy
 
 from s4cmb.tod import TimeOrderedDataPairDiff
 from s4cmb.tod import OutputSkyMap
+from s4cmb.tod import load_checkpoint
 
 from s4cmb.config_s4cmb import import_string_as_module
 
@@ -103,6 +104,12 @@ def addargs(parser):
         '-fwhm_in', dest='fwhm_in',
         required=True, type=float,
         help='Name of the output folder.')
+    parser.add_argument(
+        '-checkpoint_dir', dest='checkpoint_dir',
+        default=None,
+        help='If set, folder where maps are checkpointed after each CES. ' +
+        'A run restarted with the same number of processors resumes ' +
+        'from there and skips the CES already processed.')
 
 
 if __name__ == "__main__":
@@ -192,7 +199,23 @@ if __name__ == "__main__":
 
     state_for_noise = np.random.RandomState(params.array_noise_seed)
     seeds_for_noise = state_for_noise.randint(0, 1e6, scan.nces)
+
+    ## Resume from the last checkpoint of this processor, if any
+    sky_out_tot = None
+    ces_done = []
+    if args.checkpoint_dir is not None:
+        if rank == 0:
+            safe_mkdir(args.checkpoint_dir)
+        MPI.COMM_WORLD.barrier()
+        fn_checkpoint = os.path.join(
+            args.checkpoint_dir, 'checkpoint_sim{:03d}_rank{:04d}.npz'.format(
+                args.sim_number, rank))
+        if os.path.exists(fn_checkpoint):
+            sky_out_tot, ces_done = load_checkpoint(fn_checkpoint)
+
     for pos_CES, CESnumber in enumerate(range(rank, scan.nces, size)):
+        if CESnumber in ces_done:
+            continue
         if params.verbose:
             print("Proc [{}] with seeds ".format(rank),
                   seeds_for_noise[CESnumber], seeds_for_noise)
@@ -205,10 +228,12 @@ if __name__ == "__main__":
             width=params.width,
             array_noise_level=params.array_noise_level,
             array_noise_seed=seeds_for_noise[CESnumber],
-            mapping_perpair=params.mapping_perpair)
+            mapping_perpair=params.mapping_perpair,
+            mapping_group_size=params.mapping_group_size,
+            memory_budget=params.memory_budget)
 
         ## Initialise map containers for each processor
-        if pos_CES == 0:
+        if sky_out_tot is None:
             sky_out_tot = OutputSkyMap(projection=tod.projection,
                                        nside=tod.nside_out,
                                        obspix=tod.obspix,
@@ -216,22 +241,25 @@ if __name__ == "__main__":
                                        pixel_size=tod.pixel_size)
 
         ## Scan input map to get TODs
-        for pair in tod.pair_list:
-            d = np.array([
-                tod.map2tod(det) for det in pair])
+        for block in tod.get_mapping_blocks():
+            d = tod.map2tod_block(block)
 
             ## Project TOD to maps
             tod.tod2map(d, sky_out_tot)
 
+        if args.checkpoint_dir is not None:
+            ces_done.append(CESnumber)
+            sky_out_tot.save_checkpoint(fn_checkpoint, ces_done)
+
     MPI.COMM_WORLD.barrier()
 
     ## Coaddition over all processors.
-    ## Note that all processors will then have the coadded data.
+    ## Note that only the processor 0 will then have the coadded data.
     ## If you want informations at the level of each CES (or group of),
     ## use instead:
     ## final_map = OutputSkyMap(nside=nside_out, obspix=tod.obspix)
     ## final_map.coadd_MPI(sky_out_tot, MPI=MPI)
-    sky_out_tot.coadd_MPI(sky_out_tot, MPI=MPI)
+    sky_out_tot.coadd_MPI(sky_out_tot, MPI=MPI, root=0)
 
     if rank == 0:
         if params.projection == 'flat':
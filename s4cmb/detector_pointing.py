@@ -297,7 +297,7 @@ class Pointing():
         az, el = vconv(self.time, self.ra, self.dec)
         return az, el
 
-    def offset_detector(self, azd, eld):
+    def offset_detector(self, azd, eld, samples=None):
         """
         To compute RA/Dec of each detector from az/el, it is much
         faster to use the quaternions. This routine does it for you.
@@ -308,6 +308,8 @@ class Pointing():
             The azimuth array for the observation in radian.
         els : 1d array
             The elevation array for the observation in radian.
+        samples : slice, optional
+            If provided, compute the pointing only for those time samples.
 
         Returns
         ----------
@@ -318,8 +320,12 @@ class Pointing():
         pa : 1d array
             Parallactic angle in radian.
         """
+        if samples is None:
+            q = self.q
+        else:
+            q = self.q[samples]
         ra, dec, pa = self.quaternion.offset_radecpa_applyquat(
-            self.q, -azd, -eld)
+            q, -azd, -eld)
         return ra, dec, pa
 
 class Azel2Radec(object):
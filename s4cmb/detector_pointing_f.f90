@@ -23,6 +23,9 @@ contains
         real(DP), intent(in)     :: q(0 : 3)
         real(DP), intent(inout)  :: pq(0 : 4 * n - 1)
 
+        ! Release the GIL (threaded map2tod)
+        !f2py threadsafe
+
         ! LOCAL
         integer(I4B)             :: angle
 
@@ -73,6 +76,9 @@ contains
         real(DP), intent(in)     :: q2(0 : n - 1), q3(0 : n - 1)
         real(DP), intent(inout)  :: phi(0 : n - 1), theta(0 : n - 1), psi(0 : n - 1)
 
+        ! Release the GIL (threaded map2tod)
+        !f2py threadsafe
+
         ! LOCAL
         integer(I4B)             :: i
 
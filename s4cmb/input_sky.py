@@ -11,6 +11,7 @@ from __future__ import division, absolute_import, print_function
 
 import glob
 import os
+from collections import OrderedDict
 
 import healpy as hp
 import numpy as np
@@ -23,7 +24,7 @@ class HealpixFitsMap():
     def __init__(self, input_filename,
                  do_pol=True, verbose=False, fwhm_in=0.0, nside_in=16,
                  lmax=None, map_seed=53543, no_ileak=False, no_quleak=False,
-                 ext_map_gal=False):
+                 ext_map_gal=False, interleaved=False, precision='double'):
         """
 
         Parameters
@@ -50,9 +51,11 @@ class HealpixFitsMap():
         lmax : None or int, optional
             Maximum multipole when creating a map from cl. If none, it
             is set automatically to 2*nside_in
-        map_seed : int, optional
+        map_seed : int or list of int, optional
             If input_filename is a CAMB lensed cl file, this is the seed used
-            to create the maps. No effect if you provide maps directly.
+            to create the maps. If a list, one sky is created per seed, and
+            all skies are scanned in one pass (see stack_skies).
+            No effect if you provide maps directly.
         no_ileak : bool, optional
             If True, load temperature and polarisation, but set the temperature
             to zero to avoid leakages.
@@ -62,6 +65,15 @@ class HealpixFitsMap():
         ext_map_gal : bool, optional
             Set it to True if you are reading a map in Galactic coordinate.
             (Planck maps for example).
+        interleaved : bool, optional
+            If True, store I, Q and U in one contiguous array of size
+            (npix, 3), such that scanning fetches the three Stokes
+            parameters of a pixel at once (see interleave).
+            Polarisation only. Default is False.
+        precision : string, optional
+            Precision of the maps in memory, among ['single', 'double'].
+            Maps are generated or read in double precision, and converted
+            afterwards. Default is 'double'.
 
         """
         self.input_filename = input_filename
@@ -77,10 +89,20 @@ class HealpixFitsMap():
         else:
             self.lmax = lmax
         self.map_seed = map_seed
+        self.precision = precision
+        assert self.precision in ['single', 'double'], \
+            ValueError("Precision <{}> not understood! ".format(
+                self.precision) + "Choose among ['single', 'double'].")
+        self.dtype = np.float32 if self.precision == 'single' else np.float64
 
         self.I = None
         self.Q = None
         self.U = None
+        self.IQU = None
+
+        ## Pixels kept in memory (None for full sky). See compact.
+        self.obspix = None
+        self.obspix_rings = None
 
         if type(self.input_filename) == list:
             if self.verbose:
@@ -104,6 +126,137 @@ class HealpixFitsMap():
 
         self.set_leakage_to_zero()
 
+        if self.precision == 'single':
+            fields = ['I', 'Q', 'U'] if self.do_pol else ['I']
+            for field in fields:
+                setattr(self, field, getattr(self, field).astype(self.dtype))
+
+        ## Number of skies scanned in one pass
+        self.nskies = 1 if np.ndim(self.I) == 1 else len(self.I)
+
+        if interleaved:
+            self.interleave()
+
+    def interleave(self):
+        """
+        Store the sky as a contiguous array-of-structs IQU of size
+        (npix, 3), or (nskies, npix, 3) for several skies.
+        I, Q and U become views of IQU. Scanning then fetches the three
+        Stokes parameters with a single gather (less memory traffic).
+        No effect if do_pol is False.
+
+        Examples
+        ----------
+        >>> write_dummy_map('myfits_to_test_.fits')
+        >>> hpmap = HealpixFitsMap('myfits_to_test_.fits')
+        >>> Q = hpmap.Q.copy()
+        >>> hpmap.interleave()
+        >>> print(hpmap.IQU.shape, np.all(hpmap.IQU[:, 1] == Q))
+        (3072, 3) True
+
+        I, Q and U are views of IQU
+        >>> hpmap.U[0] = 1.
+        >>> print(hpmap.IQU[0, 2])
+        1.0
+        """
+        if not self.do_pol:
+            return
+        IQU = np.empty(np.shape(self.I) + (3,), dtype=self.I.dtype)
+        IQU[..., 0] = self.I
+        IQU[..., 1] = self.Q
+        IQU[..., 2] = self.U
+        self.IQU = IQU
+        self.I, self.Q, self.U = IQU[..., 0], IQU[..., 1], IQU[..., 2]
+
+    def compact(self, obspix):
+        """
+        Keep in memory only the pixels of the input maps listed in obspix,
+        such that memory scales with the size of the observed patch and
+        not with the full sky. Pixel p of the full sky map is then stored at
+        position np.searchsorted(self.obspix, p) in I, Q and U, which is
+        also given by the ring-offset table self.obspix_rings
+        (see get_ring_offsets).
+
+        Parameters
+        ----------
+        obspix : 1d array of int
+            Sorted indices of the pixels to keep (full sky indices,
+            at the resolution of the input map). If the map is already
+            compacted, it must be a subset of self.obspix.
+
+        Examples
+        ----------
+        >>> write_dummy_map('myfits_to_test_.fits')
+        >>> hpmap = HealpixFitsMap('myfits_to_test_.fits')
+        >>> Q = hpmap.Q.copy()
+        >>> hpmap.compact(np.array([10, 20, 3000]))
+        >>> print(hpmap.Q.shape, np.all(hpmap.Q == Q[[10, 20, 3000]]))
+        (3,) True
+        """
+        obspix = np.asarray(obspix, dtype=np.int64)
+        if self.obspix is None:
+            index = obspix
+        else:
+            index = np.searchsorted(self.obspix, obspix)
+            index[index == len(self.obspix)] = 0
+            assert np.all(self.obspix[index] == obspix), \
+                ValueError("Pixels must be a subset of the compacted map!")
+
+        fields = ['I', 'Q', 'U'] if self.do_pol else ['I']
+        for field in fields:
+            setattr(self, field,
+                    np.ascontiguousarray(getattr(self, field)[..., index]))
+        self.obspix = obspix
+        self.obspix_rings = get_ring_offsets(obspix, self.nside)
+
+        if self.IQU is not None:
+            self.interleave()
+
+    def stack_skies(self, others):
+        """
+        Add the skies of other HealpixFitsMap instances to this one.
+        I, Q and U become arrays of size (nskies, npix), and all skies are
+        then scanned in one pass by the TOD (the pointing is computed once).
+
+        Parameters
+        ----------
+        others : list of HealpixFitsMap instances
+            Skies to add. Must have the same resolution and polarisation
+            content.
+
+        Examples
+        ----------
+        >>> filename = 's4cmb/data/test_data_set_lensedCls.dat'
+        >>> sky1 = HealpixFitsMap(input_filename=filename, map_seed=1)
+        >>> sky2 = HealpixFitsMap(input_filename=filename, map_seed=2)
+        >>> sky1.stack_skies([sky2])
+        >>> print(sky1.nskies, sky1.I.shape)
+        2 (2, 3072)
+
+        Equivalent to providing a list of seeds
+        >>> sky = HealpixFitsMap(input_filename=filename, map_seed=[1, 2])
+        >>> print(np.all(sky.Q == sky1.Q))
+        True
+        """
+        for other in others:
+            assert other.nside == self.nside, \
+                ValueError("Skies must have the same nside!")
+            assert other.do_pol == self.do_pol, \
+                ValueError("Skies must have the same polarisation content!")
+            assert np.array_equal(other.obspix, self.obspix), \
+                ValueError("Skies must have the same compacted pixels!")
+
+        fields = ['I', 'Q', 'U'] if self.do_pol else ['I']
+        for field in fields:
+            maps = [np.reshape(getattr(self, field), (self.nskies, -1))]
+            maps += [np.reshape(getattr(other, field), (other.nskies, -1))
+                     for other in others]
+            setattr(self, field, np.concatenate(maps, axis=0))
+        self.nskies = len(self.I)
+
+        if self.IQU is not None:
+            self.interleave()
+
     def load_healpix_fits_map(self, force=False):
         """
         Load from disk into memory a sky map.
@@ -140,6 +293,10 @@ class HealpixFitsMap():
                 self.I = hp.read_map(
                     self.input_filename, field=0, verbose=self.verbose)
             self.nside = hp.npix2nside(len(self.I))
+            self.obspix = None
+            self.obspix_rings = None
+            if self.IQU is not None:
+                self.interleave()
         else:
             print("External data already present in memory")
 
@@ -198,6 +355,10 @@ class HealpixFitsMap():
                     fwhm=self.fwhm_in / 60. * np.pi / 180.,
                     sigma=None, pol=False, inplace=False, verbose=self.verbose)
             self.nside = hp.npix2nside(len(self.I))
+            self.obspix = None
+            self.obspix_rings = None
+            if self.IQU is not None:
+                self.interleave()
         else:
             print("External data already present in memory")
 
@@ -229,7 +390,21 @@ class HealpixFitsMap():
         >>> hpmap.create_healpix_fits_map(force=True)
         """
         if self.I is None or force:
-            if self.do_pol:
+            if type(self.map_seed) == list:
+                ## One sky per seed, stacked as (nskies, npix)
+                maps = np.array([
+                    create_sky_map(self.input_filename,
+                                   nside=self.nside_in,
+                                   FWHM=self.fwhm_in,
+                                   seed=seed,
+                                   lmax=self.lmax)
+                    for seed in self.map_seed])
+                if self.do_pol:
+                    self.I, self.Q, self.U = [
+                        np.ascontiguousarray(maps[:, i]) for i in range(3)]
+                else:
+                    self.I = np.ascontiguousarray(maps[:, 0])
+            elif self.do_pol:
                 self.I, self.Q, self.U = create_sky_map(self.input_filename,
                                                         nside=self.nside_in,
                                                         FWHM=self.fwhm_in,
@@ -241,7 +416,11 @@ class HealpixFitsMap():
                                         FWHM=self.fwhm_in,
                                         seed=self.map_seed,
                                         lmax=self.lmax)
-            self.nside = hp.npix2nside(len(self.I))
+            self.nside = hp.npix2nside(np.shape(self.I)[-1])
+            self.obspix = None
+            self.obspix_rings = None
+            if self.IQU is not None:
+                self.interleave()
         else:
             print("External data already present in memory")
 
@@ -305,6 +484,12 @@ def get_obspix(xmin, xmax, ymin, ymax, nside):
     """
     Given RA/Dec boundaries, return the observed pixels in the healpix scheme.
 
+    Pixels are enumerated ring-by-ring: for each ring crossing the Dec band,
+    the range of pixels within the RA boundaries is computed analytically,
+    such that the cost scales with the size of the patch and not with
+    the size of the Dec band. The last OBSPIX_CACHE_SIZE results are
+    cached per (boundaries, nside), and returned as read-only arrays.
+
     Parameters
     ----------
     xmin : float
@@ -329,13 +514,84 @@ def get_obspix(xmin, xmax, ymin, ymax, nside):
     ...     -np.pi/2, np.pi/2, nside=2) # doctest: +NORMALIZE_WHITESPACE
     array([ 0,  3,  4,  5, 10, 11, 12, 13, 14,
            18, 19, 20, 21, 26, 27, 28, 29,
-           30, 34, 35, 36, 37, 42, 43, 44])
+           30, 34, 35, 36, 37, 42, 43, 44, 47])
+
+    Same result as brute-force enumeration of the Dec band
+    >>> nside = 64
+    >>> obspix = get_obspix(-0.3, 0.5, -1.2, -0.6, nside)
+    >>> theta, phi = hp.pix2ang(nside, np.arange(12 * nside**2))
+    >>> phi[phi > np.pi] -= 2 * np.pi
+    >>> brute = np.where((theta >= np.pi/2 + 0.6) * (theta <= np.pi/2 + 1.2) *
+    ...     (phi >= -0.3) * (phi <= 0.5))[0]
+    >>> print(np.all(obspix == brute))
+    True
+
+    The cache holds the last OBSPIX_CACHE_SIZE patches
+    >>> print(get_obspix(-0.3, 0.5, -1.2, -0.6, nside) is obspix)
+    True
+    >>> for k in range(OBSPIX_CACHE_SIZE):
+    ...     _ = get_obspix(-0.3, 0.5, -1.2, -0.6 + 0.01 * (k + 1), nside)
+    >>> print(len(_obspix_cache) == OBSPIX_CACHE_SIZE)
+    True
+    >>> print(get_obspix(-0.3, 0.5, -1.2, -0.6, nside) is obspix)
+    False
+    """
+    key = (xmin, xmax, ymin, ymax, nside)
+    if key in _obspix_cache:
+        obspix = _obspix_cache.pop(key)
+    else:
+        obspix = _get_obspix_rings(xmin, xmax, ymin, ymax, nside)
+        obspix.flags.writeable = False
+
+    ## Most recently used patch last
+    _obspix_cache[key] = obspix
+    while len(_obspix_cache) > OBSPIX_CACHE_SIZE:
+        _obspix_cache.popitem(last=False)
+    return obspix
+
+## Observed pixels of the last patches, indexed by (boundaries, nside)
+OBSPIX_CACHE_SIZE = 8
+_obspix_cache = OrderedDict()
+
+def _get_obspix_rings(xmin, xmax, ymin, ymax, nside):
+    """
+    Ring-based enumeration of the pixels inside RA/Dec boundaries.
+    See get_obspix.
     """
     theta_min = np.pi / 2. - ymax
     theta_max = np.pi / 2. - ymin
-    fpix, lpix = hp.ang2pix(nside, [theta_min, theta_max], [0., 2.*np.pi])
-    pixs = np.arange(fpix, lpix + 1, dtype=np.int)
 
+    ## Rings whose center falls inside the Dec band
+    rings = np.arange(1, 4 * nside)
+    startpix, ringpix, costheta, sintheta, shifted = hp.ringinfo(
+        nside, rings)
+    theta_ring, _ = hp.pix2ang(nside, startpix)
+    inband = (theta_ring >= theta_min) * (theta_ring <= theta_max)
+    startpix = startpix[inband]
+    ringpix = ringpix[inband]
+    shifted = shifted[inband]
+    if len(startpix) == 0:
+        return np.array([], dtype=np.int64)
+
+    ## Range of pixel indices within the RA boundaries for each ring.
+    ## Pixel k of a ring is centered on (k + shift/2) * 2pi / ringpix.
+    ## One extra pixel on each side, the exact selection is done below.
+    dphi = 2 * np.pi / ringpix
+    kmin = np.floor(xmin / dphi - shifted / 2.).astype(np.int64) - 1
+    kmax = np.ceil(xmax / dphi - shifted / 2.).astype(np.int64) + 1
+    full = (kmax - kmin + 1) >= ringpix
+    kmin[full] = 0
+    kmax[full] = ringpix[full] - 1
+    counts = kmax - kmin + 1
+
+    ## Flatten the ranges: offset of each candidate within its ring
+    ring_id = np.repeat(np.arange(len(counts)), counts)
+    offsets = np.arange(np.sum(counts)) - np.repeat(
+        np.cumsum(counts) - counts, counts)
+    k = (kmin[ring_id] + offsets) % ringpix[ring_id]
+    pixs = np.unique(startpix[ring_id] + k)
+
+    ## Exact selection on pixel centers
     theta, phi = hp.pix2ang(nside, pixs)
     if xmin < 0:
         phi[phi > np.pi] = (phi[phi > np.pi] - 2 * np.pi)
@@ -346,6 +602,95 @@ def get_obspix(xmin, xmax, ymin, ymax, nside):
 
     return obspix
 
+def get_ring_offsets(obspix, nside):
+    """
+    Ring-offset table to go from full sky pixel indices (RING ordering)
+    to positions in obspix. The memory scales with the number of rings,
+    and not with the range of pixel indices covered by obspix.
+
+    The observed pixels of each ring must form a single range of the ring,
+    possibly wrapping around phi=0. This is the case for RA/Dec boundaries
+    (see get_obspix) and for discs.
+
+    Parameters
+    ----------
+    obspix : 1d array of int
+        Sorted indices of observed pixels (RING ordering).
+    nside : int
+        Resolution of the map.
+
+    Returns
+    ----------
+    table : 2d array of int64 of shape (6, 4 * nside) or None
+        For each ring number: index of its first pixel, its number of
+        pixels, offset within the ring of the first observed pixel of
+        the range, number of observed pixels, number of observed pixels
+        wrapped at the beginning of the ring, and position in obspix of
+        the first observed pixel of the ring. None if obspix cannot be
+        described by one range per ring.
+
+    Examples
+    ----------
+    >>> nside = 4
+    >>> obspix = get_obspix(-0.5, 0.5, -0.3, 0.3, nside)
+    >>> table = get_ring_offsets(obspix, nside)
+    >>> print(table.shape)
+    (6, 16)
+
+    Pixels of the ring 8 wrap around phi=0
+    >>> print(obspix[table[5, 8]:table[5, 8] + table[3, 8]] - table[0, 8])
+    [ 0 15]
+    >>> print(table[2:5, 8])
+    [15  2  1]
+
+    More than one range in a ring
+    >>> print(get_ring_offsets(np.array([0, 2]), nside))
+    None
+    """
+    nrings = 4 * nside
+    table = np.zeros((6, nrings), dtype=np.int64)
+    startpix, ringpix = hp.ringinfo(nside, np.arange(1, nrings))[:2]
+    table[0, 1:] = startpix
+    table[1, 1:] = ringpix
+    ## There is no ring 0
+    table[1, 0] = 1
+
+    obspix = np.asarray(obspix, dtype=np.int64)
+    if len(obspix) == 0:
+        return table
+
+    ring = hp.pix2ring(nside, obspix)
+    k = obspix - table[0, ring]
+
+    ## Observed pixels of one ring are contiguous in obspix
+    starts = np.flatnonzero(np.diff(ring)) + 1
+    first = np.append(0, starts)
+    last = np.append(starts, len(obspix)) - 1
+    rings = ring[first]
+
+    ## Breaks within a ring: at most one, if the range wraps around phi=0
+    breaks = np.flatnonzero(np.diff(k) != 1) + 1
+    breaks = breaks[~np.in1d(breaks, starts)]
+    ring_of_break = np.searchsorted(first, breaks, side='right') - 1
+    if len(np.unique(ring_of_break)) != len(ring_of_break):
+        return None
+    wrapped = (k[first[ring_of_break]] == 0) * \
+        (k[last[ring_of_break]] == table[1, rings[ring_of_break]] - 1)
+    if not np.all(wrapped):
+        return None
+
+    kmin = k[first]
+    nwrap = np.zeros(len(first), dtype=np.int64)
+    kmin[ring_of_break] = k[breaks]
+    nwrap[ring_of_break] = breaks - first[ring_of_break]
+
+    table[2, rings] = kmin
+    table[3, rings] = last - first + 1
+    table[4, rings] = nwrap
+    table[5, rings] = first
+
+    return table
+
 def LamCyl(ra, dec):
     """
     Referred to as cylindrical equal-area in the USGS report, assuming
@@ -91,6 +91,10 @@ class ScanningStrategy():
 
         self.define_boundary_of_scan()
 
+        ## Decimated boresight pointing of the scans,
+        ## see tod.get_scan_footprint.
+        self.footprints = {}
+
     def define_telescope_location(self, telescope_longitude='-67:46.816',
                                   telescope_latitude='-22:56.396',
                                   telescope_elevation=5200.):
@@ -550,6 +554,7 @@ class ScanningStrategy():
         """
         ## Initialise the date and loop over CESes
         self.telescope_location.date = self.start_date
+        self.footprints = {}
         for CES_position in range(self.nces):
             ## Initialise the starting date of observation
             ## It will be updated then automatically
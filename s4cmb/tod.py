@@ -9,6 +9,14 @@ from __future__ import division, absolute_import, print_function
 
 import sys
 import os
+import io
+import errno
+import json
+import struct
+import zipfile
+import hashlib
+import threading
+from multiprocessing.pool import ThreadPool
 
 import numpy as np
 import healpy as hp
@@ -19,6 +27,8 @@ except ImportError:
     import pickle
 
 from numpy.fft import fft, fftfreq, fftshift
+from numpy.lib.format import open_memmap
+from numpy.lib import format as npy_format
 
 from scipy.signal import firwin
 from scipy import fftpack
@@ -32,14 +42,21 @@ from s4cmb.xpure import qu_weight_mineig
 d2r = np.pi / 180.0
 am2rad = np.pi / 180. / 60.
 
+## Strategies of the tod2map kernels (0: pixel-sorted numpy path)
+TOD2MAP_STRATEGIES = {'sorted': 0, 'reduction': 1, 'owner': 2}
+
 class TimeOrderedDataPairDiff():
     """ Class to handle Time-Ordered Data (TOD) """
     def __init__(self, hardware, scanning_strategy, HealpixFitsMap,
                  CESnumber, projection='healpix',
                  nside_out=None, pixel_size=None, width=140.,
-                 cut_pixels_outside=True,
+                 width_margin=0.5, cut_pixels_outside=True,
                  array_noise_level=None, array_noise_seed=487587,
-                 mapping_perpair=False, verbose=False):
+                 mapping_perpair=False, chunk_size=None, nthreads=1,
+                 pointing_cache_dir=None, compact_input=False,
+                 precision='double', tod2map_strategy='reduction',
+                 mapping_group_size=None, memory_budget=None,
+                 verbose=False):
         """
         C'est parti!
 
@@ -66,8 +83,17 @@ class TimeOrderedDataPairDiff():
         pixel_size : float, optional
             The pixel size for the output maps if projection=flat.
             In arcmin. Default is resolution of the input map.
-        width : float, optional
-            Width for the output map in degree.
+        width : float or list of 4 floats or 'auto', optional
+            Width for the output map in degree. If a list, it contains
+            the extent of the patch on each side of its center
+            [left, right, bottom, top] in degree (healpix projection only,
+            flat patches are square). If 'auto', the patch
+            bounds are derived from the footprint of the scanning strategy
+            (boresight pointing for all CES plus the focal plane radius) with
+            a margin `width_margin` (see get_scan_footprint).
+        width_margin : float, optional
+            Margin in degree added on each side of the patch when
+            width='auto'. No effect otherwise. Default is 0.5 degree.
         cut_pixels_outside : bool, optional
             The mapping time -> map is done relatively to the sky patch
             defined by (width, ra_src, dec_src). So if for some reason your
@@ -94,6 +120,62 @@ class TimeOrderedDataPairDiff():
             If True, assume that you want to process pairs of bolometers
             one-by-one, that is pairs are uncorrelated. Default is False (and
             should be False unless you know what you are doing).
+        chunk_size : int, optional
+            If not None, the scan is processed in chunks of chunk_size time
+            samples (see set_chunk and scan_and_project), such that buffers
+            (pointing matrix, polarisation angles, masks, timestreams) scale
+            with chunk_size instead of the length of the scan.
+            Noise is then drawn by blocks of samples (see
+            WhiteNoiseGenerator), and differs from the default realisation
+            after 2**16 samples. Default is None (the whole scan at once).
+        nthreads : int, optional
+            Number of threads used to scan the input map (map2tod_block).
+            Channels are split among threads, which share the input map
+            in memory. Also the number of OpenMP threads used to project
+            timestreams into maps (tod2map). Default is 1.
+        pointing_cache_dir : string, optional
+            If not None, folder where detector pointing (global and local
+            pixel indices, parallactic angles) is stored on disk the first
+            time it is computed, and read back (memory-mapped) for later
+            simulations of the same instrument, scan and projection.
+            See PointingCache. Default is None.
+        compact_input : bool, optional
+            If True, keep in memory only the pixels of the input map
+            within the sky patch plus a margin of width_margin degree
+            (see compact_input_map). The sky patch must contain the scan,
+            and the input map is modified in place: use width='auto'
+            (footprint of all scans). Default is False.
+        precision : string, optional
+            Precision of timestreams and polarisation angles, among
+            ['single', 'double']. Single precision halves the memory of
+            the (ndetectors, ntimesamples) arrays. Boresight pointing and
+            output map accumulators are always double precision.
+            Default is 'double'.
+        tod2map_strategy : string, optional
+            How tod2map shares the projection among nthreads threads:
+            'reduction' (each thread projects a range of pairs into private
+            maps, summed at the end: this holds nthreads copies of the
+            output maps in memory) or 'owner' (samples are bucketed once by
+            range of sky pixels, and each thread projects the samples of its
+            own range: no copy of the maps, but one integer per sample).
+            Alternatively, 'sorted' accumulates samples in pixel
+            order with segmented sums (see get_pixel_order).
+            Default is 'reduction'.
+        mapping_group_size : int or string, optional
+            Process pairs by groups, between per-pair (mapping_perpair)
+            and whole-array mapping: buffers of the map-making are
+            allocated for one group, and map2tod_block/tod2map are called
+            once per group (see get_mapping_blocks). Either the number of
+            pairs per group, or a component of the focal plane among
+            ['Cr', 'Sq', 'Df'] to group pairs by crate, SQUID or DfMUX.
+            Default is None (whole array, or pairs if mapping_perpair).
+        memory_budget : float, optional
+            If mapping_group_size is None, choose the largest groups of
+            pairs whose memory for a time chunk fits in memory_budget MB:
+            buffers of the map-making (pointing matrix, angles, masks and
+            timestreams), and temporaries of map2tod_block (pointing,
+            pixel indices, modulation, sky values and noise).
+            Default is None.
         """
         ## Initialise args
         self.verbose = verbose
@@ -101,13 +183,27 @@ class TimeOrderedDataPairDiff():
         self.scanning_strategy = scanning_strategy
         self.HealpixFitsMap = HealpixFitsMap
         self.mapping_perpair = mapping_perpair
+        self.nthreads = nthreads
         self.width = width
+        self.precision = precision
+        assert self.precision in ['single', 'double'], \
+            ValueError("Precision <{}> not understood! ".format(
+                self.precision) + "Choose among ['single', 'double'].")
+        self.dtype = np.float32 if self.precision == 'single' else np.float64
+        self.tod2map_strategy = tod2map_strategy
+        assert self.tod2map_strategy in TOD2MAP_STRATEGIES, \
+            ValueError("Strategy <{}> not understood! ".format(
+                self.tod2map_strategy) + "Choose among {}.".format(
+                    sorted(TOD2MAP_STRATEGIES.keys())))
         self.cut_pixels_outside = cut_pixels_outside
         self.projection = projection
         assert self.projection in ['healpix', 'flat'], \
             ValueError("Projection <{}> for ".format(self.projection) +
                        "the output map not understood! " +
                        "Choose among ['healpix', 'flat'].")
+        assert self.projection == 'healpix' or np.ndim(self.width) == 0, \
+            ValueError("Flat projection works with square patches only: " +
+                       "width must be a float or 'auto'!")
 
         self.CESnumber = CESnumber
         assert self.CESnumber < self.scanning_strategy.nces, \
@@ -120,11 +216,30 @@ class TimeOrderedDataPairDiff():
             self.CESnumber))
         self.nsamples = self.scan['nts']
         self.npair = self.hardware.focal_plane.npair
+
+        ## Time samples processed at once
+        if chunk_size is None:
+            self.chunk_size = self.nsamples
+        else:
+            self.chunk_size = int(min(chunk_size, self.nsamples))
+        self.set_chunk(0)
         self.pair_list = np.reshape(
             self.hardware.focal_plane.bolo_index_in_fp, (self.npair, 2))
 
-        ## Pre-compute boresight pointing objects
-        self.get_boresightpointing()
+        ## Groups of pairs processed at once by the map-making
+        if self.mapping_perpair:
+            mapping_group_size = 1
+        self.pair_groups = self.get_pair_groups(
+            mapping_group_size, memory_budget)
+        self.group_size = max([len(group) for group in self.pair_groups])
+
+        ## Pre-compute boresight pointing objects. With a pointing cache,
+        ## this is deferred until some detector pointing is missing
+        ## (possibly from several threads, see map2tod_block).
+        self.pointing = None
+        self.pointing_lock = threading.Lock()
+        if pointing_cache_dir is None:
+            self.get_boresightpointing()
 
         ## Polarisation angles: intrinsic and HWP angles
         self.get_angles()
@@ -136,15 +251,22 @@ class TimeOrderedDataPairDiff():
         self.xpos = self.xpos / np.cos(self.ypos)
 
         ## Initialise pointing matrix, that is the matrix to go from time
-        ## to map domain, for all pairs of detectors.
-        if not self.mapping_perpair:
-            self.point_matrix = np.zeros(
-                (self.npair, self.nsamples), dtype=np.int32)
-        else:
-            self.point_matrix = np.zeros((1, self.nsamples), dtype=np.int32)
+        ## to map domain, for all pairs of detectors of a group.
+        self.point_matrix = np.zeros(
+            (self.group_size, self.chunk_size), dtype=np.int32)
 
-        ## Initialise the mask for timestreams
+        ## Initialise the mask for timestreams, and the flags of pairs
+        ## (run-length encoded) from which it is expanded while scanning.
         self.wafermask_pixel = self.get_timestream_masks()
+        self.flags = TimestreamFlags(self.npair, self.nsamples)
+
+        ## Flat storage of the buffers above. set_chunk exposes them
+        ## as contiguous (nrow, nt) arrays for the current time chunk,
+        ## passed to the tod2map kernels without copy.
+        self.chunk_buffers = dict(
+            [(name, getattr(self, name).reshape(-1)) for name in
+             ['point_matrix', 'pol_cos', 'pol_sin', 'wafermask_pixel']])
+        self.set_chunk(self.chunk_start)
 
         ## Get observed pixels in the input map
         if nside_out is None:
@@ -156,18 +278,44 @@ class TimeOrderedDataPairDiff():
         else:
             self.pixel_size = pixel_size * am2rad
 
+        ## Derive the sky patch bounds from the footprint of the scan.
+        ## Pixels are selected by their center, so the
+        ## resolution is added to the focal plane radius.
+        self.width_margin = width_margin
+        if isinstance(self.width, str) and self.width == 'auto':
+            if self.projection == 'healpix':
+                resolution = hp.nside2resol(self.nside_out)
+            else:
+                resolution = self.pixel_size
+            self.width = get_scan_footprint(
+                self.hardware, self.scanning_strategy,
+                projection=self.projection, margin=self.width_margin,
+                resolution=resolution)
+
         self.obspix, self.npixsky = self.get_obspix(
             self.width,
             self.scanning_strategy.ra_mid,
             self.scanning_strategy.dec_mid)
 
+        ## Ring-offset table to go from global to local output indices
+        self.obspix_rings = None
+        if self.projection == 'healpix':
+            self.obspix_rings = input_sky.get_ring_offsets(
+                self.obspix, self.nside_out)
+
+        ## Drop the pixels of the input map outside the sky patch
+        if compact_input and self.HealpixFitsMap.obspix is None:
+            self.compact_input_map()
+
         ## Get timestream weights
         self.sum_weight, self.diff_weight = self.get_weights()
 
         ## Get detector gains
         self.set_detector_gains()
 
-        ## Prepare noise simulator if needed
+        ## Prepare noise simulator if needed. In chunk mode, noise is
+        ## drawn by blocks so that chunks do not replay the samples before
+        ## them (see WhiteNoiseGenerator).
         self.array_noise_level = array_noise_level
         self.array_noise_seed = array_noise_seed
         if self.array_noise_level is not None:
@@ -175,10 +323,123 @@ class TimeOrderedDataPairDiff():
                 array_noise_level=self.array_noise_level,
                 ndetectors=2*self.npair,
                 ntimesamples=self.nsamples,
-                array_noise_seed=self.array_noise_seed)
+                array_noise_seed=self.array_noise_seed,
+                precision=self.precision,
+                block_size=None if chunk_size is None else 2**16)
         else:
             self.noise_generator = None
 
+        ## On-disk cache for detector pointing, opened for the current
+        ## detector offsets when pointing is needed (see get_pointing_cache)
+        self.pointing_cache_dir = pointing_cache_dir
+        self.pointing_cache = None
+        self.pointing_digest = None
+
+        ## Sample permutation sorting the current pointing by pixel,
+        ## and pair of each row of the buffers (see get_pixel_order)
+        self.pixel_order = None
+        self.row_pairs = -np.ones(self.group_size, dtype=np.int64)
+
+    def get_pointing_key(self):
+        """
+        Hash of everything the detector pointing depends on: scan,
+        pointing model, site, detector offsets and output sky patch.
+
+        Returns
+        ----------
+        key : string
+            md5 hexadecimal digest.
+
+        Examples
+        ----------
+        >>> inst, scan, sky_in = load_fake_instrument()
+        >>> tod0 = TimeOrderedDataPairDiff(inst, scan, sky_in, CESnumber=0)
+        >>> tod1 = TimeOrderedDataPairDiff(inst, scan, sky_in, CESnumber=1)
+        >>> tod0bis = TimeOrderedDataPairDiff(inst, scan, sky_in, CESnumber=0)
+        >>> print(tod0.get_pointing_key() == tod1.get_pointing_key())
+        False
+        >>> print(tod0.get_pointing_key() == tod0bis.get_pointing_key())
+        True
+
+        Detector offsets can change after initialisation
+        >>> key = tod0.get_pointing_key()
+        >>> tod0.xpos = tod0.xpos + 1e-3
+        >>> print(tod0.get_pointing_key() == key)
+        False
+        """
+        ## Scan and sky patches do not change after initialisation:
+        ## their digest is computed once.
+        if self.pointing_digest is None:
+            md5 = hashlib.md5()
+            for arr in [self.scan['azimuth'], self.scan['elevation'],
+                        self.scan['clock-utc'], self.obspix]:
+                md5.update(np.ascontiguousarray(arr).tobytes())
+            if self.HealpixFitsMap.obspix is not None:
+                md5.update(self.HealpixFitsMap.obspix.tobytes())
+            self.pointing_digest = md5.hexdigest()
+
+        md5 = hashlib.md5(self.pointing_digest.encode())
+        for arr in [self.xpos, self.ypos]:
+            md5.update(np.ascontiguousarray(arr).tobytes())
+        params = [
+            self.hardware.pointing_model.value_params,
+            self.hardware.pointing_model.allowed_params,
+            self.scanning_strategy.ut1utc_fn,
+            float(self.scanning_strategy.telescope_location.lat),
+            self.scanning_strategy.ra_mid, self.scanning_strategy.dec_mid,
+            self.projection, self.width, self.pixel_size, self.npixsky,
+            self.nside_out, self.HealpixFitsMap.nside,
+            self.HealpixFitsMap.ext_map_gal, self.cut_pixels_outside]
+        md5.update(repr(params).encode())
+        return md5.hexdigest()
+
+    def get_pointing_cache(self):
+        """
+        On-disk cache of the detector pointing (see PointingCache), or
+        None if pointing_cache_dir is None. The key of the cache is
+        recomputed at each call (see get_pointing_key), such that changing
+        the detector offsets or the pointing model after initialisation
+        opens another cache instead of reusing stale pointing.
+
+        Returns
+        ----------
+        pointing_cache : PointingCache instance or None
+            The cache for the current pointing.
+
+        Examples
+        ----------
+        >>> import tempfile, shutil
+        >>> path = tempfile.mkdtemp()
+        >>> inst, scan, sky_in = load_fake_instrument()
+        >>> tod = TimeOrderedDataPairDiff(inst, scan, sky_in, CESnumber=0,
+        ...     pointing_cache_dir=path)
+        >>> d = tod.map2tod_block(range(2 * tod.npair))
+        >>> tod.xpos = tod.xpos + 1e-3
+        >>> print(tod.get_pointing_cache().key == tod.get_pointing_key())
+        True
+        >>> print(len(os.listdir(path)))
+        2
+
+        Timestreams are the ones of the new offsets
+        >>> tod_ref = TimeOrderedDataPairDiff(inst, scan, sky_in, CESnumber=0)
+        >>> tod_ref.xpos = tod_ref.xpos + 1e-3
+        >>> print(np.all(tod.map2tod_block(range(2 * tod.npair)) ==
+        ...     tod_ref.map2tod_block(range(2 * tod.npair))))
+        True
+        >>> shutil.rmtree(path)
+        """
+        if self.pointing_cache_dir is None:
+            return None
+        key = self.get_pointing_key()
+        with self.pointing_lock:
+            if self.pointing_cache is None or self.pointing_cache.key != key:
+                self.pointing_cache = PointingCache(
+                    self.pointing_cache_dir, key,
+                    2 * self.npair, self.nsamples,
+                    index_dtype=np.int64 if 12 * self.HealpixFitsMap.nside**2
+                    > np.iinfo(np.int32).max else np.int32)
+        return self.pointing_cache
+
     def get_angles(self):
         """
         Retrieve polarisation angles: intrinsic (focal plane) and HWP angles,
@@ -190,23 +451,202 @@ class TimeOrderedDataPairDiff():
 
         self.intrinsic_polangle = self.hardware.focal_plane.bolo_polangle
 
-        ## Will contain the total polarisation angles for all bolometers
-        ## That is PA + intrinsic + 2 * HWP
-        if not self.mapping_perpair:
-            self.pol_angs = np.zeros((self.npair, self.nsamples))
-        else:
-            self.pol_angs = np.zeros((1, self.nsamples))
+        ## Will contain cos(2 psi) and sin(2 psi) for all top bolometers,
+        ## where psi is the total polarisation angle PA + intrinsic + 2 * HWP.
+        ## Computed once while scanning, and used by the map-making.
+        shape = (self.group_size, self.chunk_size)
+        self.pol_cos = np.zeros(shape, dtype=self.dtype)
+        self.pol_sin = np.zeros(shape, dtype=self.dtype)
+
+    def get_pair_groups(self, group_size=None, memory_budget=None):
+        """
+        Split the pairs of the focal plane into groups processed at once
+        by the map-making. See mapping_group_size and memory_budget
+        in TimeOrderedDataPairDiff.
+
+        Parameters
+        ----------
+        group_size : int or string, optional
+            Number of pairs per group, or component of the focal plane
+            among ['Cr', 'Sq', 'Df']. Default is None.
+        memory_budget : float, optional
+            Memory in MB for the buffers and temporaries of one group,
+            used if group_size is None. Default is None (one group with
+            all pairs).
+
+        Returns
+        ----------
+        groups : list of 1d array of int
+            Pair indices of each group.
+
+        Examples
+        ----------
+        >>> inst, scan, sky_in = load_fake_instrument(nsquid_per_mux=2)
+        >>> tod = TimeOrderedDataPairDiff(inst, scan, sky_in, CESnumber=0)
+        >>> print([list(g) for g in tod.get_pair_groups(3)])
+        [[0, 1, 2], [3, 4, 5], [6, 7]]
+        >>> print([list(g) for g in tod.get_pair_groups('Sq')])
+        [[0, 1, 2, 3], [4, 5, 6, 7]]
+
+        Groups of pairs whose buffers and temporaries fit in 70 MB
+        >>> print([len(g) for g in tod.get_pair_groups(memory_budget=70.)])
+        [2, 2, 2, 2]
+        """
+        pairs = np.arange(self.npair)
+        if group_size in ['Cr', 'Sq', 'Df']:
+            ## Components are nested: Cr > Df > Sq
+            fp = self.hardware.focal_plane
+            names = ['Cr', 'Df', 'Sq'][:['Cr', 'Df', 'Sq'].index(
+                group_size) + 1]
+            top = self.pair_list[:, 0]
+            keys = [tuple(np.asarray(fp.get_indices(name))[ch]
+                          for name in names) for ch in top]
+            groups = {}
+            for pair, key in zip(pairs, keys):
+                groups.setdefault(key, []).append(pair)
+            return [np.array(groups[key]) for key in sorted(groups)]
+
+        if group_size is None and memory_budget is not None:
+            ## Buffers: pointing matrix and mask (int32), angles
+            ## and timestreams.
+            itemsize = np.dtype(self.dtype).itemsize
+            nsky = self.HealpixFitsMap.nskies
+            buffers = 8 + 2 * itemsize + 2 * nsky * itemsize
+            ## Temporaries of map2tod_block: ra, dec, pa, theta, phi and
+            ## pixel indices (float64, int64) of the pair, pixel indices
+            ## and pa of each bolometer, then polarisation angles and
+            ## modulation, noise (float64) and I, Q, U of each bolometer.
+            temporaries = 5 * 8 + 2 * 8 + 2 * (8 + 4 + 8) + \
+                2 * (8 + 2 * itemsize) + 2 * (8 + 3 * itemsize)
+            bytes_per_pair = self.chunk_size * (buffers + temporaries)
+            group_size = int(memory_budget * 1024**2 // bytes_per_pair)
+        if group_size is None:
+            group_size = self.npair
+        group_size = int(min(max(group_size, 1), self.npair))
+
+        return [pairs[i:i + group_size]
+                for i in range(0, self.npair, group_size)]
+
+    def get_mapping_blocks(self):
+        """
+        Channels of each group of pairs (see get_pair_groups), that is
+        the blocks of timestreams passed to map2tod_block and tod2map.
+
+        Examples
+        ----------
+        >>> inst, scan, sky_in = load_fake_instrument()
+        >>> tod = TimeOrderedDataPairDiff(inst, scan, sky_in, CESnumber=0,
+        ...     mapping_group_size=2)
+        >>> print([list(block) for block in tod.get_mapping_blocks()])
+        [[0, 1, 2, 3], [4, 5, 6, 7]]
+        """
+        return [self.pair_list[group].ravel() for group in self.pair_groups]
 
     def get_timestream_masks(self):
         """
-        Define the masks for all the timestreams.
+        Define the masks for all the timestreams of the current chunk.
         1 if the time sample should be included, 0 otherwise.
-        Set to ones for the moment.
+        Set to ones here, then expanded from the flags of each pair
+        (see TimestreamFlags) when pairs are scanned.
         """
-        if not self.mapping_perpair:
-            return np.ones((self.npair, self.nsamples), dtype=int)
-        else:
-            return np.ones((1, self.nsamples), dtype=int)
+        return np.ones((self.group_size, self.chunk_size), dtype=np.int32)
+
+    def set_chunk(self, start):
+        """
+        Select the time chunk processed by map2tod and tod2map, that is
+        time samples [start, start + chunk_size[ (truncated at the end
+        of the scan).
+
+        Parameters
+        ----------
+        start : int
+            Index of the first time sample of the chunk.
+
+        Examples
+        ----------
+        >>> inst, scan, sky_in = load_fake_instrument()
+        >>> tod = TimeOrderedDataPairDiff(inst, scan, sky_in, CESnumber=0,
+        ...     chunk_size=50000)
+        >>> tod.set_chunk(100000)
+        >>> print(tod.chunk_start, tod.chunk_stop)
+        100000 139992
+        >>> print(tod.map2tod(0).shape)
+        (39992,)
+
+        Buffers of the chunk are contiguous
+        >>> print(tod.point_matrix.shape, tod.point_matrix.flags.c_contiguous)
+        (4, 39992) True
+        """
+        assert 0 <= start < self.nsamples, \
+            ValueError("The chunk must start between 0 and {}.".format(
+                self.nsamples - 1))
+        self.chunk_start = int(start)
+        self.chunk_stop = int(min(start + self.chunk_size, self.nsamples))
+
+        ## Views of size (nrow, nt) on the flat buffers
+        if hasattr(self, 'chunk_buffers'):
+            nt = self.chunk_stop - self.chunk_start
+            for name, buf in self.chunk_buffers.items():
+                nrow = len(buf) // self.chunk_size
+                setattr(self, name, buf[:nrow * nt].reshape((nrow, nt)))
+
+    def flag_turnarounds(self, threshold=0.1):
+        """
+        Flag the turnarounds of the scan for all pairs, that is time
+        samples where the azimuth speed is below threshold times its
+        maximum. Flags are named 'turnaround' (see TimestreamFlags).
+
+        Parameters
+        ----------
+        threshold : float, optional
+            Fraction of the maximum azimuth speed below which samples
+            are flagged. Default is 0.1.
+
+        Examples
+        ----------
+        >>> inst, scan, sky_in = load_fake_instrument()
+        >>> tod = TimeOrderedDataPairDiff(inst, scan, sky_in, CESnumber=0)
+        >>> tod.flag_turnarounds()
+        >>> print(tod.flags.nflagged(0) > 0)
+        True
+
+        Flagged samples are not projected
+        >>> m = OutputSkyMap(projection=tod.projection,
+        ...     nside=tod.nside_out, obspix=tod.obspix)
+        >>> d = tod.map2tod_block(range(2 * tod.npair))
+        >>> tod.tod2map(d, m)
+        >>> print(np.sum(m.nhit) == 4 * (tod.nsamples - tod.flags.nflagged(0)))
+        True
+        """
+        speed = np.abs(np.gradient(self.scan['azimuth'][:self.nsamples]))
+        self.flags.add_mask('turnaround', speed < threshold * np.max(speed))
+
+    def get_scan_direction(self):
+        """
+        Label the time samples of the current chunk by scan direction:
+        0 for increasing azimuth, 1 for decreasing azimuth.
+        To be used as split labels in tod2map.
+
+        Returns
+        ----------
+        direction : 1d array of int
+            Scan direction of each time sample of the chunk.
+
+        Examples
+        ----------
+        >>> inst, scan, sky_in = load_fake_instrument()
+        >>> tod = TimeOrderedDataPairDiff(inst, scan, sky_in, CESnumber=0)
+        >>> direction = tod.get_scan_direction()
+        >>> print(len(direction) == tod.nsamples, np.unique(direction))
+        True [0 1]
+        """
+        az = self.scan['azimuth']
+        start = max(self.chunk_start - 1, 0)
+        stop = min(self.chunk_stop + 1, self.nsamples)
+        daz = np.gradient(az[start:stop])
+        daz = daz[self.chunk_start - start:][:self.chunk_stop -
+                                            self.chunk_start]
+        return (daz < 0).astype(np.int32)
 
     def get_obspix(self, width, ra_src, dec_src):
         """
@@ -216,8 +656,10 @@ class TimeOrderedDataPairDiff():
 
         Parameters
         ----------
-        width : float
-            Width of the patch in degree.
+        width : float or list of 4 floats
+            Width of the patch in degree, or extent of the patch on each
+            side of its center [left, right, bottom, top] in degree
+            (healpix projection only).
         ra_src : float
             RA of the center of the patch in degree.
         dec_src : float
@@ -252,6 +694,14 @@ class TimeOrderedDataPairDiff():
         [1376 1439 1440 1504 1567 1568 1632 1695]
         >>> print(npix, len(obspix))
         16 8
+
+        Flat patches are square
+        >>> tod = TimeOrderedDataPairDiff(inst, scan, sky_in, CESnumber=0,
+        ...     projection='flat', width=[5., 5., 5., 5.])
+        Traceback (most recent call last):
+          ...
+        AssertionError: Flat projection works with square patches only:
+        width must be a float or 'auto'!
         """
         ## Change to radian
         ra_src = ra_src * d2r
@@ -294,6 +744,62 @@ class TimeOrderedDataPairDiff():
 
         return obspix, npixsky
 
+    def compact_input_map(self, margin=None):
+        """
+        Compact the input map to the pixels that can be seen by the
+        detectors, that is a disc enclosing the sky patch plus a margin
+        (see HealpixFitsMap.compact). Global indices of the pointing
+        are then converted to indices in the compacted map, and
+        an error is raised if a detector falls outside.
+
+        Parameters
+        ----------
+        margin : float, optional
+            Margin in degree around the sky patch.
+            Default is width_margin.
+
+        Examples
+        ----------
+        >>> inst, scan, sky_in = load_fake_instrument()
+        >>> tod = TimeOrderedDataPairDiff(inst, scan, sky_in, CESnumber=0,
+        ...     width='auto')
+        >>> d = tod.map2tod_block(range(2 * tod.npair))
+        >>> tod.compact_input_map()
+        >>> print(len(sky_in.I) < 12 * sky_in.nside**2)
+        True
+
+        Timestreams are unchanged
+        >>> print(np.all(tod.map2tod_block(range(2 * tod.npair)) == d))
+        True
+        """
+        if margin is None:
+            margin = self.width_margin
+
+        ## Corners of the sky patch
+        if self.projection == 'healpix':
+            ra = np.array([self.xmin, self.xmax])
+            dec = np.array([self.ymin, self.ymax])
+        elif self.projection == 'flat':
+            ## Lambert cylindrical patch centered on (0, 0)
+            ra = np.array([-1., 1.]) * self.width / 2. * d2r
+            dec = np.arcsin(np.clip(ra, -1., 1.))
+        ra_c = np.mean(ra)
+        dec_c = np.mean(dec)
+        ra, dec = [arr.ravel() for arr in np.meshgrid(ra, dec)]
+
+        theta, phi = radec2thetaphi(np.append(ra, ra_c), np.append(dec, dec_c))
+        if self.HealpixFitsMap.ext_map_gal:
+            r = hp.Rotator(coord=['C', 'G'])
+            theta, phi = r(theta, phi)
+        vec = hp.ang2vec(theta, phi)
+        radius = np.max(np.arccos(np.clip(np.dot(vec[:-1], vec[-1]), -1, 1)))
+        radius += margin * d2r + hp.nside2resol(self.HealpixFitsMap.nside)
+
+        obspix = hp.query_disc(
+            self.HealpixFitsMap.nside, vec[-1], min(radius, np.pi),
+            inclusive=True)
+        self.HealpixFitsMap.compact(np.sort(obspix))
+
     def get_weights(self):
         """
         Return the noise weights of the sum and difference timestreams
@@ -310,10 +816,7 @@ class TimeOrderedDataPairDiff():
         diff_weight : 1d array
             Weights for the difference of timestreams (size: npair)
         """
-        if not self.mapping_perpair:
-            return np.ones((2, self.npair), dtype=int)
-        else:
-            return np.ones((2, 1), dtype=int)
+        return np.ones((2, self.group_size), dtype=np.float64)
 
     def set_detector_gains(self, new_gains=None):
         """
@@ -434,10 +937,11 @@ class TimeOrderedDataPairDiff():
 
         Parameters
         ----------
-        ch : int
-            Channel index in the focal plane.
+        ch : int or 1d array of int
+            Channel index in the focal plane (or block of channels).
         parallactic_angle : 1d array
-            All parallactic angles for detector ch.
+            All parallactic angles for detector ch (current time chunk).
+            For a block of channels, 2d array of size (nchannels, nt).
         polangle_err : bool, optional
             If True, inject systematic effect.
             TODO: remove that in the systematic module.
@@ -458,14 +962,21 @@ class TimeOrderedDataPairDiff():
         [ 0.          0.31415927  0.62831853  0.9424778 ]
         """
         if not polangle_err:
-            ang_pix = (90.0 - self.intrinsic_polangle[ch]) * d2r
+            ang_pix = (90.0 - np.asarray(self.intrinsic_polangle)[ch]) * d2r
+
+            ## Block of channels: one row per channel
+            if np.ndim(ang_pix) > 0:
+                ang_pix = ang_pix[:, None]
+
+            ## HWP angles for the current time chunk
+            hwpangle = self.hwpangle[self.chunk_start:self.chunk_stop]
 
             ## Demodulation or pair diff use different convention
             ## for the definition of the angle.
             if not hasattr(self, 'dm'):
-                pol_ang = parallactic_angle + ang_pix + 2.0 * self.hwpangle
+                pol_ang = parallactic_angle + ang_pix + 2.0 * hwpangle
             else:
-                pol_ang = parallactic_angle - ang_pix - 2.0 * self.hwpangle
+                pol_ang = parallactic_angle - ang_pix - 2.0 * hwpangle
         else:
             print("This is where you call the systematic module!")
             sys.exit()
@@ -476,8 +987,7 @@ class TimeOrderedDataPairDiff():
     def map2tod(self, ch):
         """
         Scan the input sky maps to generate timestream for channel ch.
-        /!\ this is currently the bottleneck in computation. Need to speed
-        up this routine!
+        See map2tod_block to scan several channels at once.
 
         Parameters
         ----------
@@ -489,6 +999,7 @@ class TimeOrderedDataPairDiff():
         ts : 1d array
             The timestream for detector ch. If `self.HealpixFitsMap.do_pol` is
             True it returns intensity+polarisation, otherwise just intensity.
+            If the input contains several skies, array of size (nskies, nt).
 
         Examples
         ----------
@@ -498,13 +1009,635 @@ class TimeOrderedDataPairDiff():
         >>> print(round(d[0], 3)) #doctest: +NORMALIZE_WHITESPACE
         -42.874
         """
-        ## Use bolometer beam offsets.
-        azd, eld = self.xpos[ch], self.ypos[ch]
+        return self.map2tod_block([ch])[0]
+
+    def map2tod_block(self, channels, out=None):
+        """
+        Scan the input sky maps to generate timestreams for a block of
+        channels at once. Pointing is computed for all channels of the block,
+        and pixel indices, sky values, modulation and gains are then
+        computed in one go for the whole block.
+        Timestreams are identical to the ones of map2tod.
+        Only the current time chunk is scanned (see set_chunk).
+        If nthreads > 1, channels are split among a pool of threads.
+
+        Parameters
+        ----------
+        channels : list of int
+            Channel indices in the focal plane.
+        out : 2d array, optional
+            Preallocated array of size (len(channels), nt) in which
+            the timestreams are written, where nt is the size of the
+            current time chunk. If the input contains several skies
+            (see HealpixFitsMap.stack_skies), the size is
+            (len(channels), nskies, nt). Default is None (new array).
+
+        Returns
+        ----------
+        out : 2d or 3d array
+            The timestreams for detectors in channels,
+            of size (len(channels), nt) or (len(channels), nskies, nt).
+
+        Examples
+        ----------
+        >>> inst, scan, sky_in = load_fake_instrument()
+        >>> tod = TimeOrderedDataPairDiff(inst, scan, sky_in, CESnumber=1,
+        ...     array_noise_level=10.)
+        >>> d = tod.map2tod_block(range(2 * tod.npair))
+        >>> print(d.shape)
+        (8, 115200)
+        >>> print(np.all(d[3] == tod.map2tod(3)))
+        True
+
+        Timestreams can be written in a preallocated array
+        >>> out = np.zeros((2, tod.nsamples))
+        >>> _ = tod.map2tod_block(tod.pair_list[1], out=out)
+        >>> print(np.all(out == d[2:4]))
+        True
+
+        Same timestreams using several threads
+        >>> tod.nthreads = 3
+        >>> print(np.all(tod.map2tod_block(range(2 * tod.npair)) == d))
+        True
+
+        Several skies scanned in one pass
+        >>> sky2 = input_sky.HealpixFitsMap(sky_in.input_filename, map_seed=1,
+        ...     nside_in=sky_in.nside)
+        >>> sky_in.stack_skies([sky2])
+        >>> tod = TimeOrderedDataPairDiff(inst, scan, sky_in, CESnumber=1,
+        ...     array_noise_level=10.)
+        >>> d2 = tod.map2tod_block(range(2 * tod.npair))
+        >>> print(d2.shape)
+        (8, 2, 115200)
+        >>> print(np.all(d2[:, 0] == d))
+        True
+
+        Same timestreams with interleaved input maps
+        >>> sky_in.interleave()
+        >>> print(np.all(tod.map2tod_block(range(2 * tod.npair)) == d2))
+        True
+
+        Single precision timestreams
+        >>> tod = TimeOrderedDataPairDiff(inst, scan, sky_in, CESnumber=1,
+        ...     array_noise_level=10., precision='single')
+        >>> d32 = tod.map2tod_block(range(2 * tod.npair))
+        >>> print(d32.dtype, np.allclose(d32, d2, rtol=1e-4, atol=1e-3))
+        float32 True
+        """
+        channels = np.asarray(channels, dtype=int)
+        nch = len(channels)
+        nt = self.chunk_stop - self.chunk_start
+        if self.HealpixFitsMap.nskies == 1:
+            shape = (nch, nt)
+        else:
+            shape = (nch, self.HealpixFitsMap.nskies, nt)
+        if out is None:
+            out = np.empty(shape, dtype=self.dtype)
+        assert out.shape == shape, \
+            ValueError("out must have shape {}!".format(shape))
+
+        rows = self._get_block_rows(channels // 2)
+        self._run_block(self._map2tod_block, channels, out, rows)
+
+        return out
+
+    def _get_block_rows(self, pairs):
+        """
+        Rows of the pairs in the map-making buffers: pair index for
+        the whole array, position of the pair in the block otherwise.
+        """
+        if self.group_size == self.npair:
+            rows = pairs
+        else:
+            _, first, inverse = np.unique(
+                pairs, return_index=True, return_inverse=True)
+            rows = np.argsort(np.argsort(first))[inverse]
+        assert np.all(rows < self.group_size), \
+            ValueError("Blocks must have at most {} pairs!".format(
+                self.group_size))
+        return rows
+
+    def _run_block(self, func, items, out, rows):
+        """
+        Call func(items, out, rows) on the current thread, or on
+        contiguous sub-blocks of items with a pool of nthreads threads
+        (compiled kernels release the GIL).
+        """
+        nthreads = min(self.nthreads, len(items))
+        if nthreads <= 1:
+            func(items, out, rows)
+            return
+
+        bounds = np.linspace(0, len(items), nthreads + 1).astype(int)
+        pool = ThreadPool(nthreads)
+        try:
+            pool.map(
+                lambda i: func(
+                    items[bounds[i]:bounds[i + 1]],
+                    out[bounds[i]:bounds[i + 1]],
+                    rows[bounds[i]:bounds[i + 1]]),
+                range(nthreads))
+        finally:
+            pool.close()
+            pool.join()
+
+    def map2tod_sumdiff(self, pairs, out=None):
+        """
+        Scan the input sky maps to generate the half-sum and
+        half-difference timestreams of a block of pairs, that is the
+        quantities used by the map-making (see tod2map with sumdiff=True).
+        When the bolometers of a pair share their beam offsets, pointing
+        is computed and the input sky is read once per pair, and
+        modulated with the polarisation angles of the two bolometers.
+        Top and bottom timestreams are combined in place in out.
+        If nthreads > 1, pairs are split among a pool of threads.
+
+        Parameters
+        ----------
+        pairs : list of int
+            Pair indices (rows of pair_list).
+        out : 3d array, optional
+            Preallocated array of size (len(pairs), 2, nt), or
+            (len(pairs), 2, nskies, nt) for several skies. Default is None.
+
+        Returns
+        ----------
+        out : 3d or 4d array
+            out[:, 0] is the half-sum and out[:, 1] the half-difference
+            of the top and bottom timestreams of each pair.
+
+        Examples
+        ----------
+        >>> inst, scan, sky_in = load_fake_instrument()
+        >>> tod = TimeOrderedDataPairDiff(inst, scan, sky_in, CESnumber=0,
+        ...     array_noise_level=10.)
+        >>> d = tod.map2tod_block(tod.pair_list[1])
+        >>> sd = tod.map2tod_sumdiff([1])
+        >>> print(sd.shape)
+        (1, 2, 139992)
+        >>> print(np.allclose(sd[0, 1], 0.5 * (d[0] - d[1])))
+        True
+        >>> print(np.allclose(sd[0, 0], 0.5 * (d[0] + d[1])))
+        True
+
+        Bolometers of a pair with different beam offsets
+        >>> tod.xpos = tod.xpos.copy()
+        >>> tod.xpos[3] += 1e-3
+        >>> d = tod.map2tod_block(tod.pair_list[1])
+        >>> tod.nthreads = 2
+        >>> sd = tod.map2tod_sumdiff([0, 1])
+        >>> print(np.allclose(sd[1, 1], 0.5 * (d[0] - d[1])))
+        True
+        """
+        pairs = np.atleast_1d(pairs)
+        nt = self.chunk_stop - self.chunk_start
+        if self.HealpixFitsMap.nskies == 1:
+            shape = (len(pairs), 2, nt)
+        else:
+            shape = (len(pairs), 2, self.HealpixFitsMap.nskies, nt)
+        if out is None:
+            out = np.empty(shape, dtype=self.dtype)
+        assert out.shape == shape, \
+            ValueError("out must have shape {}!".format(shape))
+
+        rows = self._get_block_rows(pairs)
+        self._run_block(self._map2tod_sumdiff, pairs, out, rows)
+
+        return out
+
+    def _map2tod_sumdiff(self, pairs, out, rows):
+        """
+        Scan the input sky maps for a block of pairs in the current
+        thread. See map2tod_sumdiff.
+        """
+        top_channels = self.pair_list[pairs, 0]
+        bottom_channels = self.pair_list[pairs, 1]
+
+        ## Pointing once per pair, unless the two bolometers of a pair
+        ## have different beam offsets.
+        shared = np.all(
+            (self.xpos[top_channels] == self.xpos[bottom_channels]) &
+            (self.ypos[top_channels] == self.ypos[bottom_channels]))
+        if shared:
+            index_global, index_local, pa = self._get_block_pointing(
+                top_channels)
+            index_global_b, pa_b = index_global, pa
+        else:
+            index_global, index_local, pa = self._get_block_pointing(
+                self.pair_list[pairs].ravel())
+            index_global_b, pa_b = index_global[1::2], pa[1::2]
+            index_global, index_local, pa = \
+                index_global[0::2], index_local[0::2], pa[0::2]
+
+        self._store_block_pointing(top_channels, rows, index_local)
+
+        norm_t = self._get_block_gains(top_channels)
+        norm_b = self._get_block_gains(bottom_channels)
+        noise_t = self._get_block_noise(top_channels)
+        noise_b = self._get_block_noise(bottom_channels)
+        mod_t = self._get_block_modulation(top_channels, rows, pa)
+        mod_b = self._get_block_modulation(bottom_channels, rows, pa_b)
+
+        nsky = self.HealpixFitsMap.nskies
+        for k in range(nsky):
+            if nsky == 1:
+                top, bottom = out[:, 0], out[:, 1]
+            else:
+                top, bottom = out[:, 0, k], out[:, 1, k]
+            sky_t = self._get_sky_values(index_global, k)
+            if shared:
+                sky_b = sky_t
+            else:
+                sky_b = self._get_sky_values(index_global_b, k)
+            self._fill_timestreams(top, sky_t, mod_t, noise_t, norm_t)
+            self._fill_timestreams(bottom, sky_b, mod_b, noise_b, norm_b)
+
+        ## (t + b) / 2 and (t - b) / 2
+        top, bottom = out[:, 0], out[:, 1]
+        top += bottom
+        top *= 0.5
+        bottom *= -1.
+        bottom += top
+
+    def _map2tod_block(self, channels, out, rows):
+        """
+        Scan the input sky maps for a block of channels in the current
+        thread. rows are the rows of the pairs of the channels in the
+        buffers of the map-making. See map2tod_block.
+        """
+        index_global, index_local, pa = self._get_block_pointing(channels)
+        self._store_block_pointing(channels, rows, index_local)
+
+        norm = self._get_block_gains(channels)
+        noise = self._get_block_noise(channels)
+        modulation = self._get_block_modulation(channels, rows, pa)
+
+        nsky = self.HealpixFitsMap.nskies
+        for k in range(nsky):
+            if nsky == 1:
+                outk = out
+            else:
+                outk = out[:, k]
+            self._fill_timestreams(
+                outk, self._get_sky_values(index_global, k),
+                modulation, noise, norm)
+
+        return out
+
+    def _get_block_pointing(self, channels):
+        """
+        Pixels on the sky, their index locally, and parallactic angles
+        of a block of channels for the current time chunk.
+        """
+        start, stop = self.chunk_start, self.chunk_stop
+        pointing_cache = self.get_pointing_cache()
+        if pointing_cache is None:
+            return self.get_detector_pointing(channels, start, stop)
+        return pointing_cache.load(
+            channels, start, stop, self.get_detector_pointing)
+
+    def _store_block_pointing(self, channels, rows, index_local):
+        """
+        Store list of hit pixels and masks only for top bolometers.
+        The pixel permutation is dropped if the pointing of a row changes.
+        """
+        start, stop = self.chunk_start, self.chunk_stop
+        nt = stop - start
+        for pos, ch in enumerate(channels):
+            if ch % 2 != 0:
+                continue
+            row = rows[pos]
+            if not np.array_equal(self.point_matrix[row, :nt],
+                                  index_local[pos]):
+                self.pixel_order = None
+                self.point_matrix[row, :nt] = index_local[pos]
+            self.row_pairs[row] = ch // 2
+            self.flags.expand(
+                int(ch/2), start, stop, out=self.wafermask_pixel[row, :nt])
+
+    def _get_block_gains(self, channels):
+        """
+        Gains of a block of channels, of size (nchannels, 1), or
+        (nchannels, nt) for time-dependent gains.
+        """
+        ## Default gain for a detector is 1.,
+        ## but you can change it using set_detector_gains or
+        ## set_detector_gains_perpair.
+        gain = np.asarray(self.gain)
+        if len(gain) == self.npair * 2:
+            norm = gain[channels]
+        elif len(gain) == 2:
+            norm = gain[channels % 2]
+        if norm.ndim == 1:
+            norm = norm[:, None]
+        else:
+            norm = norm[:, self.chunk_start:self.chunk_stop]
+        return norm.astype(self.dtype, copy=False)
+
+    def _get_block_noise(self, channels):
+        """
+        Noise timestreams of a block of channels (0. without noise).
+        In chunk mode, only the samples of the current chunk are drawn.
+        """
+        start, stop = self.chunk_start, self.chunk_stop
+        if self.noise_generator is None:
+            return 0.0
+        if stop - start == self.nsamples:
+            return np.array([
+                self.noise_generator.simulate_noise_one_detector(ch)
+                for ch in channels])
+        return np.array([
+            self.noise_generator.simulate_noise_one_detector(
+                ch, start=start, stop=stop)
+            for ch in channels])
+
+    def _get_block_modulation(self, channels, rows, pa):
+        """
+        cos(2 psi) and sin(2 psi) of a block of channels, with psi the
+        polarisation angles (None if the input sky is not polarised).
+        The modulation of the map-making is stored for top bolometers.
+        """
+        if not self.HealpixFitsMap.do_pol:
+            return None
+
+        start, stop = self.chunk_start, self.chunk_stop
+        nt = stop - start
+        pol_ang = self.compute_simpolangle(channels, pa,
+                                           polangle_err=False)
+
+        cos2 = np.cos(2 * pol_ang).astype(self.dtype, copy=False)
+        sin2 = np.sin(2 * pol_ang).astype(self.dtype, copy=False)
+
+        ## Store modulation only for top bolometers.
+        ## For demodulation, HWP angles are not included at the level
+        ## of the pointing matrix (convention).
+        for pos, ch in enumerate(channels):
+            if ch % 2 != 0:
+                continue
+            row = rows[pos]
+            if hasattr(self, 'dm'):
+                pol_ang_out = pol_ang[pos] + \
+                    2.0 * self.hwpangle[start:stop]
+                self.pol_cos[row, :nt] = np.cos(2 * pol_ang_out)
+                self.pol_sin[row, :nt] = np.sin(2 * pol_ang_out)
+            else:
+                self.pol_cos[row, :nt] = cos2[pos]
+                self.pol_sin[row, :nt] = sin2[pos]
+
+        return cos2, sin2
+
+    def _get_sky_values(self, index_global, k):
+        """
+        I, Q and U values of the input sky k at the pixels index_global
+        (Q and U are None if the input sky is not polarised).
+        Interleaved input maps are read with one gather.
+        """
+        sky = self.HealpixFitsMap
+        if sky.IQU is not None:
+            iqu = np.reshape(sky.IQU, (sky.nskies, -1, 3))[k][index_global]
+            return iqu[..., 0], iqu[..., 1], iqu[..., 2]
+
+        I = np.reshape(sky.I, (sky.nskies, -1))[k][index_global]
+        if not sky.do_pol:
+            return I, None, None
+        Q = np.reshape(sky.Q, (sky.nskies, -1))[k][index_global]
+        U = np.reshape(sky.U, (sky.nskies, -1))[k][index_global]
+        return I, Q, U
+
+    def _fill_timestreams(self, out, sky_values, modulation, noise, norm):
+        """
+        Write (I + Q cos(2 psi) + U sin(2 psi) + noise) * gain in out.
+        """
+        ## For flat projection, one needs to flip the sign of U
+        ## (angle convention)
+        if self.projection == 'flat':
+            sign = -1.
+        else:
+            sign = 1.
+
+        I, Q, U = sky_values
+        out[:] = I
+        if modulation is not None:
+            cos2, sin2 = modulation
+            out += Q * cos2
+            out += sign * U * sin2
+        out += noise
+        out *= norm
+
+    def scan_and_project(self, output_maps, process_chunk=None,
+                         sumdiff=False, split=None):
+        """
+        Streaming simulation of the scan: for each time chunk (of size
+        chunk_size), scan the input map, optionally inject time-local
+        systematics, and project the timestreams into output_maps.
+        Peak memory scales with chunk_size instead of the length of the scan.
+        Timestreams are identical to the unchunked ones, and so are
+        the output maps (up to the order of floating-point additions).
+
+        Not available for demodulation, which filters the full timestreams.
+
+        Parameters
+        ----------
+        output_maps : OutputSkyMap instance
+            Instance of OutputSkyMap which contains the sky maps.
+        process_chunk : callable, optional
+            Function called as process_chunk(d, channels, start, stop)
+            for each block of timestreams d (all detectors, or one pair if
+            mapping_perpair) before projection, to modify d in place
+            (e.g. gains, crosstalk). start and stop are the time samples
+            of the chunk.
+        sumdiff : bool, optional
+            If True, d contains the half-sum and half-difference of pairs,
+            of size (npairs, 2, nt), see map2tod_sumdiff. Channels passed to
+            process_chunk are then pair indices. Default is False.
+            Blocks whose pairs are flagged over the whole chunk (see
+            TimestreamFlags) are neither scanned nor projected.
+        split : callable, optional
+            Function called as split(pairs, start, stop) for each block of
+            timestreams, returning the split labels of its samples
+            (see tod2map), where pairs are the pair indices of the block.
+
+        Examples
+        ----------
+        One chunk for the whole scan (noise is drawn by blocks in
+        chunk mode, see WhiteNoiseGenerator)
+        >>> inst, scan, sky_in = load_fake_instrument()
+        >>> tod = TimeOrderedDataPairDiff(inst, scan, sky_in, CESnumber=0,
+        ...     array_noise_level=10., chunk_size=200000)
+        >>> m = OutputSkyMap(projection=tod.projection,
+        ...     nside=tod.nside_out, obspix=tod.obspix)
+        >>> tod.tod2map(tod.map2tod_block(range(2 * tod.npair)), m)
+
+        Same maps processing the scan by chunks
+        >>> tod_chunk = TimeOrderedDataPairDiff(inst, scan, sky_in,
+        ...     CESnumber=0, array_noise_level=10., chunk_size=10000)
+        >>> m_chunk = OutputSkyMap(projection=tod.projection,
+        ...     nside=tod.nside_out, obspix=tod.obspix)
+        >>> tod_chunk.scan_and_project(m_chunk)
+        >>> print(np.all(m.nhit == m_chunk.nhit))
+        True
+        >>> print(np.allclose(m.get_I(), m_chunk.get_I()))
+        True
+
+        Same maps from pair sum and difference timestreams
+        >>> m_sd = OutputSkyMap(projection=tod.projection,
+        ...     nside=tod.nside_out, obspix=tod.obspix)
+        >>> tod_chunk.scan_and_project(m_sd, sumdiff=True)
+        >>> print(np.allclose(m.get_QU(), m_sd.get_QU()))
+        True
+
+        Same maps processing pairs by groups of 3, with one buffer
+        >>> tod_group = TimeOrderedDataPairDiff(inst, scan, sky_in,
+        ...     CESnumber=0, array_noise_level=10., chunk_size=10000,
+        ...     mapping_group_size=3)
+        >>> m_group = OutputSkyMap(projection=tod.projection,
+        ...     nside=tod.nside_out, obspix=tod.obspix)
+        >>> tod_group.scan_and_project(m_group)
+        >>> print(np.allclose(m.get_QU(), m_group.get_QU()))
+        True
+
+        Maps of the two halves of the focal plane in one pass
+        >>> m_split = OutputSkyMap(projection=tod.projection,
+        ...     nside=tod.nside_out, obspix=tod.obspix, nsplits=2)
+        >>> tod_chunk.scan_and_project(m_split,
+        ...     split=lambda pairs, start, stop:
+        ...         (np.asarray(pairs)[:, None] >= tod.npair // 2))
+        >>> print(np.all(m_split.coadd_splits().nhit == m.nhit))
+        True
+
+        Chunks flagged for all pairs are skipped
+        >>> tod_chunk.flags.add('cut', [[0, 50000]])
+        >>> m_cut = OutputSkyMap(projection=tod.projection,
+        ...     nside=tod.nside_out, obspix=tod.obspix)
+        >>> tod_chunk.scan_and_project(m_cut)
+        >>> print(np.sum(m_cut.nhit) == np.sum(m.nhit) - 4 * 50000)
+        True
+        """
+        assert not hasattr(self, 'dm'), \
+            ValueError("Streaming is not available with demodulation!")
+
+        block_pairs = self.pair_groups
+        if sumdiff:
+            blocks = block_pairs
+        else:
+            blocks = self.get_mapping_blocks()
+
+        ## Timestream buffer of the largest group, allocated once
+        ## and reused for all groups and chunks
+        if self.HealpixFitsMap.nskies == 1:
+            shape = ()
+        else:
+            shape = (self.HealpixFitsMap.nskies,)
+        if sumdiff:
+            shape = (2,) + shape
+        nrows = max([len(block) for block in blocks])
+        buf = np.empty(nrows * int(np.prod(shape)) * self.chunk_size,
+                       dtype=self.dtype)
+
+        for start in range(0, self.nsamples, self.chunk_size):
+            self.set_chunk(start)
+            nt = self.chunk_stop - self.chunk_start
+            for block, pairs in zip(blocks, block_pairs):
+                if self.flags.all_flagged(
+                        pairs, self.chunk_start, self.chunk_stop):
+                    continue
+                ## Contiguous view of size (len(block),) + shape + (nt,)
+                out = buf[:len(block) * int(np.prod(shape)) * nt].reshape(
+                    (len(block),) + shape + (nt,))
+                if sumdiff:
+                    d = self.map2tod_sumdiff(block, out=out)
+                else:
+                    d = self.map2tod_block(block, out=out)
+                if process_chunk is not None:
+                    process_chunk(d, block, self.chunk_start, self.chunk_stop)
+                if split is not None:
+                    labels = split(pairs, self.chunk_start, self.chunk_stop)
+                else:
+                    labels = None
+                self.tod2map(d, output_maps, sumdiff=sumdiff, split=labels)
+
+        self.set_chunk(0)
+
+    def get_detector_pointing(self, channels, start, stop):
+        """
+        Compute the pointing of a block of channels for time samples
+        [start, stop[, using bolometer beam offsets.
+        Channels with the same beam offsets (e.g. the two bolometers of
+        a pair) share the computation.
+
+        Parameters
+        ----------
+        channels : 1d array of int
+            Channel indices in the focal plane.
+        start : int
+            First time sample.
+        stop : int
+            Last time sample (excluded).
+
+        Returns
+        ----------
+        index_global : 2d array
+            Pixel indices in the input map, size (nchannels, nt).
+        index_local : 2d array
+            Pixel indices in the output sky patch (-1 if outside).
+        pa : 2d array
+            Parallactic angles in radian.
+        """
+        if self.pointing is None:
+            with self.pointing_lock:
+                if self.pointing is None:
+                    self.get_boresightpointing()
+
+        ## Pointing computed once per distinct beam offset
+        channels = np.asarray(channels, dtype=int)
+        offsets = np.array([self.xpos[channels], self.ypos[channels]]).T
+        _, first, inverse = np.unique(
+            offsets, axis=0, return_index=True, return_inverse=True)
+        inverse = np.ravel(inverse)
+
+        nch = len(first)
+        nt = stop - start
+        ra = np.empty((nch, nt))
+        dec = np.empty((nch, nt))
+        pa = np.empty((nch, nt))
+        for pos, ch in enumerate(channels[first]):
+            ra[pos], dec[pos], pa[pos] = self.pointing.offset_detector(
+                self.xpos[ch], self.ypos[ch], samples=slice(start, stop))
+
+        index_global, index_local, sign = self.get_pixel_indices(
+            ra.ravel(), dec.ravel())
+
+        if nch == len(channels) and np.all(inverse == np.arange(nch)):
+            return (index_global.reshape((nch, nt)),
+                    index_local.reshape((nch, nt)), pa)
+        return (index_global.reshape((nch, nt))[inverse],
+                index_local.reshape((nch, nt))[inverse], pa[inverse])
+
+    def get_pixel_indices(self, ra, dec):
+        """
+        Retrieve the pixels seen by the detectors in the input map
+        (global indices), and their index in the output sky patch
+        (local indices).
+
+        Parameters
+        ----------
+        ra : 1d array
+            RA coordinates of the detector in radian.
+        dec : 1d array
+            Dec coordinates of the detector in radian.
 
-        ## Compute pointing for detector ch
-        ra, dec, pa = self.pointing.offset_detector(azd, eld)
+        Returns
+        ----------
+        index_global : 1d array
+            Pixel indices in the input map.
+        index_local : 1d array
+            Pixel indices in the output sky patch (-1 if outside).
+        sign : float
+            Sign convention for U (flipped for flat projection).
+        """
+        ## Pixels of the compacted input map (None for full sky)
+        input_obspix = self.HealpixFitsMap.obspix
 
-        ## Retrieve corresponding pixels on the sky, and their index locally.
         if self.projection == 'flat':
             ## ??
             xmin = - self.width/2.*np.pi/180.
@@ -517,7 +1650,9 @@ class TimeOrderedDataPairDiff():
                 pixel_size=self.pixel_size,
                 npix_per_row=int(np.sqrt(self.npixsky)),
                 projection=self.projection,
-                cut_pixels_outside=self.cut_pixels_outside)
+                cut_pixels_outside=self.cut_pixels_outside,
+                input_obspix=input_obspix,
+                input_obspix_rings=self.HealpixFitsMap.obspix_rings)
             ## For flat projection, one needs to flip the sign of U
             ## (angle convention)
             sign = -1.
@@ -528,69 +1663,41 @@ class TimeOrderedDataPairDiff():
                 obspix=self.obspix,
                 ext_map_gal=self.HealpixFitsMap.ext_map_gal,
                 projection=self.projection,
-                cut_pixels_outside=self.cut_pixels_outside)
+                cut_pixels_outside=self.cut_pixels_outside,
+                input_obspix=input_obspix,
+                obspix_rings=self.obspix_rings,
+                input_obspix_rings=self.HealpixFitsMap.obspix_rings)
             sign = 1.
 
-        ## Store list of hit pixels only for top bolometers
-        if ch % 2 == 0 and not self.mapping_perpair:
-            self.point_matrix[int(ch/2)] = index_local
-        elif ch % 2 == 0 and self.mapping_perpair:
-            self.point_matrix[0] = index_local
-
-        ## Default gain for a detector is 1.,
-        ## but you can change it using set_detector_gains or
-        ## set_detector_gains_perpair.
-        if len(self.gain) == self.npair * 2:
-            norm = self.gain[ch]
-        elif len(self.gain) == 2:
-            # print("Gains per pair")
-            if ch % 2 == 0:
-                norm = self.gain[0]
-            else:
-                norm = self.gain[1]
-
-        ## Noise simulation
-        if self.noise_generator is not None:
-            noise = self.noise_generator.simulate_noise_one_detector(ch)
-        else:
-            noise = 0.0
-
-        if self.HealpixFitsMap.do_pol:
-            pol_ang = self.compute_simpolangle(ch, pa, polangle_err=False)
+        return index_global, index_local, sign
 
-            ## For demodulation, HWP angles are not included at the level
-            ## of the pointing matrix (convention).
-            if hasattr(self, 'dm'):
-                pol_ang_out = pol_ang + 2.0 * self.hwpangle
-            else:
-                pol_ang_out = pol_ang
-
-            ## Store list polangle only for top bolometers
-            if ch % 2 == 0 and not self.mapping_perpair:
-                self.pol_angs[int(ch/2)] = pol_ang_out
-            elif ch % 2 == 0 and self.mapping_perpair:
-                self.pol_angs[0] = pol_ang_out
-
-            return (self.HealpixFitsMap.I[index_global] +
-                    self.HealpixFitsMap.Q[index_global] * np.cos(2 * pol_ang) +
-                    sign * self.HealpixFitsMap.U[index_global] *
-                    np.sin(2 * pol_ang) + noise) * norm
-        else:
-            return norm * (self.HealpixFitsMap.I[index_global] + noise)
-
-    def tod2map(self, waferts, output_maps):
+    def tod2map(self, waferts, output_maps, sumdiff=False, split=None):
         """
         Project time-ordered data into sky maps for the whole array.
         Maps are updated on-the-fly. Massive speed-up thanks to the
         interface with fortran. Memory consuming though...
+        Timestreams correspond to the current time chunk (see set_chunk).
 
         Parameters
         ----------
         waferts : ndarray
-            Array of timestreams. Size (ndetectors, ntimesamples).
+            Array of timestreams. Size (ndetectors, ntimesamples), or
+            (ndetectors, nskies, ntimesamples) for several input skies.
         output_maps : OutputSkyMap instance
             Instance of OutputSkyMap which contains the sky maps. The
             coaddition of data is done on-the-fly directly.
+        sumdiff : bool, optional
+            If True, waferts contains the half-sum and half-difference
+            timestreams of pairs, of size (npairs, 2, ntimesamples) or
+            (npairs, 2, nskies, ntimesamples). See map2tod_sumdiff.
+            Not available for demodulation. Default is False.
+        split : array of int, optional
+            Split label of the samples, for output maps with nsplits > 1.
+            Broadcast against (npairs, ntimesamples): give (ntimesamples,)
+            labels per time sample (e.g. get_scan_direction), (npairs, 1)
+            labels per pair, or (npairs, ntimesamples) labels per sample.
+            All splits are accumulated in one pass. Default is None
+            (all samples in split 0).
 
         Examples
         ----------
@@ -616,6 +1723,17 @@ class TimeOrderedDataPairDiff():
         >>> assert np.allclose(sky_out[0][mask], sky_in.Q[mask])
         >>> assert np.allclose(sky_out[1][mask], sky_in.U[mask])
 
+        Several skies are projected in one pass
+        >>> sky_in.stack_skies([sky_in])
+        >>> tod = TimeOrderedDataPairDiff(inst, scan, sky_in,
+        ...     CESnumber=0, projection='healpix')
+        >>> d = tod.map2tod_block(range(2 * tod.npair))
+        >>> m2 = OutputSkyMap(projection=tod.projection,
+        ...     nside=tod.nside_out, obspix=tod.obspix, nskies=2)
+        >>> tod.tod2map(d, m2)
+        >>> print(np.all(m2.get_I()[1] == m.get_I()))
+        True
+
         FLAT: Test the routines MAP -> TOD -> MAP.
         >>> inst, scan, sky_in = load_fake_instrument()
         >>> tod = TimeOrderedDataPairDiff(inst, scan, sky_in,
@@ -625,56 +1743,372 @@ class TimeOrderedDataPairDiff():
         ...     npixsky=tod.npixsky, pixel_size=tod.pixel_size)
         >>> tod.tod2map(d, m)
 
+        Single precision timestreams, double precision maps
+        >>> tod32 = TimeOrderedDataPairDiff(inst, scan, sky_in,
+        ...     CESnumber=0, projection='flat', precision='single')
+        >>> m32 = OutputSkyMap(projection=tod.projection,
+        ...     npixsky=tod.npixsky, pixel_size=tod.pixel_size)
+        >>> tod32.tod2map(tod32.map2tod_block(range(2 * tod.npair)), m32)
+        >>> print(m32.d.dtype, np.allclose(m32.get_I(), m.get_I(), atol=1e-3))
+        float64 True
+
+        Same maps using several threads, for both strategies
+        >>> for strategy in ['reduction', 'owner']:
+        ...     tod.nthreads = 3
+        ...     tod.tod2map_strategy = strategy
+        ...     m3 = OutputSkyMap(projection=tod.projection,
+        ...         npixsky=tod.npixsky, pixel_size=tod.pixel_size)
+        ...     tod.tod2map(d, m3)
+        ...     print(np.all(m3.nhit == m.nhit),
+        ...         np.allclose(m3.get_QU(), m.get_QU()))
+        True True
+        True True
+
+        Same maps accumulating samples in pixel order
+        >>> tod.tod2map_strategy = 'sorted'
+        >>> m4 = OutputSkyMap(projection=tod.projection,
+        ...     npixsky=tod.npixsky, pixel_size=tod.pixel_size)
+        >>> tod.tod2map(d, m4)
+        >>> print(np.all(m4.nhit == m.nhit), np.allclose(m4.get_QU(), m.get_QU()))
+        True True
+
+        Same maps processing pairs by groups of 3
+        >>> tod_g = TimeOrderedDataPairDiff(inst, scan, sky_in, CESnumber=0,
+        ...     projection='flat', mapping_group_size=3,
+        ...     tod2map_strategy='sorted')
+        >>> m6 = OutputSkyMap(projection=tod.projection,
+        ...     npixsky=tod.npixsky, pixel_size=tod.pixel_size)
+        >>> for block in tod_g.get_mapping_blocks():
+        ...     tod_g.tod2map(tod_g.map2tod_block(block), m6)
+        >>> print(np.all(m6.nhit == m.nhit), np.allclose(m6.get_QU(), m.get_QU()))
+        True True
+
+        Maps split by scan direction, in one pass
+        >>> tod.tod2map_strategy = 'reduction'
+        >>> m5 = OutputSkyMap(projection=tod.projection,
+        ...     npixsky=tod.npixsky, pixel_size=tod.pixel_size, nsplits=2)
+        >>> tod.tod2map(d, m5, split=tod.get_scan_direction())
+        >>> print(np.all(m5.coadd_splits().nhit == m.nhit))
+        True
+        >>> print(np.all(m5.get_split(0).nhit <= m.nhit))
+        True
         """
-        nbolofp = waferts.shape[0]
-        npixfp = nbolofp / 2
+        if sumdiff:
+            assert not hasattr(self, 'dm'), \
+                ValueError("Sum and difference timestreams are not " +
+                           "available with demodulation!")
+            npixfp = waferts.shape[0]
+            skyshape = waferts.shape[2:-1]
+        else:
+            nbolofp = waferts.shape[0]
+            npixfp = nbolofp // 2
+            skyshape = waferts.shape[1:-1]
         # nt = int(waferts.shape[1])
         nt = int(waferts.shape[-1])
 
-        ## Check sizes
-        assert npixfp == self.point_matrix.shape[0]
-        assert nt == self.point_matrix.shape[1]
-
-        assert npixfp == self.pol_angs.shape[0]
-        assert nt == self.pol_angs.shape[1]
-
-        assert npixfp == self.diff_weight.shape[0]
-        assert npixfp == self.sum_weight.shape[0]
-
-        point_matrix = self.point_matrix.flatten()
-        pol_angs = self.pol_angs.flatten()
-        waferts = waferts.flatten()
-        diff_weight = self.diff_weight.flatten()
-        sum_weight = self.sum_weight.flatten()
-        wafermask_pixel = self.wafermask_pixel.flatten()
+        ## Check sizes. Groups may be smaller than the buffers.
+        assert self.point_matrix.shape == (self.group_size, nt)
+        assert nt == self.chunk_stop - self.chunk_start
+        assert npixfp == self.group_size or \
+            (npixfp < self.group_size < self.npair), \
+            ValueError("Timestreams do not match the pairs of a group!")
+
+        if not hasattr(self, 'dm'):
+            nsky = output_maps.nskies
+            assert (nsky == 1 and skyshape == ()) or \
+                skyshape == (nsky,), \
+                ValueError("Timestreams do not match the number of skies " +
+                           "of the output maps ({})!".format(nsky))
+
+        ## Flat views of the first npixfp rows, in the dtypes of
+        ## the kernels (no copy)
+        point_matrix = self.point_matrix[:npixfp].reshape(-1)
+        nskypix = self.npixsky
+
+        ## Sparse maps: indices of the allocated pixels
+        if output_maps.tile_size is not None:
+            point_matrix = output_maps.to_compact(point_matrix)
+            nskypix = output_maps.npixsky
+
+        ## Split maps: pixel p of split k is p + k * npixsky
+        split_matrix = None
+        if split is not None:
+            assert output_maps.nsplits > 1, \
+                ValueError("Output maps must have nsplits > 1!")
+            labels = np.broadcast_to(split, (npixfp, nt)).reshape(-1)
+            assert np.all((labels >= 0) & (labels < output_maps.nsplits)), \
+                ValueError("Split labels must be between 0 and {}!".format(
+                    output_maps.nsplits - 1))
+            assert output_maps.nsplits * nskypix < 2**31, \
+                ValueError("Too many split pixels ({} x {}) for "
+                           "32-bit indices!".format(
+                               output_maps.nsplits, nskypix))
+            split_matrix = np.where(
+                point_matrix >= 0,
+                point_matrix + labels.astype(np.int64) * nskypix,
+                -1).astype(np.int32)
+            point_matrix = split_matrix
+        nskypix = nskypix * output_maps.nsplits
+        pol_cos = self.pol_cos[:npixfp].reshape(-1)
+        pol_sin = self.pol_sin[:npixfp].reshape(-1)
+        waferts = np.ascontiguousarray(waferts, dtype=self.dtype).reshape(-1)
+        diff_weight = self.diff_weight[:npixfp]
+        sum_weight = self.sum_weight[:npixfp]
+        wafermask_pixel = self.wafermask_pixel[:npixfp].reshape(-1)
+
+        if self.tod2map_strategy == 'sorted':
+            ## The permutation of the current pointing is reused,
+            ## unless samples are split
+            self._tod2map_sorted(
+                waferts, output_maps, npixfp, nt, sumdiff, split_matrix,
+                None if split_matrix is None else wafermask_pixel)
+            return
+
+        ## Single precision kernels accumulate in double precision
+        if self.precision == 'single':
+            tod2map_hwp_f = tod_f.tod2map_hwp_f_sp
+            tod2map_pair_f = tod_f.tod2map_pair_f_sp
+        else:
+            tod2map_hwp_f = tod_f.tod2map_hwp_f
+            tod2map_pair_f = tod_f.tod2map_pair_f
+        strategy = TOD2MAP_STRATEGIES[self.tod2map_strategy]
 
         if hasattr(self, 'dm'):
-            tod_f.tod2map_hwp_f(
+            tod2map_hwp_f(
                 output_maps.d0, output_maps.d4r, output_maps.d4i,
                 output_maps.w0, output_maps.w4, output_maps.nhit,
-                point_matrix, pol_angs, waferts,
-                diff_weight, sum_weight, nt,
-                wafermask_pixel, npixfp, self.npixsky)
+                point_matrix, pol_cos, pol_sin, waferts,
+                diff_weight, sum_weight, npix=npixfp, nt=nt,
+                wafermask_pixel=wafermask_pixel, nskypix=nskypix,
+                nthreads=self.nthreads, strategy=strategy)
         else:
-            tod_f.tod2map_pair_f(
-                output_maps.d, output_maps.w, output_maps.dc,
-                output_maps.ds, output_maps.cc, output_maps.cs,
+            ## Flat views of the maps of all skies (updated in place)
+            maps = [output_maps.d, output_maps.dc, output_maps.ds]
+            assert np.all([m.flags.c_contiguous for m in maps]), \
+                ValueError("Output maps must be C-contiguous!")
+            d, dc, ds = [m.reshape(-1) for m in maps]
+            tod2map_pair_f(
+                d, output_maps.w, dc,
+                ds, output_maps.cc, output_maps.cs,
                 output_maps.ss, output_maps.nhit,
-                point_matrix, pol_angs, waferts,
-                diff_weight, sum_weight, nt,
-                wafermask_pixel, npixfp, self.npixsky)
+                point_matrix, pol_cos, pol_sin, waferts,
+                diff_weight, sum_weight, npix=npixfp, nt=nt,
+                wafermask_pixel=wafermask_pixel, nskypix=nskypix,
+                nsky=nsky, sumdiff=int(sumdiff),
+                nthreads=self.nthreads, strategy=strategy)
         # Garbage collector guard
         wafermask_pixel
 
 
+    def get_pixel_order(self, point_matrix=None, wafermask_pixel=None,
+                        nrows=None):
+        """
+        Permutation of the samples of the current chunk (in the flat
+        pointing matrix) sorting them by sky pixel, such that projection
+        becomes contiguous segmented sums. Masked samples and samples
+        outside the patch are dropped.
+
+        The permutation does not depend on the sky realisation nor on the
+        mask. For the current pointing, it is identified by the time chunk
+        and the pairs of the rows (see get_order_key), kept on the instance
+        (pixel_order) until the pointing of a row changes, and stored next
+        to the pointing in the pointing cache if any (see PointingCache).
+
+        Parameters
+        ----------
+        point_matrix : 1d array of int, optional
+            Flat pointing matrix to sort (e.g. with split offsets).
+            Default is the pointing matrix of the current chunk.
+        wafermask_pixel : 1d array of int, optional
+            Flat mask of the samples of point_matrix.
+            Default is the mask of the current chunk.
+        nrows : int, optional
+            If point_matrix is None, number of rows (pairs) of the buffers
+            to sort. Default is None (group_size).
+
+        Returns
+        ----------
+        order : 1d array of int
+            Indices of the samples, sorted by pixel.
+        starts : 1d array of int
+            First position in order of each segment of identical pixels.
+        pixels : 1d array of int
+            The pixel of each segment.
+
+        Examples
+        ----------
+        >>> inst, scan, sky_in = load_fake_instrument()
+        >>> tod = TimeOrderedDataPairDiff(inst, scan, sky_in, CESnumber=0)
+        >>> d = tod.map2tod_block(range(2 * tod.npair))
+        >>> order, starts, pixels = tod.get_pixel_order()
+        >>> point_matrix = tod.point_matrix.reshape(-1)
+        >>> print(np.all(np.diff(point_matrix[order]) >= 0))
+        True
+        >>> print(np.all(point_matrix[order[starts]] == pixels))
+        True
+
+        The permutation is kept for the next sky realisation, and
+        dropped if the pointing changes
+        >>> key, permutation = tod.pixel_order
+        >>> d = tod.map2tod_block(range(2 * tod.npair))
+        >>> print(tod.pixel_order[1] is permutation)
+        True
+        >>> tod.xpos = tod.xpos + 1e-3
+        >>> d = tod.map2tod_block(range(2 * tod.npair))
+        >>> print(tod.pixel_order is None)
+        True
+        """
+        if nrows is None:
+            nrows = self.group_size
+        if point_matrix is None:
+            point_matrix = self.point_matrix[:nrows].reshape(-1)
+            order = self._get_pointing_order(nrows)
+        else:
+            order = sort_pixels(point_matrix)
+        if wafermask_pixel is None:
+            wafermask_pixel = self.wafermask_pixel[:nrows].reshape(-1)
+
+        order = order[wafermask_pixel[order] > 0]
+        sorted_pixels = point_matrix[order]
+        starts = np.flatnonzero(np.concatenate(
+            ([True], sorted_pixels[1:] != sorted_pixels[:-1])))
+        starts = starts[:len(order)]
+        pixels = sorted_pixels[starts]
+
+        return order, starts, pixels
+
+    def get_order_key(self, nrows=None):
+        """
+        Identifier of the pointing of the first nrows rows of the buffers
+        of the current chunk: time chunk and pairs of the rows.
+
+        Parameters
+        ----------
+        nrows : int, optional
+            Number of rows (pairs) of the buffers. Default is group_size.
+
+        Returns
+        ----------
+        key : string
+            The identifier.
+
+        Examples
+        ----------
+        >>> inst, scan, sky_in = load_fake_instrument()
+        >>> tod = TimeOrderedDataPairDiff(inst, scan, sky_in, CESnumber=0,
+        ...     mapping_group_size=2)
+        >>> d = tod.map2tod_block(range(4))
+        >>> key = tod.get_order_key()
+        >>> d = tod.map2tod_block(range(4, 8))
+        >>> print(tod.get_order_key() == key)
+        False
+        """
+        if nrows is None:
+            nrows = self.group_size
+        md5 = hashlib.md5(self.row_pairs[:nrows].tobytes())
+        return '{}_{}_{}'.format(
+            self.chunk_start, self.chunk_stop, md5.hexdigest())
+
+    def _get_pointing_order(self, nrows):
+        """
+        Permutation sorting by pixel the samples of the first nrows rows
+        of the current pointing matrix, without mask (see get_pixel_order).
+        Read from the instance or the pointing cache if already computed.
+        """
+        key = self.get_order_key(nrows)
+        if self.pixel_order is not None and self.pixel_order[0] == key:
+            return self.pixel_order[1]
+
+        order = None
+        pointing_cache = self.get_pointing_cache()
+        if pointing_cache is not None:
+            order = pointing_cache.load_order(key)
+        if order is None:
+            order = sort_pixels(self.point_matrix[:nrows].reshape(-1))
+            if pointing_cache is not None:
+                pointing_cache.save_order(key, order)
+
+        self.pixel_order = (key, order)
+        return order
+
+    def _tod2map_sorted(self, waferts, output_maps, npixfp, nt, sumdiff,
+                        point_matrix, wafermask_pixel):
+        """
+        Projection of the flat timestreams waferts in pixel order,
+        see get_pixel_order. Same accumulation as the tod2map kernels.
+        point_matrix and wafermask_pixel are None for the current pointing.
+        """
+        order, starts, pixels = self.get_pixel_order(
+            point_matrix, wafermask_pixel, nrows=npixfp)
+        if len(order) == 0:
+            return
+
+        ## Pixels are unique, also in the sparse maps
+        if output_maps.tile_size is not None:
+            pixels = output_maps.to_compact(pixels)
+
+        ## Pair and time sample of each sorted sample
+        j = order // nt
+        i = order % nt
+        c = self.pol_cos.reshape(-1)[order].astype(np.float64)
+        s = self.pol_sin.reshape(-1)[order].astype(np.float64)
+        sum_weight = self.sum_weight.reshape(-1)[j]
+        diff_weight = self.diff_weight.reshape(-1)[j]
+
+        def segsum(x):
+            return np.add.reduceat(x, starts)
+
+        output_maps.nhit[pixels] += np.diff(
+            np.append(starts, len(order))).astype(np.int32)
+
+        if hasattr(self, 'dm'):
+            ts = waferts.reshape((-1, 3, nt))
+            t0 = ts[j, 0, i].astype(np.float64)
+            t4r = ts[j, 1, i].astype(np.float64)
+            t4i = ts[j, 2, i].astype(np.float64)
+            output_maps.w0[pixels] += segsum(sum_weight)
+            output_maps.w4[pixels] += segsum(diff_weight)
+            output_maps.d0[pixels] += segsum(t0 * sum_weight)
+            output_maps.d4r[pixels] += segsum(
+                (c * t4r + s * t4i) * diff_weight)
+            output_maps.d4i[pixels] += segsum(
+                (s * t4r - c * t4i) * diff_weight)
+            return
+
+        output_maps.w[pixels] += segsum(sum_weight)
+        output_maps.cc[pixels] += segsum(c * c * diff_weight)
+        output_maps.cs[pixels] += segsum(c * s * diff_weight)
+        output_maps.ss[pixels] += segsum(s * s * diff_weight)
+
+        nsky = output_maps.nskies
+        ts = waferts.reshape((npixfp, 2, nsky, nt))
+        d, dc, ds = [np.reshape(m, (nsky, -1)) for m in
+                     [output_maps.d, output_maps.dc, output_maps.ds]]
+        for k in range(nsky):
+            top = ts[j, 0, k, i].astype(np.float64)
+            bottom = ts[j, 1, k, i].astype(np.float64)
+            if sumdiff:
+                tsum, tdiff = top, bottom
+            else:
+                tsum = 0.5 * (top + bottom)
+                tdiff = 0.5 * (top - bottom)
+            d[k][pixels] += segsum(tsum * sum_weight)
+            dc[k][pixels] += segsum(c * tdiff * diff_weight)
+            ds[k][pixels] += segsum(s * tdiff * diff_weight)
+
+
 class TimeOrderedDataDemod(TimeOrderedDataPairDiff):
     """ Class to """
     def __init__(self, hardware, scanning_strategy, HealpixFitsMap,
                  CESnumber, projection='healpix',
                  nside_out=None, pixel_size=None, width=140.,
-                 cut_pixels_outside=True,
+                 width_margin=0.5, cut_pixels_outside=True,
                  array_noise_level=None, array_noise_seed=487587,
-                 mapping_perpair=False, verbose=False):
+                 mapping_perpair=False, chunk_size=None, nthreads=1,
+                 pointing_cache_dir=None, compact_input=False,
+                 precision='double', tod2map_strategy='reduction',
+                 mapping_group_size=None, memory_budget=None,
+                 verbose=False):
         """
         C'est parti!
 
@@ -701,8 +2135,11 @@ class TimeOrderedDataDemod(TimeOrderedDataPairDiff):
         pixel_size : float, optional
             The pixel size for the output maps if projection=flat.
             In arcmin. Default is resolution of the input map.
-        width : float, optional
-            Width for the output map in degree.
+        width : float or list of 4 floats or 'auto', optional
+            Width for the output map in degree. See TimeOrderedDataPairDiff.
+        width_margin : float, optional
+            Margin in degree added on each side of the patch when
+            width='auto'. No effect otherwise. Default is 0.5 degree.
         array_noise_level : float, optional
             Noise level for the whole array in [u]K.sqrt(s). If not None, it
             will inject on-the-fly noise in time-domain while scanning
@@ -717,6 +2154,30 @@ class TimeOrderedDataDemod(TimeOrderedDataPairDiff):
             If True, assume that you want to process pairs of bolometers
             one-by-one, that is pairs are uncorrelated. Default is False (and
             should be False unless you know what you are doing).
+        chunk_size : None
+            Not available: the demodulation filters whole timestreams.
+        nthreads : int, optional
+            Number of threads used to scan the input map (map2tod_block)
+            and to project timestreams into maps (tod2map). Default is 1.
+        pointing_cache_dir : string, optional
+            Folder for the on-disk cache of detector pointing
+            (see PointingCache). Default is None.
+        compact_input : bool, optional
+            If True, keep in memory only the pixels of the input map
+            within the sky patch. See TimeOrderedDataPairDiff.
+            Default is False.
+        precision : string, optional
+            Precision of timestreams, among ['single', 'double'].
+            Default is 'double'.
+        tod2map_strategy : string, optional
+            Strategy of tod2map, among ['reduction', 'owner', 'sorted'].
+            See TimeOrderedDataPairDiff. Default is 'reduction'.
+        mapping_group_size : int or string, optional
+            Process pairs by groups. See TimeOrderedDataPairDiff.
+            Default is None.
+        memory_budget : float, optional
+            Memory in MB for the buffers of one group of pairs.
+            See TimeOrderedDataPairDiff. Default is None.
 
         Examples
         ----------
@@ -729,17 +2190,41 @@ class TimeOrderedDataDemod(TimeOrderedDataPairDiff):
         >>> m = OutputSkyMap(projection=tod.projection,
         ...     nside=tod.nside_out, obspix=tod.obspix, demodulation=True)
         >>> tod.tod2map(d, m)
+
+        Same timestreams with a compacted input map
+        >>> tod = TimeOrderedDataDemod(inst, scan, sky_in,
+        ...     CESnumber=0, mapping_perpair=True, width='auto')
+        >>> d = tod.map2tod(0)
+        >>> tod = TimeOrderedDataDemod(inst, scan, sky_in,
+        ...     CESnumber=0, mapping_perpair=True, width='auto',
+        ...     compact_input=True)
+        >>> print(sky_in.obspix is not None, np.all(tod.map2tod(0) == d))
+        True True
         """
+        assert chunk_size is None, \
+            ValueError("Demodulation filters whole timestreams: " +
+                       "chunk_size is not available!")
         TimeOrderedDataPairDiff.__init__(
             self, hardware, scanning_strategy, HealpixFitsMap,
             CESnumber, projection=projection,
             nside_out=nside_out, pixel_size=pixel_size, width=width,
+            width_margin=width_margin,
             cut_pixels_outside=cut_pixels_outside,
             array_noise_level=array_noise_level,
             array_noise_seed=array_noise_seed,
             mapping_perpair=mapping_perpair,
+            nthreads=nthreads,
+            pointing_cache_dir=pointing_cache_dir,
+            compact_input=compact_input,
+            precision=precision,
+            tod2map_strategy=tod2map_strategy,
+            mapping_group_size=mapping_group_size,
+            memory_budget=memory_budget,
             verbose=verbose)
 
+        assert self.HealpixFitsMap.nskies == 1, \
+            ValueError("Demodulation works with one input sky only!")
+
         ## Prepare the demodulation of timestreams
         self.dm = Demodulation(
             self.hardware.half_wave_plate.freq_hwp,
@@ -771,7 +2256,7 @@ class TimeOrderedDataDemod(TimeOrderedDataPairDiff):
         newts : array of size (ndet, 3, nbolometer)
         """
         outshape = (ts.shape[0], 3, ts.shape[1])
-        newts = np.zeros(outshape)
+        newts = np.zeros(outshape, dtype=self.dtype)
 
         self.dm.b = ts
         # dm.b.copy()
@@ -1098,10 +2583,363 @@ def convolvefilter(x, f, ff=None, isreal=False):
     return u[fftslice].reshape(init_shape)
 
 
+class PointingCache():
+    """ Class to handle the on-disk cache of detector pointing """
+    def __init__(self, path, key, nchannels, nsamples, index_dtype=np.int32):
+        """
+        Detector pointing (global and local pixel indices, parallactic
+        angles) does not depend on the sky or noise realisation.
+        It is stored in memory-mappable .npy files, one row per channel,
+        in the folder path/key. Samples are computed the first time they
+        are requested (e.g. chunk by chunk, see set_chunk), and read back
+        from disk afterwards.
+
+        Parameters
+        ----------
+        path : string
+            Folder containing the caches.
+        key : string
+            Hash of the instrument, scan and projection
+            (see TimeOrderedDataPairDiff.get_pointing_key).
+        nchannels : int
+            Number of channels in the focal plane.
+        nsamples : int
+            Number of time samples in the scan.
+        index_dtype : dtype, optional
+            Type of the global pixel indices. Default is int32.
+
+        Examples
+        ----------
+        >>> import tempfile, shutil
+        >>> path = tempfile.mkdtemp()
+        >>> inst, scan, sky_in = load_fake_instrument()
+        >>> tod = TimeOrderedDataPairDiff(inst, scan, sky_in, CESnumber=0,
+        ...     pointing_cache_dir=path)
+        >>> d = tod.map2tod_block(range(2 * tod.npair))
+        >>> print(np.all(tod.pointing_cache.done))
+        True
+
+        In chunk mode, only the current chunk is computed
+        >>> path_chunk = tempfile.mkdtemp()
+        >>> tod_chunk = TimeOrderedDataPairDiff(inst, scan, sky_in,
+        ...     CESnumber=0, pointing_cache_dir=path_chunk, chunk_size=10000)
+        >>> d_chunk = tod_chunk.map2tod_block(range(2 * tod.npair))
+        >>> print(np.sum(tod_chunk.pointing_cache.done[0]))
+        10000
+        >>> print(np.all(d_chunk == d[:, :10000]))
+        True
+        >>> shutil.rmtree(path_chunk)
+
+        Second run reads pointing from the disk
+        >>> tod2 = TimeOrderedDataPairDiff(inst, scan, sky_in, CESnumber=0,
+        ...     pointing_cache_dir=path)
+        >>> print(np.all(tod2.map2tod_block(range(2 * tod.npair)) == d))
+        True
+        >>> print(tod2.pointing is None)
+        True
+        >>> shutil.rmtree(path)
+        """
+        self.key = key
+        self.path = os.path.join(path, key)
+        try:
+            os.makedirs(self.path)
+        except OSError:
+            ## Already created (possibly by another process)
+            if not os.path.isdir(self.path):
+                raise
+
+        shape = (nchannels, nsamples)
+        self.index_global = self.open(
+            'index_global.npy', index_dtype, shape)
+        self.index_local = self.open('index_local.npy', np.int32, shape)
+        self.pa = self.open('pa.npy', np.float64, shape)
+
+        ## Samples already computed
+        self.done = self.open('done.npy', np.bool_, shape)
+
+    def open(self, fn, dtype, shape):
+        """
+        Open (or create) one of the memory-mapped files of the cache.
+        A new file is created under a temporary name, and linked to its
+        final name only if no other process created it meanwhile, such
+        that all processes share the same file.
+        """
+        fullpath = os.path.join(self.path, fn)
+        if not os.path.exists(fullpath):
+            tmp = '{}.{}.{}.tmp'.format(
+                fullpath, os.getpid(), threading.current_thread().ident)
+            arr = open_memmap(tmp, mode='w+', dtype=dtype, shape=shape)
+            del arr
+            try:
+                os.link(tmp, fullpath)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+            finally:
+                os.remove(tmp)
+
+        arr = open_memmap(fullpath, mode='r+')
+        assert arr.shape == shape and arr.dtype == dtype, \
+            ValueError("Pointing cache {} is corrupted!".format(fullpath))
+        return arr
+
+    def load(self, channels, start, stop, compute):
+        """
+        Return the pointing of a block of channels for time samples
+        [start, stop[. Channels with missing samples are computed for
+        [start, stop[ only, and written to disk.
+
+        Parameters
+        ----------
+        channels : 1d array of int
+            Channel indices in the focal plane.
+        start : int
+            First time sample.
+        stop : int
+            Last time sample (excluded).
+        compute : callable
+            compute(channels, start, stop) returns (index_global,
+            index_local, pa) for time samples [start, stop[.
+
+        Returns
+        ----------
+        index_global, index_local, pa : 2d arrays
+            See TimeOrderedDataPairDiff.get_detector_pointing.
+        """
+        channels = np.asarray(channels, dtype=int)
+        missing = channels[
+            ~np.all(self.done[channels, start:stop], axis=1)]
+        if len(missing) > 0:
+            index_global, index_local, pa = compute(missing, start, stop)
+            self.index_global[missing, start:stop] = index_global
+            self.index_local[missing, start:stop] = index_local
+            self.pa[missing, start:stop] = pa
+            for arr in [self.index_global, self.index_local, self.pa]:
+                arr.flush()
+
+            ## Only flag samples once their pointing is on disk
+            self.done[missing, start:stop] = True
+            self.done.flush()
+
+        return (self.index_global[channels, start:stop],
+                self.index_local[channels, start:stop],
+                self.pa[channels, start:stop])
+
+    def load_order(self, key):
+        """
+        Return the pixel permutation stored under key, or None if it
+        has not been computed yet. See save_order.
+
+        Parameters
+        ----------
+        key : string
+            Identifier of the time chunk and pairs
+            (see TimeOrderedDataPairDiff.get_order_key).
+
+        Returns
+        ----------
+        order : 1d array of int or None
+            The permutation.
+        """
+        fullpath = os.path.join(self.path, 'order_{}.npy'.format(key))
+        if not os.path.exists(fullpath):
+            return None
+        return np.load(fullpath)
+
+    def save_order(self, key, order):
+        """
+        Store the pixel permutation of the pointing identified by key
+        (see TimeOrderedDataPairDiff.get_pixel_order). The file is written
+        under a temporary name and renamed, such that concurrent processes
+        never read a partial file.
+
+        Parameters
+        ----------
+        key : string
+            Identifier of the time chunk and pairs
+            (see TimeOrderedDataPairDiff.get_order_key).
+        order : 1d array of int
+            The permutation.
+
+        Examples
+        ----------
+        >>> import tempfile, shutil
+        >>> path = tempfile.mkdtemp()
+        >>> inst, scan, sky_in = load_fake_instrument()
+        >>> tod = TimeOrderedDataPairDiff(inst, scan, sky_in, CESnumber=0,
+        ...     pointing_cache_dir=path)
+        >>> d = tod.map2tod_block(range(2 * tod.npair))
+        >>> order, starts, pixels = tod.get_pixel_order()
+
+        The permutation is read back by a new instance
+        >>> tod2 = TimeOrderedDataPairDiff(inst, scan, sky_in, CESnumber=0,
+        ...     pointing_cache_dir=path)
+        >>> d = tod2.map2tod_block(range(2 * tod.npair))
+        >>> key = tod2.get_order_key()
+        >>> print(np.all(tod2.pointing_cache.load_order(key) ==
+        ...     tod.pixel_order[1]))
+        True
+        >>> print(np.all(tod2.get_pixel_order()[0] == order))
+        True
+        >>> shutil.rmtree(path)
+        """
+        fullpath = os.path.join(self.path, 'order_{}.npy'.format(key))
+        tmp = '{}.{}.tmp'.format(fullpath, os.getpid())
+        with open(tmp, 'wb') as f:
+            np.save(f, order)
+        os.rename(tmp, fullpath)
+
+
+class TimestreamFlags():
+    """ Class to handle flags of timestreams as run-length encoded runs """
+    def __init__(self, nrows, nsamples):
+        """
+        Flags (turnarounds, glitches, cuts, ...) are stored for each row
+        (e.g. pair of detectors) as sorted, disjoint intervals of flagged
+        time samples [start, stop[, one list per flag name. Memory scales
+        with the number of flagged runs instead of the number of samples,
+        and masks are expanded only for the time chunk being processed.
+
+        Parameters
+        ----------
+        nrows : int
+            Number of rows (timestreams) flagged independently.
+        nsamples : int
+            Number of time samples per row.
+
+        Examples
+        ----------
+        >>> flags = TimestreamFlags(2, 10)
+        >>> flags.add('glitch', [[2, 4]], rows=1)
+        >>> flags.add_mask('cut', np.arange(10) >= 7)
+        >>> print(flags.get(1).tolist())
+        [[2, 4], [7, 10]]
+        >>> print(flags.expand(1, 0, 10))
+        [1 1 0 0 1 1 1 0 0 0]
+        >>> print(flags.expand(1, 0, 10, names=['glitch']))
+        [1 1 0 0 1 1 1 1 1 1]
+        >>> print(flags.nflagged(0), flags.all_flagged([0, 1], 7, 10))
+        3 True
+        """
+        self.nrows = nrows
+        self.nsamples = nsamples
+
+        ## Flagged intervals of each row, indexed by flag name
+        self.intervals = {}
+
+    def add(self, name, intervals, rows=None):
+        """
+        Flag intervals of time samples.
+
+        Parameters
+        ----------
+        name : string
+            Name of the flag (e.g. 'glitch').
+        intervals : 2d array of int
+            Flagged intervals [start, stop[ of size (nintervals, 2).
+        rows : int or list of int, optional
+            Rows to flag. Default is None (all rows).
+        """
+        if rows is None:
+            rows = range(self.nrows)
+        runs = np.clip(np.reshape(intervals, (-1, 2)), 0, self.nsamples)
+        flag = self.intervals.setdefault(
+            name, [np.zeros((0, 2), dtype=np.int64)] * self.nrows)
+        for row in np.atleast_1d(rows):
+            flag[row] = intervals_union(flag[row], runs)
+
+    def add_mask(self, name, mask, rows=None):
+        """
+        Flag time samples from a boolean mask of size nsamples
+        (True for flagged samples). See add.
+        """
+        self.add(name, mask_to_intervals(mask), rows=rows)
+
+    def get(self, row, names=None):
+        """
+        Return the flagged intervals of a row, merged over flag names.
+
+        Parameters
+        ----------
+        row : int
+            Index of the row.
+        names : list of string, optional
+            Flags to include. Default is None (all flags).
+
+        Returns
+        ----------
+        intervals : 2d array of int
+            Sorted, disjoint intervals [start, stop[ of size (n, 2).
+        """
+        if names is None:
+            names = self.intervals.keys()
+        runs = np.zeros((0, 2), dtype=np.int64)
+        for name in names:
+            runs = intervals_union(runs, self.intervals[name][row])
+        return runs
+
+    def expand(self, row, start, stop, out=None, names=None):
+        """
+        Expand the flags of a row into a mask for time samples
+        [start, stop[: 1 if the sample should be included, 0 otherwise.
+
+        Parameters
+        ----------
+        row : int
+            Index of the row.
+        start : int
+            First time sample.
+        stop : int
+            Last time sample (excluded).
+        out : 1d array, optional
+            Preallocated array of size stop - start. Default is None.
+        names : list of string, optional
+            Flags to include. Default is None (all flags).
+
+        Returns
+        ----------
+        out : 1d array of int32
+            The mask.
+        """
+        if out is None:
+            out = np.empty(stop - start, dtype=np.int32)
+        out[:] = 1
+        if not self.intervals:
+            return out
+        runs = np.clip(self.get(row, names) - start, 0, stop - start)
+        if len(runs) > 0:
+            ## Runs are disjoint: +1 at starts, -1 at stops
+            edges = np.zeros(stop - start + 1, dtype=np.int32)
+            edges[runs[:, 0]] += 1
+            edges[runs[:, 1]] -= 1
+            out[np.cumsum(edges[:-1]) > 0] = 0
+        return out
+
+    def nflagged(self, row, start=0, stop=None, names=None):
+        """
+        Number of flagged samples of a row within [start, stop[.
+        See expand for the parameters.
+        """
+        if stop is None:
+            stop = self.nsamples
+        runs = np.clip(self.get(row, names), start, stop)
+        return int(np.sum(runs[:, 1] - runs[:, 0]))
+
+    def all_flagged(self, rows, start, stop, names=None):
+        """
+        True if all time samples [start, stop[ of the rows are flagged.
+        See expand for the parameters.
+        """
+        if not self.intervals:
+            return False
+        return all([self.nflagged(row, start, stop, names) == stop - start
+                    for row in np.atleast_1d(rows)])
+
+
 class WhiteNoiseGenerator():
     """ Class to handle white noise """
     def __init__(self, array_noise_level, ndetectors, ntimesamples,
-                 array_noise_seed):
+                 array_noise_seed, precision='double', block_size=None):
         """
         This class is used to simulate time-domain noise.
         Usually, it is used in combination with map2tod to insert noise
@@ -1119,9 +2957,23 @@ class WhiteNoiseGenerator():
         array_noise_seed : int
             Seed used to generate random numbers. From this single seed,
             we generate a list of seeds for all detectors.
+        precision : string, optional
+            Precision of the noise timestreams among ['single', 'double'].
+            Random numbers are always drawn in double precision, so that
+            the noise realisation does not depend on the precision.
+        block_size : int, optional
+            If not None, timestreams are drawn by blocks of block_size
+            samples, each with its own random state (seeded by the detector
+            seed and the block index), such that any range of samples is
+            simulated without replaying the samples before it. The first
+            block uses the detector seed only, so timestreams differ from
+            the default ones after block_size samples.
+            Default is None: one random sequence per detector, and a range
+            of samples is obtained by drawing the sequence up to its end.
 
         """
         self.array_noise_level = array_noise_level
+        self.dtype = np.float32 if precision == 'single' else np.float64
         self.ndetectors = ndetectors
         self.ntimesamples = ntimesamples
 
@@ -1133,19 +2985,29 @@ class WhiteNoiseGenerator():
         state = np.random.RandomState(self.array_noise_seed)
         self.noise_seeds = state.randint(0, 1e6, size=self.ndetectors)
 
-    def simulate_noise_one_detector(self, ch):
+        self.block_size = block_size
+
+    def simulate_noise_one_detector(self, ch, start=None, stop=None):
         """
         Simulate noise on-the-fly for one detector.
 
+        If start and stop are provided, only time samples [start, stop[ are
+        returned, and chunks are identical to the full timestream.
+        Without block_size, the samples before start are drawn too.
+
         Parameters
         ----------
         ch : int
             Index of the detector in the array.
+        start : int, optional
+            First time sample of the chunk.
+        stop : int, optional
+            Last time sample (excluded) of the chunk.
 
         Returns
         ----------
         vec : 1d array
-            Vector of noise of size ntimesamples.
+            Vector of noise of size ntimesamples (or stop - start).
             The level of noise is given by detector_noise_level in uK.sqrt(s).
 
         Examples
@@ -1154,11 +3016,57 @@ class WhiteNoiseGenerator():
         >>> ts = wn.simulate_noise_one_detector(0)
         >>> print(ts) #doctest: +NORMALIZE_WHITESPACE
         [ -2185.65609023   5137.21044598  -5407.22292574  11020.59471471]
+
+        Same noise simulated by chunks
+        >>> ts1 = wn.simulate_noise_one_detector(0, start=0, stop=3)
+        >>> ts2 = wn.simulate_noise_one_detector(0, start=3, stop=4)
+        >>> print(np.all(np.concatenate((ts1, ts2)) == ts))
+        True
+
+        Chunks can be simulated in any order
+        >>> wn = WhiteNoiseGenerator(3000., 2, 10, array_noise_seed=493875,
+        ...     block_size=4)
+        >>> ts = wn.simulate_noise_one_detector(1)
+        >>> ts2 = wn.simulate_noise_one_detector(1, start=5, stop=10)
+        >>> ts1 = wn.simulate_noise_one_detector(1, start=0, stop=5)
+        >>> print(np.all(np.concatenate((ts1, ts2)) == ts))
+        True
+
+        Blocks change the realisation after the first block only
+        >>> ts_legacy = WhiteNoiseGenerator(
+        ...     3000., 2, 10, array_noise_seed=493875
+        ...     ).simulate_noise_one_detector(1)
+        >>> print(np.all(ts_legacy[:4] == ts[:4]), np.all(ts_legacy == ts))
+        True False
         """
-        state = np.random.RandomState(self.noise_seeds[ch])
-        vec = state.normal(size=self.ntimesamples)
+        if start is None:
+            start = 0
+        if stop is None:
+            stop = self.ntimesamples
+
+        if self.block_size is None:
+            state = np.random.RandomState(self.noise_seeds[ch])
+            vec = state.normal(size=stop)[start:]
+            return (self.detector_noise_level * vec).astype(
+                self.dtype, copy=False)
+
+        vec = np.empty(stop - start)
+        for block in range(start // self.block_size,
+                           (stop - 1) // self.block_size + 1):
+            first = block * self.block_size
+            if block == 0:
+                state = np.random.RandomState(self.noise_seeds[ch])
+            else:
+                state = np.random.RandomState([self.noise_seeds[ch], block])
+
+            ## Draw the block up to the end of the chunk only
+            lo = max(start, first)
+            hi = min(stop, first + self.block_size)
+            vec[lo - start:hi - start] = state.normal(size=hi - first)[
+                lo - first:]
 
-        return self.detector_noise_level * vec
+        return (self.detector_noise_level * vec).astype(
+            self.dtype, copy=False)
 
 
 def psdts(ts, sample_rate, NFFT=4096):
@@ -1279,7 +3187,8 @@ class OutputSkyMap():
     """ Class to handle sky maps generated by tod2map """
     def __init__(self, projection,
                  obspix=None, npixsky=None,
-                 nside=None, pixel_size=None, demodulation=False):
+                 nside=None, pixel_size=None, demodulation=False,
+                 nskies=1, tile_size=None, nsplits=1):
         """
         Initialise all maps: weights, projected TOD, and Stokes parameters.
 
@@ -1299,6 +3208,44 @@ class OutputSkyMap():
         pixel_size : float, optional
             The size of pixels in arcmin if projection=flat. No effect
             if projection=healpix.
+        demodulation : bool, optional
+            If True, maps are built from demodulated timestreams.
+        nskies : int, optional
+            Number of input skies projected in one pass (pair difference
+            only). If larger than 1, d, dc and ds (and the solved I, Q, U)
+            have size (nskies, npixsky), and weights are shared.
+        tile_size : int, optional
+            If not None, the patch is split in tiles of tile_size
+            consecutive pixels, and only tiles which have been hit are
+            allocated (sparse maps). obspix and npixsky then describe the
+            allocated pixels only (see allocate_tiles and sort_tiles).
+            Default is None (dense maps of the whole patch).
+        nsplits : int, optional
+            Number of split maps (e.g. scan directions, detector halves)
+            accumulated in one pass, see TimeOrderedDataPairDiff.tod2map.
+            Maps of the splits are stacked along the pixel axis (size
+            nsplits * npixsky). See get_split and coadd_splits.
+            Not available with tile_size. Default is 1.
+
+        Examples
+        ----------
+        Sparse maps only allocate the tiles which have been hit
+        >>> inst, scan, sky_in = load_fake_instrument()
+        >>> tod = TimeOrderedDataPairDiff(inst, scan, sky_in, CESnumber=0)
+        >>> m = OutputSkyMap(projection=tod.projection,
+        ...     nside=tod.nside_out, obspix=tod.obspix, tile_size=16)
+        >>> tod.tod2map(tod.map2tod_block(range(2 * tod.npair)), m)
+        >>> print(m.npixsky < tod.npixsky, len(m.obspix) == m.npixsky)
+        True True
+
+        Same maps as the dense ones on the allocated pixels
+        >>> m_dense = OutputSkyMap(projection=tod.projection,
+        ...     nside=tod.nside_out, obspix=tod.obspix)
+        >>> tod.tod2map(tod.map2tod_block(range(2 * tod.npair)), m_dense)
+        >>> print(np.all(m.get_I() == m_dense.get_I()[m.local_pixels]))
+        True
+        >>> print(np.sum(m.nhit) == np.sum(m_dense.nhit))
+        True
         """
         self.nside = nside
         self.projection = projection
@@ -1307,6 +3254,13 @@ class OutputSkyMap():
         self.nside = nside
         self.pixel_size = pixel_size
         self.demodulation = demodulation
+        self.nskies = nskies
+        self.tile_size = tile_size
+        self.nsplits = nsplits
+        assert self.nsplits == 1 or self.tile_size is None, \
+            ValueError("Split maps are not available with tiles!")
+        assert self.nskies == 1 or not self.demodulation, \
+            ValueError("Demodulation works with one input sky only!")
 
         if self.projection == 'healpix':
             assert self.obspix is not None, \
@@ -1326,6 +3280,19 @@ class OutputSkyMap():
                 ValueError("You need to provide the size of " +
                            "pixels (pixel_size) in arcmin if projection=flat.")
 
+        ## Sparse layout: no tile allocated yet
+        if self.tile_size is not None:
+            self.patch_obspix = self.obspix
+            self.patch_npixsky = self.npixsky
+            ntiles = (self.patch_npixsky + self.tile_size - 1) // \
+                self.tile_size
+            self.tile_slot = np.full(ntiles, -1, dtype=np.int64)
+            self.tiles = np.array([], dtype=np.int64)
+            self.local_pixels = np.array([], dtype=np.int64)
+            self.npixsky = 0
+            if self.projection == 'healpix':
+                self.obspix = self.patch_obspix[self.local_pixels]
+
         self.initialise_sky_maps()
 
         if not self.demodulation:
@@ -1333,6 +3300,200 @@ class OutputSkyMap():
         else:
             self.to_coadd = 'd0 d4r d4i w0 w4 nhit'
 
+    def allocate_tiles(self, tiles):
+        """
+        Allocate tiles of a sparse map (see tile_size). New tiles take the
+        next free slots (slot s holds the pixels [s * tile_size,
+        (s + 1) * tile_size[ of the maps), in the order they are hit.
+        The maps grow geometrically when all slots are taken, so data
+        already accumulated is only copied O(log(ntiles)) times.
+        Free pixels of the maps have local_pixels (and obspix) -1, and
+        tiles are sorted only at readout (see sort_tiles).
+
+        Parameters
+        ----------
+        tiles : 1d array of int
+            Indices of the tiles (tile t contains the pixels
+            [t * tile_size, (t + 1) * tile_size[ of the patch).
+
+        Examples
+        ----------
+        >>> m = OutputSkyMap(projection='healpix', nside=16,
+        ...     obspix=np.arange(10), tile_size=4)
+        >>> m.allocate_tiles([2])
+        >>> m.nhit[:] = 1
+        >>> m.allocate_tiles([0])
+        >>> print(m.obspix, m.nhit)
+        [ 8  9 -1 -1  0  1  2  3] [1 1 0 0 0 0 0 0]
+        >>> m.sort_tiles()
+        >>> print(m.obspix, m.nhit)
+        [0 1 2 3 8 9] [0 0 0 0 1 1]
+        """
+        tiles = np.unique(np.asarray(tiles, dtype=np.int64))
+        new = tiles[self.tile_slot[tiles] < 0]
+        if len(new) == 0:
+            return
+
+        slots = len(self.tiles) + np.arange(len(new))
+        self.tiles = np.append(self.tiles, new)
+        self.tile_slot[new] = slots
+
+        ## Only the last tile of the patch can be incomplete
+        needed = slots[-1] * self.tile_size + self.tile_npix(new[-1])
+        if needed > self.npixsky:
+            capacity = min(max(needed, 2 * self.npixsky),
+                           len(self.tile_slot) * self.tile_size)
+            for k in self.to_coadd.split(' '):
+                old = getattr(self, k)
+                new_map = np.zeros(
+                    np.shape(old)[:-1] + (capacity,), dtype=old.dtype)
+                new_map[..., :self.npixsky] = old
+                setattr(self, k, new_map)
+            free = -np.ones(capacity - self.npixsky, dtype=np.int64)
+            self.local_pixels = np.append(self.local_pixels, free)
+            if self.projection == 'healpix':
+                self.obspix = np.append(self.obspix, free)
+            self.npixsky = capacity
+
+        index, pixels = self.tile_positions(new)
+        self.local_pixels[index] = pixels
+        if self.projection == 'healpix':
+            self.obspix[index] = self.patch_obspix[pixels]
+
+    def sort_tiles(self):
+        """
+        Reorder the allocated tiles of sparse maps by increasing index,
+        and drop the free pixels, such that allocated pixels
+        (local_pixels, obspix) are sorted. This is done before reading
+        out the maps (get_I, get_QU, coadd_MPI, distribute_MPI,
+        save_checkpoint, pickle_me, save_me). No effect on dense maps.
+
+        Examples
+        ----------
+        >>> m = OutputSkyMap(projection='flat', npixsky=10,
+        ...     pixel_size=2., tile_size=4)
+        >>> m.allocate_tiles([1])
+        >>> m.allocate_tiles([0])
+        >>> m.nhit[:] = np.arange(8)
+        >>> m.sort_tiles()
+        >>> print(m.local_pixels, m.nhit)
+        [0 1 2 3 4 5 6 7] [4 5 6 7 0 1 2 3]
+        """
+        if self.tile_size is None:
+            return
+        tiles = np.sort(self.tiles)
+        index, pixels = self.tile_positions(tiles)
+        if np.array_equal(tiles, self.tiles) and len(index) == self.npixsky:
+            return
+
+        for k in self.to_coadd.split(' '):
+            setattr(self, k, getattr(self, k)[..., index])
+        self.tiles = tiles
+        self.tile_slot[tiles] = np.arange(len(tiles))
+        self.local_pixels = pixels
+        self.npixsky = len(pixels)
+        if self.projection == 'healpix':
+            self.obspix = self.patch_obspix[pixels]
+
+    def tile_positions(self, tiles):
+        """
+        Positions in the sparse maps of the pixels of allocated tiles,
+        and the corresponding pixel indices in the patch.
+        """
+        tiles = np.asarray(tiles, dtype=np.int64)
+        npix = self.tile_npix(tiles)
+        offset = np.arange(np.sum(npix)) - np.repeat(
+            np.cumsum(npix) - npix, npix)
+        index = np.repeat(self.tile_slot[tiles] * self.tile_size, npix) + \
+            offset
+        pixels = np.repeat(tiles * self.tile_size, npix) + offset
+        return index, pixels
+
+    def get_split(self, k):
+        """
+        Return the maps of one split as a new OutputSkyMap instance.
+
+        Parameters
+        ----------
+        k : int
+            Label of the split, between 0 and nsplits - 1.
+
+        Examples
+        ----------
+        >>> m = OutputSkyMap(projection='healpix', nside=16,
+        ...     obspix=np.array([0, 1, 2]), nsplits=2)
+        >>> m.nhit[:] = [1, 2, 3, 4, 5, 6]
+        >>> print(m.get_split(1).nhit)
+        [4 5 6]
+        """
+        other = OutputSkyMap(
+            self.projection, obspix=self.obspix, npixsky=self.npixsky,
+            nside=self.nside, pixel_size=self.pixel_size,
+            demodulation=self.demodulation, nskies=self.nskies)
+        for name in self.to_coadd.split(' '):
+            arr = getattr(self, name)
+            setattr(other, name,
+                    arr[..., k * self.npixsky:(k + 1) * self.npixsky].copy())
+        return other
+
+    def coadd_splits(self):
+        """
+        Return the sum of all split maps, that is the maps one would get
+        without splits, as a new OutputSkyMap instance.
+
+        Examples
+        ----------
+        >>> m = OutputSkyMap(projection='healpix', nside=16,
+        ...     obspix=np.array([0, 1, 2]), nsplits=2)
+        >>> m.nhit[:] = [1, 2, 3, 4, 5, 6]
+        >>> print(m.coadd_splits().nhit)
+        [5 7 9]
+        """
+        other = self.get_split(0)
+        for k in range(1, self.nsplits):
+            other.coadd(self.get_split(k))
+        return other
+
+    def to_compact(self, local):
+        """
+        Convert pixel indices in the patch to indices in the sparse maps,
+        allocating the tiles which are hit for the first time.
+
+        Parameters
+        ----------
+        local : 1d array of int
+            Pixel indices in the patch (-1 for no pixel).
+
+        Returns
+        ----------
+        compact : 1d array of int32
+            Pixel indices in the sparse maps (-1 for no pixel).
+        """
+        local = np.asarray(local)
+        seen = local >= 0
+        tiles = local[seen] // self.tile_size
+        hit = np.zeros(len(self.tile_slot), dtype=bool)
+        hit[tiles] = True
+        self.allocate_tiles(np.flatnonzero(hit))
+
+        compact = np.full(local.shape, -1, dtype=np.int32)
+        compact[seen] = self.tile_slot[tiles] * self.tile_size + \
+            local[seen] % self.tile_size
+        return compact
+
+    def to_patch(self, sparse_map, fill_with=0.0):
+        """
+        Expand a map defined on the allocated pixels of sparse maps
+        to the whole patch.
+        """
+        patch_map = np.full(
+            np.shape(sparse_map)[:-1] + (self.patch_npixsky,), fill_with,
+            dtype=np.asarray(sparse_map).dtype)
+        allocated = self.local_pixels >= 0
+        patch_map[..., self.local_pixels[allocated]] = \
+            np.asarray(sparse_map)[..., allocated]
+        return patch_map
+
     def initialise_sky_maps(self):
         """
         Create empty sky maps. This includes:
@@ -1354,18 +3515,23 @@ class OutputSkyMap():
         if self.demodulation:
             self.initialise_sky_maps_demod()
         else:
-            # To accumulate A^T N^-1 d
-            self.d = np.zeros(self.npixsky)
-            self.dc = np.zeros(self.npixsky)
-            self.ds = np.zeros(self.npixsky)
+            # To accumulate A^T N^-1 d (one per input sky)
+            npix = self.npixsky * self.nsplits
+            if self.nskies == 1:
+                shape = npix
+            else:
+                shape = (self.nskies, npix)
+            self.d = np.zeros(shape)
+            self.dc = np.zeros(shape)
+            self.ds = np.zeros(shape)
 
             # To accumulate A^T N^-1 A
-            self.w = np.zeros(self.npixsky)
-            self.cc = np.zeros(self.npixsky)
-            self.cs = np.zeros(self.npixsky)
-            self.ss = np.zeros(self.npixsky)
+            self.w = np.zeros(npix)
+            self.cc = np.zeros(npix)
+            self.cs = np.zeros(npix)
+            self.ss = np.zeros(npix)
 
-            self.nhit = np.zeros(self.npixsky, dtype=np.int32)
+            self.nhit = np.zeros(npix, dtype=np.int32)
 
     def get_I(self):
         """
@@ -1379,12 +3545,13 @@ class OutputSkyMap():
             Intensity map. Note that only the observed pixels defined in
             obspix are returned (and not the full sky map).
         """
+        self.sort_tiles()
         if self.demodulation:
             return self.get_I_demod()
 
         hit = self.w > 0
         I = np.zeros_like(self.d)
-        I[hit] = self.d[hit]/self.w[hit]
+        I[..., hit] = self.d[..., hit]/self.w[hit]
         return I
 
     def get_QU(self):
@@ -1407,6 +3574,7 @@ class OutputSkyMap():
             Stokes U map. Note that only the observed pixels defined in
             obspix are returned (and not the full sky map).
         """
+        self.sort_tiles()
         if self.demodulation:
             return self.get_QU_demod()
 
@@ -1523,22 +3691,53 @@ class OutputSkyMap():
         >>> m1.coadd(m2)
         >>> print(m1.nhit)
         [ 2.  2.  2.  2.]
-        """
-        assert np.all(self.obspix == other.obspix), \
-            ValueError("To add maps together, they must have the same obspix!")
 
+        Sparse maps merge their tiles.
+        >>> m1 = OutputSkyMap(projection='healpix',
+        ...     nside=16, obspix=np.arange(8), tile_size=2)
+        >>> m1.allocate_tiles([0])
+        >>> m1.nhit[:] = 1
+        >>> m2 = OutputSkyMap(projection='healpix',
+        ...     nside=16, obspix=np.arange(8), tile_size=2)
+        >>> m2.allocate_tiles([0, 3])
+        >>> m2.nhit[:] = 1
+        >>> m1.coadd(m2)
+        >>> m1.sort_tiles()
+        >>> print(m1.obspix, m1.nhit)
+        [0 1 6 7] [2 2 1 1]
+        """
         if to_coadd is None:
             to_coadd = self.to_coadd
 
+        if self.tile_size is not None:
+            assert other.tile_size == self.tile_size and \
+                self.patch_npixsky == other.patch_npixsky, \
+                ValueError("To add sparse maps together, they must have " +
+                           "the same patch and tile_size!")
+            self.allocate_tiles(other.tiles)
+            allocated = other.local_pixels >= 0
+            pixels = other.local_pixels[allocated]
+            index = self.tile_slot[pixels // self.tile_size] * \
+                self.tile_size + pixels % self.tile_size
+            for k in to_coadd.split(' '):
+                a = getattr(self, k)
+                a[..., index] += getattr(other, k)[..., allocated]
+            return
+
+        assert np.all(self.obspix == other.obspix), \
+            ValueError("To add maps together, they must have the same obspix!")
+
         to_coadd_split = to_coadd.split(' ')
         for k in to_coadd_split:
             a = getattr(self, k)
             b = getattr(other, k)
             a += b
 
-    def coadd_MPI(self, other, MPI, to_coadd=None):
+    def coadd_MPI(self, other, MPI, to_coadd=None, comm=None, root=None):
         """
-        Crappy way of coadding vectors through different processors.
+        Coadd vectors through different processors.
+        All vectors are packed into a single contiguous buffer, summed
+        in place with one buffer-based reduction, and unpacked into self.
 
         Parameters
         ----------
@@ -1550,6 +3749,12 @@ class OutputSkyMap():
         to_coadd : string, optional
             String with names of vectors to coadd separated by a space.
             Names must be attributes of other and self.
+        comm : communicator, optional
+            Communicator of the processors. Default is MPI.COMM_WORLD.
+        root : int, optional
+            If not None, coadd on the processor root only (Reduce), and
+            leave self unchanged on other processors. Default is None,
+            that is all processors get the coadded vectors (Allreduce).
 
         Examples
         ---------
@@ -1558,15 +3763,275 @@ class OutputSkyMap():
         >>> m = OutputSkyMap(projection='healpix',
         ...     nside=16, obspix=np.array([0, 1, 2, 3]))
         >>> ## do whatever you want with the maps
+        >>> m.nhit += 2
         >>> m.coadd_MPI(m, MPI)
+        >>> print(m.nhit, m.nhit.dtype)
+        [2 2 2 2] int32
+
+        Coadd on the first processor only
+        >>> m.coadd_MPI(m, MPI, root=0)
+        >>> print(m.nhit)
+        [2 2 2 2]
         """
         if to_coadd is None:
             to_coadd = self.to_coadd
+        if comm is None:
+            comm = MPI.COMM_WORLD
+
+        ## Sparse maps: allocate the tiles hit by any processor
+        if self.tile_size is not None:
+            hit = np.zeros(len(other.tile_slot), dtype=np.int32)
+            hit[other.tiles] = 1
+            comm.Allreduce(MPI.IN_PLACE, hit, op=MPI.SUM)
+            tiles = np.flatnonzero(hit)
+            other.allocate_tiles(tiles)
+            self.allocate_tiles(tiles)
+            other.sort_tiles()
+            self.sort_tiles()
+
+        ## Pack all vectors in one buffer (hit counts are exact in float64)
+        arrays = [np.asarray(getattr(other, k)) for k in to_coadd.split(' ')]
+        bounds = np.cumsum([0] + [arr.size for arr in arrays])
+        buf = np.empty(bounds[-1], dtype=np.float64)
+        for arr, start, stop in zip(arrays, bounds[:-1], bounds[1:]):
+            buf[start:stop] = arr.ravel()
+
+        if root is None:
+            comm.Allreduce(MPI.IN_PLACE, buf, op=MPI.SUM)
+        elif comm.Get_rank() == root:
+            comm.Reduce(MPI.IN_PLACE, buf, op=MPI.SUM, root=root)
+        else:
+            comm.Reduce(buf, None, op=MPI.SUM, root=root)
+            return
 
-        to_coadd_split = to_coadd.split(' ')
-        for k in to_coadd_split:
-            setattr(self, k, MPI.COMM_WORLD.allreduce(
-                getattr(other, k), op=MPI.SUM))
+        for k, arr, start, stop in zip(
+                to_coadd.split(' '), arrays, bounds[:-1], bounds[1:]):
+            setattr(self, k, buf[start:stop].reshape(arr.shape).astype(
+                arr.dtype, copy=False))
+
+    def get_tile_owners(self, size, hit=None):
+        """
+        Processors owning the tiles of sparse maps in distributed mode
+        (see distribute_MPI): the patch is split in size contiguous
+        ranges of tiles, one per processor, with the same number of
+        hit tiles.
+
+        Parameters
+        ----------
+        size : int
+            Number of processors.
+        hit : 1d array of bool, optional
+            Tiles hit by any processor. Default is None (all tiles).
+
+        Returns
+        ----------
+        owners : 1d array of int
+            Rank of the owner of each tile of the patch.
+
+        Examples
+        ----------
+        >>> m = OutputSkyMap(projection='healpix', nside=16,
+        ...     obspix=np.arange(10), tile_size=2)
+        >>> print(m.get_tile_owners(2))
+        [0 0 0 1 1]
+        >>> print(m.get_tile_owners(2, hit=np.array([1, 0, 0, 1, 1])))
+        [0 0 0 0 1]
+        """
+        if hit is None:
+            hit = np.ones(len(self.tile_slot), dtype=bool)
+        position = np.maximum(np.cumsum(hit > 0) - 1, 0)
+        return position * size // max(np.sum(hit > 0), 1)
+
+    def distribute_MPI(self, MPI, comm=None):
+        """
+        Distributed coaddition of sparse maps (see tile_size): each
+        processor sends the tiles it has accumulated to their owners
+        (see get_tile_owners) with all-to-all exchanges, and keeps
+        only the tiles it owns, summed over all processors.
+        Maps are modified in place. No processor holds the whole patch:
+        get_IQU, pickle_me, etc. then run in parallel over owned pixels.
+
+        Parameters
+        ----------
+        MPI : module
+            Module for communication (mpi4py).
+        comm : communicator, optional
+            Communicator of the processors. Default is MPI.COMM_WORLD.
+
+        Examples
+        ----------
+        >>> from mpi4py import MPI
+        >>> m = OutputSkyMap(projection='healpix', nside=16,
+        ...     obspix=np.arange(10), tile_size=2)
+        >>> m.allocate_tiles([1, 4])
+        >>> m.nhit[:] = 1
+        >>> m.distribute_MPI(MPI)
+        >>> print(m.obspix, m.nhit)
+        [2 3 8 9] [1 1 1 1]
+        """
+        assert self.tile_size is not None, \
+            ValueError("Distributed maps need sparse maps (tile_size)!")
+        if comm is None:
+            comm = MPI.COMM_WORLD
+        size = comm.Get_size()
+        names = self.to_coadd.split(' ')
+        self.sort_tiles()
+
+        ## Values of each allocated pixel, one row per pixel.
+        ## Tiles are sorted and owners are contiguous ranges of tiles,
+        ## so that rows sent to each processor are contiguous.
+        arrays = [getattr(self, k) for k in names]
+        shapes = [np.shape(arr)[:-1] for arr in arrays]
+        columns = [int(np.prod(shape)) for shape in shapes]
+        send = np.empty((self.npixsky, sum(columns)), dtype=np.float64)
+        start = 0
+        for arr, ncol in zip(arrays, columns):
+            send[:, start:start + ncol] = np.reshape(arr, (ncol, -1)).T
+            start += ncol
+
+        ## Owners balance the tiles hit by any processor
+        hit = np.zeros(len(self.tile_slot), dtype=np.int32)
+        hit[self.tiles] = 1
+        comm.Allreduce(MPI.IN_PLACE, hit, op=MPI.SUM)
+        owners = self.get_tile_owners(size, hit)[self.tiles]
+        tile_counts = np.bincount(owners, minlength=size).astype(np.int64)
+        pixel_counts = np.bincount(
+            owners, weights=self.tile_npix(self.tiles),
+            minlength=size).astype(np.int64)
+
+        ## Number of tiles and pixels received from each processor
+        recv_tile_counts = np.empty(size, dtype=np.int64)
+        recv_pixel_counts = np.empty(size, dtype=np.int64)
+        comm.Alltoall(tile_counts, recv_tile_counts)
+        comm.Alltoall(pixel_counts, recv_pixel_counts)
+
+        def displacements(counts):
+            return np.concatenate(([0], np.cumsum(counts)[:-1]))
+
+        recv_tiles = np.empty(np.sum(recv_tile_counts), dtype=np.int64)
+        comm.Alltoallv(
+            [self.tiles, (tile_counts, displacements(tile_counts)),
+             MPI.INT64_T],
+            [recv_tiles, (recv_tile_counts,
+                          displacements(recv_tile_counts)), MPI.INT64_T])
+
+        nval = send.shape[1]
+        recv = np.empty((np.sum(recv_pixel_counts), nval), dtype=np.float64)
+        comm.Alltoallv(
+            [send, (pixel_counts * nval, displacements(pixel_counts) * nval),
+             MPI.DOUBLE],
+            [recv, (recv_pixel_counts * nval,
+                    displacements(recv_pixel_counts) * nval), MPI.DOUBLE])
+        del send
+
+        ## Keep only the owned tiles, and sum contributions
+        self.tile_slot[:] = -1
+        self.tiles = np.array([], dtype=np.int64)
+        self.local_pixels = np.array([], dtype=np.int64)
+        self.npixsky = 0
+        if self.projection == 'healpix':
+            self.obspix = self.patch_obspix[self.local_pixels]
+        for k, arr, shape in zip(names, arrays, shapes):
+            setattr(self, k, np.zeros(shape + (0,), dtype=arr.dtype))
+        del arrays
+        self.allocate_tiles(np.unique(recv_tiles))
+
+        ## Position of the received rows in the owned tiles
+        index, _ = self.tile_positions(recv_tiles)
+
+        start = 0
+        for k, ncol in zip(names, columns):
+            arr = getattr(self, k)
+            flat = np.reshape(arr, (ncol, -1))
+            for col in range(ncol):
+                flat[col] += np.bincount(
+                    index, weights=recv[:, start + col],
+                    minlength=self.npixsky).astype(arr.dtype)
+            start += ncol
+
+    def save_checkpoint(self, fn, ces_done):
+        """
+        Save the accumulators on disk, together with the list of scans
+        already projected, to resume an interrupted run (see
+        load_checkpoint). Only pixels with non-zero values are stored,
+        in a compressed npz file. The file is written under a temporary
+        name and renamed, so that a crash never leaves a partial
+        checkpoint.
+
+        Parameters
+        ----------
+        fn : string
+            Name of the checkpoint file.
+        ces_done : list of int
+            Indices of the scans (CES) accumulated in the maps.
+
+        Examples
+        ----------
+        >>> import tempfile, shutil
+        >>> path = tempfile.mkdtemp()
+        >>> fn = os.path.join(path, 'checkpoint.npz')
+        >>> inst, scan, sky_in = load_fake_instrument()
+        >>> maps = []
+        >>> for CESnumber in range(2):
+        ...     tod = TimeOrderedDataPairDiff(inst, scan, sky_in,
+        ...         CESnumber=CESnumber, width='auto')
+        ...     if CESnumber == 0:
+        ...         m = OutputSkyMap(projection=tod.projection,
+        ...             nside=tod.nside_out, obspix=tod.obspix)
+        ...     tod.tod2map(tod.map2tod_block(range(2 * tod.npair)), m)
+        ...     if CESnumber == 0:
+        ...         m.save_checkpoint(fn, [CESnumber])
+
+        Resume after the first scan: identical maps
+        >>> m2, ces_done = load_checkpoint(fn)
+        >>> print(ces_done)
+        [0]
+        >>> tod.tod2map(tod.map2tod_block(range(2 * tod.npair)), m2)
+        >>> print(np.all([np.array_equal(getattr(m, k), getattr(m2, k))
+        ...     for k in m.to_coadd.split(' ')]))
+        True
+        >>> shutil.rmtree(path)
+        """
+        self.sort_tiles()
+        names = self.to_coadd.split(' ')
+        npix = self.npixsky * self.nsplits
+        nonzero = np.zeros(npix, dtype=bool)
+        for k in names:
+            nonzero |= np.any(
+                np.reshape(getattr(self, k) != 0, (-1, npix)), axis=0)
+        pixels = np.flatnonzero(nonzero)
+
+        data = dict([(k, getattr(self, k)[..., pixels]) for k in names])
+        data['pixels'] = pixels
+        data['ces_done'] = np.asarray(ces_done, dtype=np.int64)
+
+        ## Arguments to rebuild the maps. Sparse maps store their tiles.
+        if self.tile_size is not None:
+            npixsky, obspix = self.patch_npixsky, self.patch_obspix
+            data['tiles'] = self.tiles
+        else:
+            npixsky, obspix = self.npixsky, self.obspix
+        if obspix is not None:
+            data['obspix'] = obspix
+        data['header'] = np.array(json.dumps({
+            'projection': self.projection, 'npixsky': int(npixsky),
+            'nside': self.nside, 'pixel_size': self.pixel_size,
+            'demodulation': self.demodulation, 'nskies': self.nskies,
+            'tile_size': self.tile_size, 'nsplits': self.nsplits}))
+
+        tmp = fn + '.tmp'
+        with open(tmp, 'wb') as f:
+            np.savez_compressed(f, **data)
+        os.rename(tmp, fn)
+
+    def tile_npix(self, tiles):
+        """
+        Number of pixels of tiles of the patch (only the last tile
+        of the patch can be incomplete).
+        """
+        tiles = np.asarray(tiles, dtype=np.int64)
+        return np.minimum(
+            self.tile_size, self.patch_npixsky - tiles * self.tile_size)
 
     def pickle_me(self, fn, shrink_maps=True, crop_maps=False,
                   epsilon=0., verbose=False):
@@ -1588,6 +4053,9 @@ class OutputSkyMap():
             0 <= epsilon < 1/4. The higher the more selective.
 
         """
+        assert self.nsplits == 1, \
+            ValueError("Save the splits one by one (see get_split)!")
+        self.sort_tiles()
         if self.demodulation:
             self.pickle_me_demod(
                 fn, shrink_maps=shrink_maps, crop_maps=crop_maps,
@@ -1603,6 +4071,11 @@ class OutputSkyMap():
                     'nside': self.nside, 'pixel_size': self.pixel_size,
                     'obspix': self.obspix}
 
+            ## Flat sky outputs are square patches
+            if self.tile_size is not None and self.projection == 'flat':
+                for k in ['I', 'Q', 'U', 'wI', 'wP', 'nhit']:
+                    data[k] = self.to_patch(data[k])
+
             if shrink_maps and self.projection == 'flat':
                 data = shrink_me(data, based_on='wP')
             elif crop_maps is not False and self.projection == 'flat':
@@ -1611,6 +4084,115 @@ class OutputSkyMap():
             with open(fn, 'wb') as f:
                 pickle.dump(data, f, protocol=2)
 
+    def save_me(self, fn, compress=True, precision='double',
+                chunk_size=2**20, epsilon=0., verbose=False):
+        """
+        Save the solved maps (I, Q, U), the weights (wI, wP) and hit
+        counts of the observed pixels (nhit > 0) into a zip container of
+        .npy chunks, read back lazily with PartialSkyMap. Unlike pickle_me,
+        only observed pixels are stored, together with their index obspix
+        (healpix index, or index in the patch for flat projection), and
+        maps can be read by ranges of pixels.
+
+        Parameters
+        ----------
+        fn: string
+            The name of the file where data will be stored.
+        compress : bool, optional
+            If True, chunks are compressed (deflate). Otherwise they are
+            stored as is, and memory-mapped when read. Default is True.
+        precision : string, optional
+            Precision of the stored maps and weights among
+            ['single', 'double']. Default is 'double'.
+        chunk_size : int, optional
+            Number of pixels per chunk. Default is 2**20.
+        epsilon : float, optional
+            Threshold for selecting the pixels in polarisation.
+            0 <= epsilon < 1/4. The higher the more selective.
+
+        Examples
+        ----------
+        >>> import tempfile, shutil
+        >>> path = tempfile.mkdtemp()
+        >>> fn = os.path.join(path, 'maps.zip')
+        >>> inst, scan, sky_in = load_fake_instrument()
+        >>> tod = TimeOrderedDataPairDiff(inst, scan, sky_in, CESnumber=0)
+        >>> m = OutputSkyMap(projection=tod.projection,
+        ...     nside=tod.nside_out, obspix=tod.obspix)
+        >>> tod.tod2map(tod.map2tod_block(range(2 * tod.npair)), m)
+        >>> m.save_me(fn, chunk_size=100)
+        >>> maps = PartialSkyMap(fn)
+        >>> seen = m.nhit > 0
+        >>> print(np.all(maps.get('obspix') == m.obspix[seen]))
+        True
+        >>> print(np.all(maps.get('I', 10, 150) == m.get_I()[seen][10:150]))
+        True
+
+        Uncompressed single precision maps are memory-mapped
+        >>> m.save_me(fn, compress=False, precision='single')
+        >>> I = PartialSkyMap(fn).get('I')
+        >>> print(I.dtype, np.allclose(I, m.get_I()[seen]))
+        float32 True
+        >>> shutil.rmtree(path)
+        """
+        assert self.nsplits == 1, \
+            ValueError("Save the splits one by one (see get_split)!")
+        assert precision in ['single', 'double'], \
+            ValueError("Precision <{}> not understood! ".format(precision) +
+                       "Choose among ['single', 'double'].")
+        dtype = np.float32 if precision == 'single' else np.float64
+
+        self.sort_tiles()
+        I, Q, U = self.get_IQU()
+        if self.demodulation:
+            wI, wP = self.w0, self.w4
+        else:
+            wI = self.w
+            wP = qu_weight_mineig(self.cc, self.cs, self.ss,
+                                  epsilon=epsilon, verbose=verbose)
+
+        ## Observed pixels, and their index in the patch or on the sphere
+        seen = np.flatnonzero(self.nhit > 0)
+        if self.projection == 'healpix':
+            obspix = self.obspix[seen]
+        elif self.tile_size is not None:
+            obspix = self.local_pixels[seen]
+        else:
+            obspix = seen
+        if self.tile_size is not None:
+            npixsky = self.patch_npixsky
+        else:
+            npixsky = self.npixsky
+
+        data = {'I': I, 'Q': Q, 'U': U, 'wI': wI, 'wP': wP}
+        data = dict([(k, np.asarray(v)[..., seen].astype(dtype))
+                     for k, v in data.items()])
+        data['nhit'] = self.nhit[seen]
+        data['obspix'] = np.asarray(obspix, dtype=np.int64)
+
+        header = {
+            'projection': self.projection, 'nside': self.nside,
+            'pixel_size': self.pixel_size, 'npixsky': int(npixsky),
+            'demodulation': self.demodulation, 'nskies': self.nskies,
+            'npix': len(seen), 'chunk_size': int(chunk_size),
+            'names': sorted(data.keys())}
+
+        if compress:
+            compression = zipfile.ZIP_DEFLATED
+        else:
+            compression = zipfile.ZIP_STORED
+        tmp = fn + '.tmp'
+        with zipfile.ZipFile(tmp, 'w', compression, allowZip64=True) as zf:
+            zf.writestr('header.json', json.dumps(header))
+            for k, arr in data.items():
+                for chunk, start in enumerate(range(0, max(len(seen), 1),
+                                                    chunk_size)):
+                    buf = io.BytesIO()
+                    npy_format.write_array(buf, np.ascontiguousarray(
+                        arr[..., start:start + chunk_size]))
+                    zf.writestr(chunk_name(k, chunk), buf.getvalue())
+        os.rename(tmp, fn)
+
     def initialise_sky_maps_demod(self):
         """
         Create empty sky maps. This includes:
@@ -1629,16 +4211,18 @@ class OutputSkyMap():
         pair differenced.
 
         """
+        npix = self.npixsky * self.nsplits
+
         # To accumulate A^T N^-1 d
-        self.d0 = np.zeros(self.npixsky)
-        self.d4r = np.zeros(self.npixsky)
-        self.d4i = np.zeros(self.npixsky)
+        self.d0 = np.zeros(npix)
+        self.d4r = np.zeros(npix)
+        self.d4i = np.zeros(npix)
 
         # To accumulate A^T N^-1 A
-        self.w0 = np.zeros(self.npixsky)
-        self.w4 = np.zeros(self.npixsky)
+        self.w0 = np.zeros(npix)
+        self.w4 = np.zeros(npix)
 
-        self.nhit = np.zeros(self.npixsky, dtype=np.int32)
+        self.nhit = np.zeros(npix, dtype=np.int32)
 
     def get_I_demod(self):
         """
@@ -1712,6 +4296,11 @@ class OutputSkyMap():
                 'nside': self.nside, 'pixel_size': self.pixel_size,
                 'obspix': self.obspix}
 
+        ## Flat sky outputs are square patches
+        if self.tile_size is not None and self.projection == 'flat':
+            for k in ['I', 'Q', 'U', 'wI', 'wP', 'nhit']:
+                data[k] = self.to_patch(data[k])
+
         if shrink_maps and self.projection == 'flat':
             data = shrink_me(data, based_on='wP')
         elif crop_maps is not False and self.projection == 'flat':
@@ -1721,6 +4310,276 @@ class OutputSkyMap():
             pickle.dump(data, f, protocol=2)
 
 
+class PartialSkyMap():
+    """ Class to read sky maps written by OutputSkyMap.save_me """
+    def __init__(self, fn):
+        """
+        Maps are read lazily, by ranges of observed pixels: only the chunks
+        covering the range are read (and decompressed), and chunks stored
+        without compression are memory-mapped.
+
+        Parameters
+        ----------
+        fn : string
+            Name of the file written by OutputSkyMap.save_me.
+
+        Attributes
+        ----------
+        header : dict
+            projection, nside, pixel_size, npixsky (size of the patch),
+            demodulation, nskies, npix (number of observed pixels),
+            chunk_size and names of the maps.
+        """
+        self.fn = fn
+        self.zf = zipfile.ZipFile(fn, 'r')
+        self.header = json.loads(self.zf.read('header.json').decode())
+        self.npix = self.header['npix']
+        self.chunk_size = self.header['chunk_size']
+
+    def read_chunk(self, name, chunk):
+        """
+        Return one chunk of a map, memory-mapped if not compressed.
+        """
+        info = self.zf.getinfo(chunk_name(name, chunk))
+        if info.compress_type != zipfile.ZIP_STORED:
+            f = self.zf.open(info)
+            data = npy_format.read_array(f)
+            f.close()
+            return data
+
+        ## Data of a stored member follows its local header
+        with open(self.fn, 'rb') as f:
+            f.seek(info.header_offset)
+            local = struct.unpack('<4s5H3L2H', f.read(30))
+            f.seek(info.header_offset + 30 + local[-2] + local[-1])
+            version = npy_format.read_magic(f)
+            if version == (1, 0):
+                shape, fortran, dtype = npy_format.read_array_header_1_0(f)
+            else:
+                shape, fortran, dtype = npy_format.read_array_header_2_0(f)
+            offset = f.tell()
+        if np.prod(shape) == 0:
+            return np.zeros(shape, dtype=dtype)
+        return np.memmap(self.fn, dtype=dtype, mode='r', offset=offset,
+                         shape=shape, order='F' if fortran else 'C')
+
+    def get(self, name, start=0, stop=None):
+        """
+        Return a map for observed pixels [start, stop[.
+
+        Parameters
+        ----------
+        name : string
+            Name of the map among ['I', 'Q', 'U', 'wI', 'wP', 'nhit',
+            'obspix'].
+        start : int, optional
+            First observed pixel. Default is 0.
+        stop : int, optional
+            Last observed pixel (excluded). Default is None (npix).
+
+        Returns
+        ----------
+        data : array
+            The map, of size stop - start (last axis).
+        """
+        if stop is None:
+            stop = self.npix
+        stop = min(stop, self.npix)
+        first = start // self.chunk_size
+        last = max((stop - 1) // self.chunk_size, first)
+        chunks = [self.read_chunk(name, chunk)
+                  for chunk in range(first, last + 1)]
+        if len(chunks) == 1:
+            data = chunks[0]
+        else:
+            data = np.concatenate(chunks, axis=-1)
+        offset = first * self.chunk_size
+        return data[..., start - offset:stop - offset]
+
+    def find_range(self, pixmin, pixmax):
+        """
+        Range [start, stop[ of the observed pixels whose index (obspix)
+        is within [pixmin, pixmax[. obspix is read one chunk at a time.
+        """
+        start, stop = None, 0
+        nchunk = (self.npix + self.chunk_size - 1) // self.chunk_size
+        for chunk in range(nchunk):
+            obspix = self.read_chunk('obspix', chunk)
+            if obspix[-1] < pixmin:
+                continue
+            if obspix[0] >= pixmax:
+                break
+            offset = chunk * self.chunk_size
+            if start is None:
+                start = offset + np.searchsorted(obspix, pixmin)
+            stop = offset + np.searchsorted(obspix, pixmax)
+        if start is None:
+            return 0, 0
+        return int(start), int(stop)
+
+    def close(self):
+        """
+        Close the file.
+        """
+        self.zf.close()
+
+
+class SkyMapStatistics():
+    """ Class to accumulate running statistics of maps over simulations """
+    def __init__(self, obspix):
+        """
+        Mean, variance and covariance of I, Q and U in each pixel over
+        simulations, updated in place one simulation at a time
+        (Welford's algorithm): memory does not depend on the number of
+        simulations. Statistics are computed for a range of pixels only,
+        such that processors can share the maps by ranges of pixels.
+        Pixels which are not observed in a simulation are skipped, and
+        each pixel keeps its own number of simulations.
+
+        Parameters
+        ----------
+        obspix : 1d array of int
+            Sorted indices of the pixels (healpix index, or index in the
+            patch for flat projection), as obspix in OutputSkyMap.save_me.
+
+        Examples
+        ----------
+        >>> import tempfile, shutil
+        >>> path = tempfile.mkdtemp()
+        >>> inst, scan, sky_in = load_fake_instrument()
+        >>> maps = []
+        >>> for sim in range(4):
+        ...     tod = TimeOrderedDataPairDiff(inst, scan, sky_in,
+        ...         CESnumber=0, array_noise_level=10.,
+        ...         array_noise_seed=sim)
+        ...     m = OutputSkyMap(projection=tod.projection,
+        ...         nside=tod.nside_out, obspix=tod.obspix)
+        ...     tod.tod2map(tod.map2tod_block(range(2 * tod.npair)), m)
+        ...     m.save_me(os.path.join(path, 'sim{}.zip'.format(sim)))
+        ...     maps.append(np.array(m.get_IQU())[:, m.nhit > 0])
+
+        Statistics over the simulations, for half of the pixels
+        >>> obspix = tod.obspix[m.nhit > 0]
+        >>> half = len(obspix) // 2
+        >>> stats = SkyMapStatistics(obspix[:half])
+        >>> for sim in range(4):
+        ...     stats.update_from_file(os.path.join(path,
+        ...         'sim{}.zip'.format(sim)))
+        >>> print(np.allclose(stats.get_mean(),
+        ...     np.mean(maps, axis=0)[:, :half]))
+        True
+        >>> print(np.allclose(stats.get_variance(),
+        ...     np.var(maps, axis=0, ddof=1)[:, :half]))
+        True
+        >>> IQ = [np.cov(np.array(maps)[:, 0, i], np.array(maps)[:, 1, i])
+        ...     for i in range(half)]
+        >>> print(np.allclose(stats.get_covariance()[0],
+        ...     [c[0, 1] for c in IQ]))
+        True
+        >>> shutil.rmtree(path)
+        """
+        self.obspix = np.asarray(obspix, dtype=np.int64)
+        npix = len(self.obspix)
+
+        ## Number of simulations, mean, and sums of squared deviations
+        ## (II, QQ, UU) and of products of deviations (IQ, IU, QU)
+        self.nsims = np.zeros(npix, dtype=np.int64)
+        self.mean = np.zeros((3, npix))
+        self.m2 = np.zeros((3, npix))
+        self.c2 = np.zeros((3, npix))
+
+    def update(self, iqu, pixels):
+        """
+        Add one simulation.
+
+        Parameters
+        ----------
+        iqu : 2d array
+            I, Q and U maps of size (3, npix).
+        pixels : 1d array of int
+            Sorted indices of the pixels of the maps. Pixels not in
+            obspix are ignored.
+        """
+        pixels = np.asarray(pixels)
+        index = np.searchsorted(self.obspix, pixels)
+        index[index == len(self.obspix)] = 0
+        keep = self.obspix[index] == pixels
+        if len(self.obspix) == 0 or not np.any(keep):
+            return
+        index = index[keep]
+        x = np.asarray(iqu, dtype=np.float64)[:, keep]
+
+        self.nsims[index] += 1
+        delta = x - self.mean[:, index]
+        self.mean[:, index] += delta / self.nsims[index]
+        delta_new = x - self.mean[:, index]
+        self.m2[:, index] += delta * delta_new
+        ## Co-moments IQ, IU, QU
+        for k, (a, b) in enumerate([(0, 1), (0, 2), (1, 2)]):
+            self.c2[k, index] += delta[a] * delta_new[b]
+
+    def update_from_map(self, output_maps):
+        """
+        Add one simulation from an OutputSkyMap instance
+        (observed pixels only).
+        """
+        assert output_maps.nskies == 1, \
+            ValueError("Statistics work with one sky per map!")
+        output_maps.sort_tiles()
+        seen = output_maps.nhit > 0
+        if output_maps.projection == 'healpix':
+            pixels = output_maps.obspix
+        elif output_maps.tile_size is not None:
+            pixels = output_maps.local_pixels
+        else:
+            pixels = np.arange(output_maps.npixsky)
+        iqu = np.array(output_maps.get_IQU())
+        self.update(iqu[:, seen], pixels[seen])
+
+    def update_from_file(self, fn):
+        """
+        Add one simulation from a file written by OutputSkyMap.save_me.
+        Only the observed pixels within the range of obspix are read.
+        """
+        if len(self.obspix) == 0:
+            return
+        maps = PartialSkyMap(fn)
+        assert maps.header['nskies'] == 1, \
+            ValueError("Statistics work with one sky per map!")
+        start, stop = maps.find_range(self.obspix[0], self.obspix[-1] + 1)
+        if stop > start:
+            iqu = [maps.get(k, start, stop) for k in ['I', 'Q', 'U']]
+            self.update(iqu, maps.get('obspix', start, stop))
+        maps.close()
+
+    def get_mean(self):
+        """
+        Mean of I, Q and U, of size (3, npix).
+        """
+        return self.mean
+
+    def get_variance(self, ddof=1):
+        """
+        Variance of I, Q and U, of size (3, npix). Pixels with less than
+        ddof + 1 simulations are set to 0.
+        """
+        norm = (self.nsims - ddof).astype(np.float64)
+        return np.where(norm > 0, self.m2 / np.maximum(norm, 1), 0.)
+
+    def get_covariance(self, ddof=1):
+        """
+        Covariance of IQ, IU and QU, of size (3, npix). Pixels with less
+        than ddof + 1 simulations are set to 0.
+        """
+        norm = (self.nsims - ddof).astype(np.float64)
+        return np.where(norm > 0, self.c2 / np.maximum(norm, 1), 0.)
+
+def chunk_name(name, chunk):
+    """
+    Name of a chunk of map in files written by OutputSkyMap.save_me.
+    """
+    return '{}/{:06d}.npy'.format(name, chunk)
+
 def shrink_me(dic, based_on):
     """
     Shrink maps to remove unecessary zeros.
@@ -1890,11 +4749,208 @@ def partial2full(partial_obs, obspix, nside, fill_with=0.0):
     fullsky[obspix] = partial_obs
     return fullsky
 
+def mask_to_intervals(mask):
+    """
+    Run-length encoding of a boolean mask.
+
+    Parameters
+    ----------
+    mask : 1d array of bool
+        The mask.
+
+    Returns
+    ----------
+    intervals : 2d array of int
+        Intervals [start, stop[ of True values, of size (nintervals, 2).
+
+    Examples
+    ----------
+    >>> mask = np.array([1, 1, 0, 0, 1, 0], dtype=bool)
+    >>> print(mask_to_intervals(mask).tolist())
+    [[0, 2], [4, 5]]
+    """
+    mask = np.asarray(mask, dtype=np.int8)
+    edges = np.flatnonzero(np.diff(np.concatenate(([0], mask, [0]))))
+    return edges.reshape((-1, 2)).astype(np.int64)
+
+def intervals_union(a, b):
+    """
+    Union of two lists of intervals [start, stop[.
+
+    Parameters
+    ----------
+    a : 2d array of int
+        Intervals of size (na, 2), not necessarily sorted or disjoint.
+    b : 2d array of int
+        Intervals of size (nb, 2), not necessarily sorted or disjoint.
+
+    Returns
+    ----------
+    intervals : 2d array of int
+        Sorted, disjoint (and not adjacent) intervals.
+
+    Examples
+    ----------
+    >>> a = [[0, 2], [8, 9]]
+    >>> b = [[1, 4], [4, 6]]
+    >>> print(intervals_union(a, b).tolist())
+    [[0, 6], [8, 9]]
+    """
+    runs = np.concatenate(
+        (np.reshape(a, (-1, 2)), np.reshape(b, (-1, 2)))).astype(np.int64)
+    runs = runs[runs[:, 1] > runs[:, 0]]
+    if len(runs) == 0:
+        return runs
+    runs = runs[np.argsort(runs[:, 0], kind='mergesort')]
+
+    ## A new run starts after the furthest stop of the previous runs
+    stops = np.maximum.accumulate(runs[:, 1])
+    first = np.concatenate(([True], runs[1:, 0] > stops[:-1]))
+    last = np.concatenate((np.flatnonzero(first)[1:] - 1, [len(runs) - 1]))
+    return np.array([runs[first, 0], stops[last]]).T
+
+def intervals_complement(a, nsamples):
+    """
+    Complement of a list of intervals [start, stop[ within [0, nsamples[.
+
+    Examples
+    ----------
+    >>> print(intervals_complement([[2, 4], [7, 10]], 10).tolist())
+    [[0, 2], [4, 7]]
+    """
+    runs = intervals_union(np.clip(np.reshape(a, (-1, 2)), 0, nsamples), [])
+    bounds = np.concatenate(([0], runs.ravel(), [nsamples])).reshape((-1, 2))
+    return bounds[bounds[:, 1] > bounds[:, 0]]
+
+def intervals_intersection(a, b, nsamples):
+    """
+    Intersection of two lists of intervals [start, stop[ within
+    [0, nsamples[.
+
+    Examples
+    ----------
+    >>> print(intervals_intersection([[0, 5]], [[3, 8]], 10).tolist())
+    [[3, 5]]
+    """
+    return intervals_complement(
+        intervals_union(
+            intervals_complement(a, nsamples),
+            intervals_complement(b, nsamples)), nsamples)
+
+def load_checkpoint(fn):
+    """
+    Read maps saved by OutputSkyMap.save_checkpoint.
+
+    Parameters
+    ----------
+    fn : string
+        Name of the checkpoint file.
+
+    Returns
+    ----------
+    output_maps : OutputSkyMap instance
+        The maps, with the same accumulators as when they were saved.
+    ces_done : list of int
+        Indices of the scans (CES) already accumulated in the maps.
+    """
+    data = np.load(fn)
+    header = json.loads(str(data['header']))
+    if 'obspix' in data.files:
+        obspix = data['obspix']
+    else:
+        obspix = None
+
+    output_maps = OutputSkyMap(
+        header['projection'], obspix=obspix, npixsky=header['npixsky'],
+        nside=header['nside'], pixel_size=header['pixel_size'],
+        demodulation=header['demodulation'], nskies=header['nskies'],
+        tile_size=header['tile_size'], nsplits=header['nsplits'])
+    if 'tiles' in data.files:
+        output_maps.allocate_tiles(data['tiles'])
+
+    pixels = data['pixels']
+    for k in output_maps.to_coadd.split(' '):
+        getattr(output_maps, k)[..., pixels] = data[k]
+
+    return output_maps, [int(ces) for ces in data['ces_done']]
+
+def sort_pixels(point_matrix):
+    """
+    Stable permutation sorting the samples of a flat pointing matrix by
+    pixel. Samples outside the sky patch (pixel -1) are dropped.
+
+    Parameters
+    ----------
+    point_matrix : 1d array of int
+        Pixel indices of the samples.
+
+    Returns
+    ----------
+    order : 1d array of int
+        Indices of the samples, sorted by pixel.
+
+    Examples
+    ----------
+    >>> print(sort_pixels(np.array([3, -1, 0, 3, 1])))
+    [2 4 0 3]
+    """
+    seen = np.flatnonzero(point_matrix >= 0)
+    return seen[np.argsort(point_matrix[seen], kind='mergesort')]
+
+def get_local_indices(pixels, obspix, obspix_rings=None):
+    """
+    Convert global pixel indices (full sky) to local pixel indices
+    (position in obspix). If the ring-offset table of obspix is given
+    (see input_sky.get_ring_offsets), the position is read from the
+    ring of the pixel and its offset within the ring. Otherwise this is
+    a binary search in obspix.
+
+    Parameters
+    ----------
+    pixels : int or 1d array of int
+        Global pixel indices.
+    obspix : 1d array of int
+        Sorted array with indices of observed pixels.
+    obspix_rings : 2d array of int, optional
+        Ring-offset table of obspix (RING ordering). Default is None.
+
+    Returns
+    ----------
+    index : int or 1d array of int32
+        Position of the pixels in obspix (-1 if not in obspix).
+
+    Examples
+    ----------
+    >>> print(get_local_indices(np.array([8, 3, 5, 9]), np.array([3, 4, 8])))
+    [ 2  0 -1 -1]
+
+    Same result with the ring-offset table
+    >>> obspix = input_sky.get_obspix(-0.5, 0.5, -0.3, 0.3, 4)
+    >>> table = input_sky.get_ring_offsets(obspix, 4)
+    >>> pixels = np.arange(12 * 4**2)
+    >>> print(np.all(get_local_indices(pixels, obspix, table) ==
+    ...     get_local_indices(pixels, obspix)))
+    True
+    """
+    obspix = np.asarray(obspix)
+    pixels = np.asarray(pixels)
+    if obspix_rings is not None:
+        nside = obspix_rings.shape[1] // 4
+        pixels_1d = np.atleast_1d(pixels).astype(np.int64).ravel()
+        rings = np.asarray(hp.pix2ring(nside, pixels_1d), dtype=np.int64)
+        index = tod_f.local_indices_f(pixels_1d, rings, obspix_rings)
+        return index.reshape(pixels.shape)
+    if len(obspix) == 0:
+        return np.full(pixels.shape, -1, dtype=np.int32)
+    index = np.minimum(np.searchsorted(obspix, pixels), len(obspix) - 1)
+    return np.where(obspix[index] == pixels, index, -1).astype(np.int32)
+
 def build_pointing_matrix(ra, dec, nside_in, nside_out=None,
                           projection='healpix', obspix=None, ext_map_gal=False,
                           xmin=None, ymin=None,
                           pixel_size=None, npix_per_row=None,
-                          cut_pixels_outside=True):
+                          cut_pixels_outside=True, input_obspix=None,
+                          obspix_rings=None, input_obspix_rings=None):
     """
     Given pointing coordinates (RA/Dec), retrieve the corresponding healpix
     pixel index for a full sky map. This acts effectively as an operator
@@ -1944,6 +5000,16 @@ def build_pointing_matrix(ra, dec, nside_in, nside_out=None,
     cut_pixels_outside : bool, optional
         If True assign -1 to pixels not in obspix. If False, the routine
         crashes if there are pixels outside. Default is True.
+    input_obspix : 1d array of int, optional
+        If the input map has been compacted (see HealpixFitsMap.compact),
+        its sorted pixels HealpixFitsMap.obspix, to go from full sky to
+        compacted input indices (see get_local_indices). Raise a
+        ValueError if a pixel is not in the compacted map.
+    obspix_rings : 2d array of int, optional
+        Ring-offset table of obspix (see input_sky.get_ring_offsets).
+        If None, local indices are found by binary search in obspix.
+    input_obspix_rings : 2d array of int, optional
+        Ring-offset table of input_obspix (HealpixFitsMap.obspix_rings).
 
     Returns
     ----------
@@ -1974,6 +5040,13 @@ def build_pointing_matrix(ra, dec, nside_in, nside_out=None,
     ...  nside_in=16, nside_out=8, obspix=np.array(range(12*16**2)))
     >>> print(index_global, index_local)
     [2592  420] [624 112]
+
+    Indices in a compacted input map
+    >>> index_global, index_local = build_pointing_matrix(
+    ... np.array([0.0, 0.0]), np.array([-np.pi/4, np.pi/4]),
+    ...  nside_in=16, input_obspix=np.array([420, 2592]))
+    >>> print(index_global)
+    [1 0]
     """
     if nside_out is None:
         nside_out = nside_in
@@ -1985,13 +5058,21 @@ def build_pointing_matrix(ra, dec, nside_in, nside_out=None,
 
     index_global = hp.ang2pix(nside_in, theta, phi)
 
+    if input_obspix is not None:
+        index_global = get_local_indices(
+            index_global, input_obspix, input_obspix_rings)
+        if np.any(index_global < 0):
+            msg = "Pixels outside the compacted input map. " + \
+                "Increase the margin while compacting the input map."
+            raise ValueError(msg)
+
     if projection == 'healpix' and obspix is not None:
         index_global_out = hp.ang2pix(nside_out, theta, phi)
-        index_local = obspix.searchsorted(index_global_out)
-        mask1 = index_local < len(obspix)
-        loc = mask1
-        loc[mask1] = obspix[index_local[mask1]] == index_global_out[mask1]
-        outside_pixels = np.invert(loc)
+
+        ## Position in the sorted obspix (-1 for outside pixels)
+        index_local = get_local_indices(
+            index_global_out, obspix, obspix_rings)
+        outside_pixels = index_local == -1
 
         ## Handling annoying cases.
         if (np.sum(outside_pixels) and (not cut_pixels_outside)):
@@ -2048,6 +5129,197 @@ def build_pointing_matrix(ra, dec, nside_in, nside_out=None,
 
     return index_global, index_local
 
+def footprint_to_width(ra, dec, fp_radius, ra_src=0.0, dec_src=0.0,
+                       margin=0.5, projection='healpix'):
+    """
+    Convert the boresight footprint of a scan into patch bounds, that is
+    the extent of the patch on each side of (`ra_src`, `dec_src`).
+    The focal plane is described as a disc of radius `fp_radius` around
+    the boresight, so its extent in RA grows as 1/cos(dec).
+
+    Parameters
+    ----------
+    ra : 1d array
+        RA of the boresight in radian.
+    dec : 1d array
+        Dec of the boresight in radian.
+    fp_radius : float
+        Radius of the focal plane on the sky in radian.
+    ra_src : float, optional
+        RA of the center of the patch in degree.
+    dec_src : float, optional
+        Dec of the center of the patch in degree.
+    margin : float, optional
+        Margin in degree added on each side of the patch.
+    projection : string, optional
+        Type of projection for the output map among [healpix, flat].
+
+    Returns
+    ----------
+    width : list of 4 floats or float
+        For healpix projection, the extent of the patch on each
+        side of its center [left, right, bottom, top] in degree.
+        For flat projection, the width of the square patch
+        (centered on the center of the scan) in degree.
+
+    Examples
+    ----------
+    >>> ra = np.array([-10., 0., 10.]) * d2r
+    >>> dec = np.array([-5., 0., 5.]) * d2r
+    >>> width = footprint_to_width(ra, dec, fp_radius=0., margin=1.)
+    >>> print(' '.join(['{:.1f}'.format(w) for w in width]))
+    11.0 11.0 6.0 6.0
+
+    >>> width = footprint_to_width(ra, dec, fp_radius=0., margin=1.,
+    ...     projection='flat')
+    >>> print(round(width, 2))
+    22.0
+    """
+    ## Unwrap RA around the center of the patch
+    dra = (ra - ra_src * d2r + np.pi) % (2 * np.pi) - np.pi
+
+    ## Furthest detector from the equator sets the extent in RA.
+    ## Stop before the pole (the patch covers all RA there anyway).
+    dec_far = np.minimum(np.abs(dec) + fp_radius, np.pi / 2. - 1e-3)
+    ra_radius = fp_radius / np.cos(dec_far)
+
+    left = max(-np.min(dra - ra_radius), 0.) / d2r + margin
+    right = max(np.max(dra + ra_radius), 0.) / d2r + margin
+    bottom = max(dec_src * d2r - np.min(dec - fp_radius), 0.) / d2r + margin
+    top = max(np.max(dec + fp_radius) - dec_src * d2r, 0.) / d2r + margin
+
+    ## Do not go beyond the full sky in RA
+    left = min(left, 180.)
+    right = min(right, 180.)
+
+    if projection == 'flat':
+        return 2. * max([left, right, bottom, top])
+
+    return [left, right, bottom, top]
+
+def get_scan_footprint(hardware, scanning_strategy, projection='healpix',
+                       CESnumbers=None, margin=0.5, resolution=0.0,
+                       decimation=50):
+    """
+    Compute the tightest sky patch containing all the detectors for a set of
+    scans, with a margin. The boresight pointing is computed on a decimated
+    set of time samples (turnarounds and first/last samples are always
+    included), and the focal plane is described as a disc around the
+    boresight.
+
+    The decimated boresight pointing of each scan is stored in
+    scanning_strategy.footprints, so that all TimeOrderedDataPairDiff
+    instances built with width='auto' compute it once, and share the
+    same patch (and the same obspix for coaddition).
+
+    Parameters
+    ----------
+    hardware : Hardware instance
+        Instance of Hardware containing instrument parameters and models.
+    scanning_strategy : ScanningStrategy instance
+        Instance of ScanningStrategy containing scan parameters.
+    projection : string, optional
+        Type of projection for the output map among [healpix, flat].
+    CESnumbers : list of int, optional
+        Scans to include. Default is all scans of the scanning strategy.
+    margin : float, optional
+        Margin in degree added on each side of the patch.
+    resolution : float, optional
+        Size of the output pixels in radian. It is added to the focal
+        plane radius, as pixels are selected based on their center.
+    decimation : int, optional
+        Compute the boresight pointing every `decimation` samples.
+
+    Returns
+    ----------
+    width : list of 4 floats or float
+        See footprint_to_width.
+
+    Examples
+    ----------
+    >>> inst, scan, sky_in = load_fake_instrument()
+    >>> width = get_scan_footprint(inst, scan, margin=0.5)
+    >>> print(' '.join(['{:.1f}'.format(w) for w in width]))
+    68.1 68.6 11.4 11.8
+    >>> print(sorted(key[0] for key in scan.footprints))
+    [0, 1]
+
+    The sky patch is then much smaller than the default one
+    >>> tod = TimeOrderedDataPairDiff(inst, scan, sky_in, CESnumber=0,
+    ...     width='auto')
+    >>> tod_default = TimeOrderedDataPairDiff(inst, scan, sky_in, CESnumber=0)
+    >>> print(tod.npixsky, tod_default.npixsky)
+    180 727
+
+    No detectors fall outside the patch
+    >>> d = tod.map2tod(0)
+    >>> print(np.sum(tod.point_matrix[0] == -1))
+    0
+    """
+    if CESnumbers is None:
+        CESnumbers = range(scanning_strategy.nces)
+
+    lat = float(scanning_strategy.telescope_location.lat) * 180. / np.pi
+    if projection == 'healpix':
+        ra_src = 0.0
+        dec_src = 0.0
+    elif projection == 'flat':
+        ra_src = scanning_strategy.ra_mid
+        dec_src = scanning_strategy.dec_mid * np.pi / 180.
+
+    ## Boresight pointing depends on the pointing model of the hardware
+    model = hardware.pointing_model
+    model_key = (tuple(np.ravel(model.value_params)),
+                 tuple(np.ravel(model.allowed_params)))
+
+    ras = []
+    decs = []
+    for CESnumber in CESnumbers:
+        key = (CESnumber, projection, decimation, model_key)
+        if key in scanning_strategy.footprints:
+            ra, dec = scanning_strategy.footprints[key]
+            ras.append(ra)
+            decs.append(dec)
+            continue
+
+        scan = getattr(scanning_strategy, 'scan{}'.format(CESnumber))
+
+        ## Decimate, but keep the turnarounds and the edges of the scan
+        az = scan['azimuth']
+        turnarounds = np.where(np.diff(np.sign(np.diff(az))) != 0)[0] + 1
+        index = np.unique(np.concatenate(
+            (np.arange(0, len(az), decimation), turnarounds, [len(az) - 1])))
+
+        pointing = Pointing(
+            az_enc=scan['azimuth'][index],
+            el_enc=scan['elevation'][index],
+            time=scan['clock-utc'][index],
+            value_params=hardware.pointing_model.value_params,
+            allowed_params=hardware.pointing_model.allowed_params,
+            ut1utc_fn=scanning_strategy.ut1utc_fn,
+            lat=lat, ra_src=ra_src, dec_src=dec_src)
+        ra, dec, pa = pointing.offset_detector(0.0, 0.0)
+        scanning_strategy.footprints[key] = (ra, dec)
+        ras.append(ra)
+        decs.append(dec)
+
+    fp_radius = np.max(
+        np.hypot(hardware.beam_model.xpos, hardware.beam_model.ypos))
+    fp_radius += resolution
+
+    ## In flat projection, the scan is rotated around (0, 0).
+    if projection == 'healpix':
+        center = (scanning_strategy.ra_mid, scanning_strategy.dec_mid)
+    else:
+        center = (0.0, 0.0)
+
+    width = footprint_to_width(
+        np.concatenate(ras), np.concatenate(decs), fp_radius,
+        ra_src=center[0], dec_src=center[1],
+        margin=margin, projection=projection)
+
+    return width
+
 def load_fake_instrument(nside=16, nsquid_per_mux=1):
     """
     For test purposes.
@@ -5,73 +5,335 @@
 !!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!
 module tod_f
 
+!$ use omp_lib
+
 contains
 
     subroutine tod2map_pair_f(d, w, dc, ds, cc, cs, ss, nhit, waferi1d, &
-    waferpa, waferts, diff_weight, sum_weight, npix, nt, &
-    wafermask_pixel, nskypix)
+    wafercos, wafersin, waferts, diff_weight, sum_weight, npix, nt, &
+    wafermask_pixel, nskypix, nsky, sumdiff, nthreads, strategy)
         implicit none
+        ! Timestreams of nsky input skies are projected in one pass:
+        ! d, dc and ds contain nsky maps, weights are shared.
+        ! If sumdiff > 0, waferts contains the half-sum and half-difference
+        ! of each pair instead of top and bottom timestreams.
+        ! wafercos and wafersin are cos(2 psi) and sin(2 psi), with psi the
+        ! polarisation angle of top bolometers.
+        ! With nthreads > 1, the projection is shared among OpenMP threads:
+        ! strategy = 1 (reduction): each thread projects a range of pairs
+        ! into private copies of the maps (nthreads copies in memory),
+        ! which are summed at the end.
+        ! strategy = 2 (owner): samples are first bucketed by range of sky
+        ! pixels (see bucket_samples_f), and each thread projects the samples
+        ! of its own buckets (no private maps, and the same order of
+        ! summation as the serial kernel).
 
         integer, parameter       :: I4B = 4
         integer, parameter       :: DP = 8
-        real(DP), parameter      :: pi = 3.141592
 
-        integer(I4B), intent(in) :: npix, nt, nskypix
+        integer(I4B), intent(in) :: npix, nt, nskypix, nsky, sumdiff
+        integer(I4B), intent(in) :: nthreads, strategy
         integer(I4B), intent(in) :: waferi1d(0:npix*nt - 1)
         integer(I4B), intent(in) :: wafermask_pixel(0:npix*nt - 1)
-        real(DP), intent(in)     :: waferpa(0:npix*nt - 1), waferts(0:npix*nt*2 - 1)
+        real(DP), intent(in)     :: wafercos(0:npix*nt - 1), wafersin(0:npix*nt - 1)
+        real(DP), intent(in)     :: waferts(0:npix*nt*2*nsky - 1)
         real(DP), intent(in)     :: diff_weight(0:npix - 1), sum_weight(0:npix - 1)
 
-        real(DP), intent(inout)  :: d(0:nskypix - 1), w(0:nskypix - 1), dc(0:nskypix - 1)
-        real(DP), intent(inout)  :: ds(0:nskypix - 1), cc(0:nskypix - 1)
+        real(DP), intent(inout)  :: d(0:nskypix*nsky - 1), w(0:nskypix - 1)
+        real(DP), intent(inout)  :: dc(0:nskypix*nsky - 1), ds(0:nskypix*nsky - 1)
+        real(DP), intent(inout)  :: cc(0:nskypix - 1)
         real(DP), intent(inout)  :: cs(0:nskypix - 1), ss(0:nskypix - 1)
         integer(I4B), intent(inout) :: nhit(0:nskypix - 1)
 
-        integer(I4B)             :: i, j, ipix, pixel
+        integer(I4B)             :: tid, nth, jlo, jhi, b
+        integer(I4B), allocatable :: offsets(:), order(:)
+        real(DP), allocatable    :: d_p(:), w_p(:), dc_p(:), ds_p(:)
+        real(DP), allocatable    :: cc_p(:), cs_p(:), ss_p(:)
+        integer(I4B), allocatable :: nhit_p(:)
+
+        if (nthreads .le. 1) then
+            call pair_accumulate_f(d, w, dc, ds, cc, cs, ss, nhit, waferi1d, &
+            wafercos, wafersin, waferts, diff_weight, sum_weight, npix, nt, &
+            wafermask_pixel, nskypix, nsky, sumdiff, 0, npix - 1)
+        else if (strategy .eq. 2) then
+            allocate(offsets(0:nthreads), order(0:npix*nt - 1))
+            call bucket_samples_f(waferi1d, wafermask_pixel, npix*nt, &
+            nskypix, nthreads, offsets, order)
+            !$omp parallel num_threads(nthreads) private(tid, nth, b)
+            tid = 0
+            nth = 1
+            !$ tid = omp_get_thread_num()
+            !$ nth = omp_get_num_threads()
+            do b=tid, nthreads - 1, nth
+                call pair_accumulate_order_f(d, w, dc, ds, cc, cs, ss, nhit, &
+                waferi1d, wafercos, wafersin, waferts, diff_weight, &
+                sum_weight, npix, nt, nskypix, nsky, sumdiff, order, &
+                offsets(b), offsets(b + 1) - 1)
+            enddo
+            !$omp end parallel
+            deallocate(offsets, order)
+        else
+            !$omp parallel num_threads(nthreads) private(tid, nth, jlo, jhi, &
+            !$omp d_p, w_p, dc_p, ds_p, cc_p, cs_p, ss_p, nhit_p)
+            tid = 0
+            nth = 1
+            !$ tid = omp_get_thread_num()
+            !$ nth = omp_get_num_threads()
+            jlo = tid * npix / nth
+            jhi = (tid + 1) * npix / nth - 1
+            allocate(d_p(0:nskypix*nsky - 1), dc_p(0:nskypix*nsky - 1))
+            allocate(ds_p(0:nskypix*nsky - 1), w_p(0:nskypix - 1))
+            allocate(cc_p(0:nskypix - 1), cs_p(0:nskypix - 1))
+            allocate(ss_p(0:nskypix - 1), nhit_p(0:nskypix - 1))
+            d_p = 0.0
+            w_p = 0.0
+            dc_p = 0.0
+            ds_p = 0.0
+            cc_p = 0.0
+            cs_p = 0.0
+            ss_p = 0.0
+            nhit_p = 0
+            call pair_accumulate_f(d_p, w_p, dc_p, ds_p, cc_p, cs_p, ss_p, &
+            nhit_p, waferi1d, wafercos, wafersin, waferts, diff_weight, &
+            sum_weight, npix, nt, wafermask_pixel, nskypix, nsky, sumdiff, &
+            jlo, jhi)
+            !$omp critical
+            d = d + d_p
+            w = w + w_p
+            dc = dc + dc_p
+            ds = ds + ds_p
+            cc = cc + cc_p
+            cs = cs + cs_p
+            ss = ss + ss_p
+            nhit = nhit + nhit_p
+            !$omp end critical
+            deallocate(d_p, w_p, dc_p, ds_p, cc_p, cs_p, ss_p, nhit_p)
+            !$omp end parallel
+        endif
+
+    end subroutine
+
+    subroutine pair_accumulate_f(d, w, dc, ds, cc, cs, ss, nhit, waferi1d, &
+    wafercos, wafersin, waferts, diff_weight, sum_weight, npix, nt, &
+    wafermask_pixel, nskypix, nsky, sumdiff, jlo, jhi)
+        implicit none
+        ! Projection of pairs [jlo, jhi].
+        ! See tod2map_pair_f.
+
+        integer, parameter       :: I4B = 4
+        integer, parameter       :: DP = 8
+
+        integer(I4B), intent(in) :: npix, nt, nskypix, nsky, sumdiff
+        integer(I4B), intent(in) :: jlo, jhi
+        integer(I4B), intent(in) :: waferi1d(0:npix*nt - 1)
+        integer(I4B), intent(in) :: wafermask_pixel(0:npix*nt - 1)
+        real(DP), intent(in)     :: wafercos(0:npix*nt - 1), wafersin(0:npix*nt - 1)
+        real(DP), intent(in)     :: waferts(0:npix*nt*2*nsky - 1)
+        real(DP), intent(in)     :: diff_weight(0:npix - 1), sum_weight(0:npix - 1)
+
+        real(DP), intent(inout)  :: d(0:nskypix*nsky - 1), w(0:nskypix - 1)
+        real(DP), intent(inout)  :: dc(0:nskypix*nsky - 1), ds(0:nskypix*nsky - 1)
+        real(DP), intent(inout)  :: cc(0:nskypix - 1)
+        real(DP), intent(inout)  :: cs(0:nskypix - 1), ss(0:nskypix - 1)
+        integer(I4B), intent(inout) :: nhit(0:nskypix - 1)
+
+        integer(I4B)             :: i, j, k, ipix, pixel
         integer(I4B)             :: ict, icb
         real(DP)                 :: sum, diff, c, s
 
-        do j=0, npix - 1
+        do j=jlo, jhi
             do i=0, nt - 1
                 ipix = i + j * nt
-                if (wafermask_pixel(ipix) .gt. 0 .and. waferi1d(ipix) .gt. 0) then
-                    ict = i + 2*j*nt
-                    icb = i + (2*j + 1)*nt
-
-                    pixel = waferi1d(ipix)
-
-                    sum = 0.5*(waferts(ict) + waferts(icb))
-                    diff = 0.5*(waferts(ict) - waferts(icb))
-                    c = cos(2.0*waferpa(ipix))
-                    s = sin(2.0*waferpa(ipix))
+                pixel = waferi1d(ipix)
+                if (wafermask_pixel(ipix) .gt. 0 .and. pixel .ge. 0) then
+                    c = wafercos(ipix)
+                    s = wafersin(ipix)
 
                     nhit(pixel) = nhit(pixel) + 1
                     w(pixel) = w(pixel) + sum_weight(j)
-                    d(pixel) = d(pixel) + sum * sum_weight(j)
 
-                    dc(pixel) = dc(pixel) + c * diff * diff_weight(j)
-                    ds(pixel) = ds(pixel) + s * diff * diff_weight(j)
                     cc(pixel) = cc(pixel) + c * c * diff_weight(j)
                     cs(pixel) = cs(pixel) + c * s * diff_weight(j)
                     ss(pixel) = ss(pixel) + s * s * diff_weight(j)
+
+                    do k=0, nsky - 1
+                        ict = i + (2*j*nsky + k)*nt
+                        icb = i + ((2*j + 1)*nsky + k)*nt
+
+                        if (sumdiff .gt. 0) then
+                            sum = waferts(ict)
+                            diff = waferts(icb)
+                        else
+                            sum = 0.5*(waferts(ict) + waferts(icb))
+                            diff = 0.5*(waferts(ict) - waferts(icb))
+                        endif
+
+                        d(pixel + k*nskypix) = d(pixel + k*nskypix) + sum * sum_weight(j)
+                        dc(pixel + k*nskypix) = dc(pixel + k*nskypix) + c * diff * diff_weight(j)
+                        ds(pixel + k*nskypix) = ds(pixel + k*nskypix) + s * diff * diff_weight(j)
+                    enddo
                 endif
             enddo
         enddo
 
     end subroutine
 
+    subroutine pair_accumulate_order_f(d, w, dc, ds, cc, cs, ss, nhit, &
+    waferi1d, wafercos, wafersin, waferts, diff_weight, sum_weight, npix, nt, &
+    nskypix, nsky, sumdiff, order, klo, khi)
+        implicit none
+        ! Projection of the samples order(klo:khi) (see bucket_samples_f).
+        ! See tod2map_pair_f.
+
+        integer, parameter       :: I4B = 4
+        integer, parameter       :: DP = 8
+
+        integer(I4B), intent(in) :: npix, nt, nskypix, nsky, sumdiff
+        integer(I4B), intent(in) :: klo, khi
+        integer(I4B), intent(in) :: waferi1d(0:npix*nt - 1)
+        integer(I4B), intent(in) :: order(0:npix*nt - 1)
+        real(DP), intent(in)     :: wafercos(0:npix*nt - 1), wafersin(0:npix*nt - 1)
+        real(DP), intent(in)     :: waferts(0:npix*nt*2*nsky - 1)
+        real(DP), intent(in)     :: diff_weight(0:npix - 1), sum_weight(0:npix - 1)
+
+        real(DP), intent(inout)  :: d(0:nskypix*nsky - 1), w(0:nskypix - 1)
+        real(DP), intent(inout)  :: dc(0:nskypix*nsky - 1), ds(0:nskypix*nsky - 1)
+        real(DP), intent(inout)  :: cc(0:nskypix - 1)
+        real(DP), intent(inout)  :: cs(0:nskypix - 1), ss(0:nskypix - 1)
+        integer(I4B), intent(inout) :: nhit(0:nskypix - 1)
+
+        integer(I4B)             :: i, j, k, m, ipix, pixel
+        integer(I4B)             :: ict, icb
+        real(DP)                 :: sum, diff, c, s
+
+        do m=klo, khi
+            ipix = order(m)
+            j = ipix / nt
+            i = ipix - j * nt
+            pixel = waferi1d(ipix)
+            c = wafercos(ipix)
+            s = wafersin(ipix)
+
+            nhit(pixel) = nhit(pixel) + 1
+            w(pixel) = w(pixel) + sum_weight(j)
+
+            cc(pixel) = cc(pixel) + c * c * diff_weight(j)
+            cs(pixel) = cs(pixel) + c * s * diff_weight(j)
+            ss(pixel) = ss(pixel) + s * s * diff_weight(j)
+
+            do k=0, nsky - 1
+                ict = i + (2*j*nsky + k)*nt
+                icb = i + ((2*j + 1)*nsky + k)*nt
+
+                if (sumdiff .gt. 0) then
+                    sum = waferts(ict)
+                    diff = waferts(icb)
+                else
+                    sum = 0.5*(waferts(ict) + waferts(icb))
+                    diff = 0.5*(waferts(ict) - waferts(icb))
+                endif
+
+                d(pixel + k*nskypix) = d(pixel + k*nskypix) + sum * sum_weight(j)
+                dc(pixel + k*nskypix) = dc(pixel + k*nskypix) + c * diff * diff_weight(j)
+                ds(pixel + k*nskypix) = ds(pixel + k*nskypix) + s * diff * diff_weight(j)
+            enddo
+        enddo
+
+    end subroutine
+
     subroutine tod2map_hwp_f(d0, d4r, d4i, w0, w4, nhit, waferi1d, &
-    waferpa, waferts, weight4, weight0, npix, nt, &
-    wafermask_pixel, nskypix)
+    wafercos, wafersin, waferts, weight4, weight0, npix, nt, &
+    wafermask_pixel, nskypix, nthreads, strategy)
         implicit none
+        ! With nthreads > 1, the projection is shared among OpenMP threads,
+        ! see tod2map_pair_f for the strategies.
 
         integer, parameter       :: I4B = 4
         integer, parameter       :: DP = 8
-        real(DP), parameter      :: pi = 3.141592
 
-        integer(I4B), intent(in) :: npix, nt, nskypix
+        integer(I4B), intent(in) :: npix, nt, nskypix, nthreads, strategy
         integer(I4B), intent(in) :: waferi1d(0:npix*nt - 1), wafermask_pixel(0:npix*nt - 1)
-        real(DP), intent(in)     :: waferpa(0:npix*nt - 1), waferts(0:npix*nt*3*2 - 1)
+        real(DP), intent(in)     :: wafercos(0:npix*nt - 1), wafersin(0:npix*nt - 1)
+        real(DP), intent(in)     :: waferts(0:npix*nt*3*2 - 1)
+        real(DP), intent(in)     :: weight0(0:npix - 1), weight4(0:npix - 1)
+
+        real(DP), intent(inout)  :: d0(0:nskypix - 1), d4r(0:nskypix - 1), d4i(0:nskypix - 1)
+        real(DP), intent(inout)  :: w0(0:nskypix - 1), w4(0:nskypix - 1)
+        integer(I4B), intent(inout) :: nhit(0:nskypix - 1)
+
+        integer(I4B)             :: tid, nth, jlo, jhi, b
+        integer(I4B), allocatable :: offsets(:), order(:)
+        real(DP), allocatable    :: d0_p(:), d4r_p(:), d4i_p(:), w0_p(:), w4_p(:)
+        integer(I4B), allocatable :: nhit_p(:)
+
+        if (nthreads .le. 1) then
+            call hwp_accumulate_f(d0, d4r, d4i, w0, w4, nhit, waferi1d, &
+            wafercos, wafersin, waferts, weight4, weight0, npix, nt, &
+            wafermask_pixel, nskypix, 0, npix - 1)
+        else if (strategy .eq. 2) then
+            allocate(offsets(0:nthreads), order(0:npix*nt - 1))
+            call bucket_samples_f(waferi1d, wafermask_pixel, npix*nt, &
+            nskypix, nthreads, offsets, order)
+            !$omp parallel num_threads(nthreads) private(tid, nth, b)
+            tid = 0
+            nth = 1
+            !$ tid = omp_get_thread_num()
+            !$ nth = omp_get_num_threads()
+            do b=tid, nthreads - 1, nth
+                call hwp_accumulate_order_f(d0, d4r, d4i, w0, w4, nhit, &
+                waferi1d, wafercos, wafersin, waferts, weight4, weight0, &
+                npix, nt, nskypix, order, offsets(b), offsets(b + 1) - 1)
+            enddo
+            !$omp end parallel
+            deallocate(offsets, order)
+        else
+            !$omp parallel num_threads(nthreads) private(tid, nth, jlo, jhi, &
+            !$omp d0_p, d4r_p, d4i_p, w0_p, w4_p, nhit_p)
+            tid = 0
+            nth = 1
+            !$ tid = omp_get_thread_num()
+            !$ nth = omp_get_num_threads()
+            jlo = tid * npix / nth
+            jhi = (tid + 1) * npix / nth - 1
+            allocate(d0_p(0:nskypix - 1), d4r_p(0:nskypix - 1))
+            allocate(d4i_p(0:nskypix - 1), w0_p(0:nskypix - 1))
+            allocate(w4_p(0:nskypix - 1), nhit_p(0:nskypix - 1))
+            d0_p = 0.0
+            d4r_p = 0.0
+            d4i_p = 0.0
+            w0_p = 0.0
+            w4_p = 0.0
+            nhit_p = 0
+            call hwp_accumulate_f(d0_p, d4r_p, d4i_p, w0_p, w4_p, nhit_p, &
+            waferi1d, wafercos, wafersin, waferts, weight4, weight0, npix, nt, &
+            wafermask_pixel, nskypix, jlo, jhi)
+            !$omp critical
+            d0 = d0 + d0_p
+            d4r = d4r + d4r_p
+            d4i = d4i + d4i_p
+            w0 = w0 + w0_p
+            w4 = w4 + w4_p
+            nhit = nhit + nhit_p
+            !$omp end critical
+            deallocate(d0_p, d4r_p, d4i_p, w0_p, w4_p, nhit_p)
+            !$omp end parallel
+        endif
+    end subroutine
+
+    subroutine hwp_accumulate_f(d0, d4r, d4i, w0, w4, nhit, waferi1d, &
+    wafercos, wafersin, waferts, weight4, weight0, npix, nt, &
+    wafermask_pixel, nskypix, jlo, jhi)
+        implicit none
+        ! Projection of pairs [jlo, jhi].
+        ! See tod2map_hwp_f.
+
+        integer, parameter       :: I4B = 4
+        integer, parameter       :: DP = 8
+
+        integer(I4B), intent(in) :: npix, nt, nskypix, jlo, jhi
+        integer(I4B), intent(in) :: waferi1d(0:npix*nt - 1), wafermask_pixel(0:npix*nt - 1)
+        real(DP), intent(in)     :: wafercos(0:npix*nt - 1), wafersin(0:npix*nt - 1)
+        real(DP), intent(in)     :: waferts(0:npix*nt*3*2 - 1)
         real(DP), intent(in)     :: weight0(0:npix - 1), weight4(0:npix - 1)
 
         real(DP), intent(inout)  :: d0(0:nskypix - 1), d4r(0:nskypix - 1), d4i(0:nskypix - 1)
@@ -83,18 +345,17 @@ contains
         integer(I4B)             :: if0, i4r, i4i
         real(DP)                 :: c, s
 
-        do j=0, npix - 1
+        do j=jlo, jhi
             do i=0, nt - 1
                 ipix = i + j*nt
-                if (wafermask_pixel(ipix) .gt. 0 .and. waferi1d(ipix) .gt. 0) then
+                pixel = waferi1d(ipix)
+                if (wafermask_pixel(ipix) .gt. 0 .and. pixel .ge. 0) then
                     if0 = i + j*3*nt
                     i4r = i + nt + j*3*nt
                     i4i = i + nt*2 + j*3*nt
 
-                    pixel = waferi1d(ipix)
-
-                    c = cos(2.0*waferpa(ipix))
-                    s = sin(2.0*waferpa(ipix))
+                    c = wafercos(ipix)
+                    s = wafersin(ipix)
 
                     nhit(pixel) = nhit(pixel) + 1
 
@@ -108,4 +369,542 @@ contains
         enddo
     end subroutine
 
+    subroutine hwp_accumulate_order_f(d0, d4r, d4i, w0, w4, nhit, &
+    waferi1d, wafercos, wafersin, waferts, weight4, weight0, &
+    npix, nt, nskypix, order, klo, khi)
+        implicit none
+        ! Projection of the samples order(klo:khi) (see bucket_samples_f).
+        ! See tod2map_hwp_f.
+
+        integer, parameter       :: I4B = 4
+        integer, parameter       :: DP = 8
+
+        integer(I4B), intent(in) :: npix, nt, nskypix, klo, khi
+        integer(I4B), intent(in) :: waferi1d(0:npix*nt - 1), order(0:npix*nt - 1)
+        real(DP), intent(in)     :: wafercos(0:npix*nt - 1), wafersin(0:npix*nt - 1)
+        real(DP), intent(in)     :: waferts(0:npix*nt*3*2 - 1)
+        real(DP), intent(in)     :: weight0(0:npix - 1), weight4(0:npix - 1)
+
+        real(DP), intent(inout)  :: d0(0:nskypix - 1), d4r(0:nskypix - 1), d4i(0:nskypix - 1)
+        real(DP), intent(inout)  :: w0(0:nskypix - 1), w4(0:nskypix - 1)
+        integer(I4B), intent(inout) :: nhit(0:nskypix - 1)
+
+        integer(I4B)             :: i, j, m, ipix
+        integer(I4B)             :: pixel
+        integer(I4B)             :: if0, i4r, i4i
+        real(DP)                 :: c, s
+
+        do m=klo, khi
+            ipix = order(m)
+            j = ipix / nt
+            i = ipix - j*nt
+            pixel = waferi1d(ipix)
+            if0 = i + j*3*nt
+            i4r = i + nt + j*3*nt
+            i4i = i + nt*2 + j*3*nt
+
+            c = wafercos(ipix)
+            s = wafersin(ipix)
+
+            nhit(pixel) = nhit(pixel) + 1
+
+            w0(pixel) = w0(pixel) + weight0(j)
+            w4(pixel) = w4(pixel) + weight4(j)
+            d0(pixel) = d0(pixel)+ waferts(if0) * weight0(j)
+            d4r(pixel) = d4r(pixel) + (c*waferts(i4r)+s*waferts(i4i)) * weight4(j)
+            d4i(pixel) = d4i(pixel) + (s*waferts(i4r)-c*waferts(i4i)) * weight4(j)
+        enddo
+    end subroutine
+
+    subroutine tod2map_pair_f_sp(d, w, dc, ds, cc, cs, ss, nhit, waferi1d, &
+    wafercos, wafersin, waferts, diff_weight, sum_weight, npix, nt, &
+    wafermask_pixel, nskypix, nsky, sumdiff, nthreads, strategy)
+        implicit none
+        ! Single precision version of tod2map_pair_f.
+        ! Timestreams and modulation are real(4), accumulation is done in real(8).
+
+        integer, parameter       :: I4B = 4
+        integer, parameter       :: DP = 8
+        integer, parameter       :: SP = 4
+
+        integer(I4B), intent(in) :: npix, nt, nskypix, nsky, sumdiff
+        integer(I4B), intent(in) :: nthreads, strategy
+        integer(I4B), intent(in) :: waferi1d(0:npix*nt - 1)
+        integer(I4B), intent(in) :: wafermask_pixel(0:npix*nt - 1)
+        real(SP), intent(in)     :: wafercos(0:npix*nt - 1), wafersin(0:npix*nt - 1)
+        real(SP), intent(in)     :: waferts(0:npix*nt*2*nsky - 1)
+        real(DP), intent(in)     :: diff_weight(0:npix - 1), sum_weight(0:npix - 1)
+
+        real(DP), intent(inout)  :: d(0:nskypix*nsky - 1), w(0:nskypix - 1)
+        real(DP), intent(inout)  :: dc(0:nskypix*nsky - 1), ds(0:nskypix*nsky - 1)
+        real(DP), intent(inout)  :: cc(0:nskypix - 1)
+        real(DP), intent(inout)  :: cs(0:nskypix - 1), ss(0:nskypix - 1)
+        integer(I4B), intent(inout) :: nhit(0:nskypix - 1)
+
+        integer(I4B)             :: tid, nth, jlo, jhi, b
+        integer(I4B), allocatable :: offsets(:), order(:)
+        real(DP), allocatable    :: d_p(:), w_p(:), dc_p(:), ds_p(:)
+        real(DP), allocatable    :: cc_p(:), cs_p(:), ss_p(:)
+        integer(I4B), allocatable :: nhit_p(:)
+
+        if (nthreads .le. 1) then
+            call pair_accumulate_f_sp(d, w, dc, ds, cc, cs, ss, nhit, waferi1d, &
+            wafercos, wafersin, waferts, diff_weight, sum_weight, npix, nt, &
+            wafermask_pixel, nskypix, nsky, sumdiff, 0, npix - 1)
+        else if (strategy .eq. 2) then
+            allocate(offsets(0:nthreads), order(0:npix*nt - 1))
+            call bucket_samples_f(waferi1d, wafermask_pixel, npix*nt, &
+            nskypix, nthreads, offsets, order)
+            !$omp parallel num_threads(nthreads) private(tid, nth, b)
+            tid = 0
+            nth = 1
+            !$ tid = omp_get_thread_num()
+            !$ nth = omp_get_num_threads()
+            do b=tid, nthreads - 1, nth
+                call pair_accumulate_order_f_sp(d, w, dc, ds, cc, cs, ss, nhit, &
+                waferi1d, wafercos, wafersin, waferts, diff_weight, &
+                sum_weight, npix, nt, nskypix, nsky, sumdiff, order, &
+                offsets(b), offsets(b + 1) - 1)
+            enddo
+            !$omp end parallel
+            deallocate(offsets, order)
+        else
+            !$omp parallel num_threads(nthreads) private(tid, nth, jlo, jhi, &
+            !$omp d_p, w_p, dc_p, ds_p, cc_p, cs_p, ss_p, nhit_p)
+            tid = 0
+            nth = 1
+            !$ tid = omp_get_thread_num()
+            !$ nth = omp_get_num_threads()
+            jlo = tid * npix / nth
+            jhi = (tid + 1) * npix / nth - 1
+            allocate(d_p(0:nskypix*nsky - 1), dc_p(0:nskypix*nsky - 1))
+            allocate(ds_p(0:nskypix*nsky - 1), w_p(0:nskypix - 1))
+            allocate(cc_p(0:nskypix - 1), cs_p(0:nskypix - 1))
+            allocate(ss_p(0:nskypix - 1), nhit_p(0:nskypix - 1))
+            d_p = 0.0
+            w_p = 0.0
+            dc_p = 0.0
+            ds_p = 0.0
+            cc_p = 0.0
+            cs_p = 0.0
+            ss_p = 0.0
+            nhit_p = 0
+            call pair_accumulate_f_sp(d_p, w_p, dc_p, ds_p, cc_p, cs_p, ss_p, &
+            nhit_p, waferi1d, wafercos, wafersin, waferts, diff_weight, &
+            sum_weight, npix, nt, wafermask_pixel, nskypix, nsky, sumdiff, &
+            jlo, jhi)
+            !$omp critical
+            d = d + d_p
+            w = w + w_p
+            dc = dc + dc_p
+            ds = ds + ds_p
+            cc = cc + cc_p
+            cs = cs + cs_p
+            ss = ss + ss_p
+            nhit = nhit + nhit_p
+            !$omp end critical
+            deallocate(d_p, w_p, dc_p, ds_p, cc_p, cs_p, ss_p, nhit_p)
+            !$omp end parallel
+        endif
+
+    end subroutine
+
+    subroutine pair_accumulate_f_sp(d, w, dc, ds, cc, cs, ss, nhit, waferi1d, &
+    wafercos, wafersin, waferts, diff_weight, sum_weight, npix, nt, &
+    wafermask_pixel, nskypix, nsky, sumdiff, jlo, jhi)
+        implicit none
+        ! Projection of pairs [jlo, jhi].
+        ! See tod2map_pair_f_sp.
+
+        integer, parameter       :: I4B = 4
+        integer, parameter       :: DP = 8
+        integer, parameter       :: SP = 4
+
+        integer(I4B), intent(in) :: npix, nt, nskypix, nsky, sumdiff
+        integer(I4B), intent(in) :: jlo, jhi
+        integer(I4B), intent(in) :: waferi1d(0:npix*nt - 1)
+        integer(I4B), intent(in) :: wafermask_pixel(0:npix*nt - 1)
+        real(SP), intent(in)     :: wafercos(0:npix*nt - 1), wafersin(0:npix*nt - 1)
+        real(SP), intent(in)     :: waferts(0:npix*nt*2*nsky - 1)
+        real(DP), intent(in)     :: diff_weight(0:npix - 1), sum_weight(0:npix - 1)
+
+        real(DP), intent(inout)  :: d(0:nskypix*nsky - 1), w(0:nskypix - 1)
+        real(DP), intent(inout)  :: dc(0:nskypix*nsky - 1), ds(0:nskypix*nsky - 1)
+        real(DP), intent(inout)  :: cc(0:nskypix - 1)
+        real(DP), intent(inout)  :: cs(0:nskypix - 1), ss(0:nskypix - 1)
+        integer(I4B), intent(inout) :: nhit(0:nskypix - 1)
+
+        integer(I4B)             :: i, j, k, ipix, pixel
+        integer(I4B)             :: ict, icb
+        real(DP)                 :: sum, diff, c, s
+
+        do j=jlo, jhi
+            do i=0, nt - 1
+                ipix = i + j * nt
+                pixel = waferi1d(ipix)
+                if (wafermask_pixel(ipix) .gt. 0 .and. pixel .ge. 0) then
+                    c = real(wafercos(ipix), DP)
+                    s = real(wafersin(ipix), DP)
+
+                    nhit(pixel) = nhit(pixel) + 1
+                    w(pixel) = w(pixel) + sum_weight(j)
+
+                    cc(pixel) = cc(pixel) + c * c * diff_weight(j)
+                    cs(pixel) = cs(pixel) + c * s * diff_weight(j)
+                    ss(pixel) = ss(pixel) + s * s * diff_weight(j)
+
+                    do k=0, nsky - 1
+                        ict = i + (2*j*nsky + k)*nt
+                        icb = i + ((2*j + 1)*nsky + k)*nt
+
+                        if (sumdiff .gt. 0) then
+                            sum = real(waferts(ict), DP)
+                            diff = real(waferts(icb), DP)
+                        else
+                            sum = 0.5*(real(waferts(ict), DP) + real(waferts(icb), DP))
+                            diff = 0.5*(real(waferts(ict), DP) - real(waferts(icb), DP))
+                        endif
+
+                        d(pixel + k*nskypix) = d(pixel + k*nskypix) + sum * sum_weight(j)
+                        dc(pixel + k*nskypix) = dc(pixel + k*nskypix) + c * diff * diff_weight(j)
+                        ds(pixel + k*nskypix) = ds(pixel + k*nskypix) + s * diff * diff_weight(j)
+                    enddo
+                endif
+            enddo
+        enddo
+
+    end subroutine
+
+    subroutine pair_accumulate_order_f_sp(d, w, dc, ds, cc, cs, ss, nhit, &
+    waferi1d, wafercos, wafersin, waferts, diff_weight, sum_weight, npix, nt, &
+    nskypix, nsky, sumdiff, order, klo, khi)
+        implicit none
+        ! Projection of the samples order(klo:khi) (see bucket_samples_f).
+        ! See tod2map_pair_f_sp.
+
+        integer, parameter       :: I4B = 4
+        integer, parameter       :: DP = 8
+        integer, parameter       :: SP = 4
+
+        integer(I4B), intent(in) :: npix, nt, nskypix, nsky, sumdiff
+        integer(I4B), intent(in) :: klo, khi
+        integer(I4B), intent(in) :: waferi1d(0:npix*nt - 1)
+        integer(I4B), intent(in) :: order(0:npix*nt - 1)
+        real(SP), intent(in)     :: wafercos(0:npix*nt - 1), wafersin(0:npix*nt - 1)
+        real(SP), intent(in)     :: waferts(0:npix*nt*2*nsky - 1)
+        real(DP), intent(in)     :: diff_weight(0:npix - 1), sum_weight(0:npix - 1)
+
+        real(DP), intent(inout)  :: d(0:nskypix*nsky - 1), w(0:nskypix - 1)
+        real(DP), intent(inout)  :: dc(0:nskypix*nsky - 1), ds(0:nskypix*nsky - 1)
+        real(DP), intent(inout)  :: cc(0:nskypix - 1)
+        real(DP), intent(inout)  :: cs(0:nskypix - 1), ss(0:nskypix - 1)
+        integer(I4B), intent(inout) :: nhit(0:nskypix - 1)
+
+        integer(I4B)             :: i, j, k, m, ipix, pixel
+        integer(I4B)             :: ict, icb
+        real(DP)                 :: sum, diff, c, s
+
+        do m=klo, khi
+            ipix = order(m)
+            j = ipix / nt
+            i = ipix - j * nt
+            pixel = waferi1d(ipix)
+            c = real(wafercos(ipix), DP)
+            s = real(wafersin(ipix), DP)
+
+            nhit(pixel) = nhit(pixel) + 1
+            w(pixel) = w(pixel) + sum_weight(j)
+
+            cc(pixel) = cc(pixel) + c * c * diff_weight(j)
+            cs(pixel) = cs(pixel) + c * s * diff_weight(j)
+            ss(pixel) = ss(pixel) + s * s * diff_weight(j)
+
+            do k=0, nsky - 1
+                ict = i + (2*j*nsky + k)*nt
+                icb = i + ((2*j + 1)*nsky + k)*nt
+
+                if (sumdiff .gt. 0) then
+                    sum = real(waferts(ict), DP)
+                    diff = real(waferts(icb), DP)
+                else
+                    sum = 0.5*(real(waferts(ict), DP) + real(waferts(icb), DP))
+                    diff = 0.5*(real(waferts(ict), DP) - real(waferts(icb), DP))
+                endif
+
+                d(pixel + k*nskypix) = d(pixel + k*nskypix) + sum * sum_weight(j)
+                dc(pixel + k*nskypix) = dc(pixel + k*nskypix) + c * diff * diff_weight(j)
+                ds(pixel + k*nskypix) = ds(pixel + k*nskypix) + s * diff * diff_weight(j)
+            enddo
+        enddo
+
+    end subroutine
+
+    subroutine tod2map_hwp_f_sp(d0, d4r, d4i, w0, w4, nhit, waferi1d, &
+    wafercos, wafersin, waferts, weight4, weight0, npix, nt, &
+    wafermask_pixel, nskypix, nthreads, strategy)
+        implicit none
+        ! Single precision version of tod2map_hwp_f.
+        ! Timestreams and modulation are real(4), accumulation is done in real(8).
+
+        integer, parameter       :: I4B = 4
+        integer, parameter       :: DP = 8
+        integer, parameter       :: SP = 4
+
+        integer(I4B), intent(in) :: npix, nt, nskypix, nthreads, strategy
+        integer(I4B), intent(in) :: waferi1d(0:npix*nt - 1), wafermask_pixel(0:npix*nt - 1)
+        real(SP), intent(in)     :: wafercos(0:npix*nt - 1), wafersin(0:npix*nt - 1)
+        real(SP), intent(in)     :: waferts(0:npix*nt*3*2 - 1)
+        real(DP), intent(in)     :: weight0(0:npix - 1), weight4(0:npix - 1)
+
+        real(DP), intent(inout)  :: d0(0:nskypix - 1), d4r(0:nskypix - 1), d4i(0:nskypix - 1)
+        real(DP), intent(inout)  :: w0(0:nskypix - 1), w4(0:nskypix - 1)
+        integer(I4B), intent(inout) :: nhit(0:nskypix - 1)
+
+        integer(I4B)             :: tid, nth, jlo, jhi, b
+        integer(I4B), allocatable :: offsets(:), order(:)
+        real(DP), allocatable    :: d0_p(:), d4r_p(:), d4i_p(:), w0_p(:), w4_p(:)
+        integer(I4B), allocatable :: nhit_p(:)
+
+        if (nthreads .le. 1) then
+            call hwp_accumulate_f_sp(d0, d4r, d4i, w0, w4, nhit, waferi1d, &
+            wafercos, wafersin, waferts, weight4, weight0, npix, nt, &
+            wafermask_pixel, nskypix, 0, npix - 1)
+        else if (strategy .eq. 2) then
+            allocate(offsets(0:nthreads), order(0:npix*nt - 1))
+            call bucket_samples_f(waferi1d, wafermask_pixel, npix*nt, &
+            nskypix, nthreads, offsets, order)
+            !$omp parallel num_threads(nthreads) private(tid, nth, b)
+            tid = 0
+            nth = 1
+            !$ tid = omp_get_thread_num()
+            !$ nth = omp_get_num_threads()
+            do b=tid, nthreads - 1, nth
+                call hwp_accumulate_order_f_sp(d0, d4r, d4i, w0, w4, nhit, &
+                waferi1d, wafercos, wafersin, waferts, weight4, weight0, &
+                npix, nt, nskypix, order, offsets(b), offsets(b + 1) - 1)
+            enddo
+            !$omp end parallel
+            deallocate(offsets, order)
+        else
+            !$omp parallel num_threads(nthreads) private(tid, nth, jlo, jhi, &
+            !$omp d0_p, d4r_p, d4i_p, w0_p, w4_p, nhit_p)
+            tid = 0
+            nth = 1
+            !$ tid = omp_get_thread_num()
+            !$ nth = omp_get_num_threads()
+            jlo = tid * npix / nth
+            jhi = (tid + 1) * npix / nth - 1
+            allocate(d0_p(0:nskypix - 1), d4r_p(0:nskypix - 1))
+            allocate(d4i_p(0:nskypix - 1), w0_p(0:nskypix - 1))
+            allocate(w4_p(0:nskypix - 1), nhit_p(0:nskypix - 1))
+            d0_p = 0.0
+            d4r_p = 0.0
+            d4i_p = 0.0
+            w0_p = 0.0
+            w4_p = 0.0
+            nhit_p = 0
+            call hwp_accumulate_f_sp(d0_p, d4r_p, d4i_p, w0_p, w4_p, nhit_p, &
+            waferi1d, wafercos, wafersin, waferts, weight4, weight0, npix, nt, &
+            wafermask_pixel, nskypix, jlo, jhi)
+            !$omp critical
+            d0 = d0 + d0_p
+            d4r = d4r + d4r_p
+            d4i = d4i + d4i_p
+            w0 = w0 + w0_p
+            w4 = w4 + w4_p
+            nhit = nhit + nhit_p
+            !$omp end critical
+            deallocate(d0_p, d4r_p, d4i_p, w0_p, w4_p, nhit_p)
+            !$omp end parallel
+        endif
+    end subroutine
+
+    subroutine hwp_accumulate_f_sp(d0, d4r, d4i, w0, w4, nhit, waferi1d, &
+    wafercos, wafersin, waferts, weight4, weight0, npix, nt, &
+    wafermask_pixel, nskypix, jlo, jhi)
+        implicit none
+        ! Projection of pairs [jlo, jhi].
+        ! See tod2map_hwp_f_sp.
+
+        integer, parameter       :: I4B = 4
+        integer, parameter       :: DP = 8
+        integer, parameter       :: SP = 4
+
+        integer(I4B), intent(in) :: npix, nt, nskypix, jlo, jhi
+        integer(I4B), intent(in) :: waferi1d(0:npix*nt - 1), wafermask_pixel(0:npix*nt - 1)
+        real(SP), intent(in)     :: wafercos(0:npix*nt - 1), wafersin(0:npix*nt - 1)
+        real(SP), intent(in)     :: waferts(0:npix*nt*3*2 - 1)
+        real(DP), intent(in)     :: weight0(0:npix - 1), weight4(0:npix - 1)
+
+        real(DP), intent(inout)  :: d0(0:nskypix - 1), d4r(0:nskypix - 1), d4i(0:nskypix - 1)
+        real(DP), intent(inout)  :: w0(0:nskypix - 1), w4(0:nskypix - 1)
+        integer(I4B), intent(inout) :: nhit(0:nskypix - 1)
+
+        integer(I4B)             :: i, j, ipix
+        integer(I4B)             :: pixel
+        integer(I4B)             :: if0, i4r, i4i
+        real(DP)                 :: c, s, t0, t4r, t4i
+
+        do j=jlo, jhi
+            do i=0, nt - 1
+                ipix = i + j*nt
+                pixel = waferi1d(ipix)
+                if (wafermask_pixel(ipix) .gt. 0 .and. pixel .ge. 0) then
+                    if0 = i + j*3*nt
+                    i4r = i + nt + j*3*nt
+                    i4i = i + nt*2 + j*3*nt
+
+                    c = real(wafercos(ipix), DP)
+                    s = real(wafersin(ipix), DP)
+
+                    nhit(pixel) = nhit(pixel) + 1
+
+                    w0(pixel) = w0(pixel) + weight0(j)
+                    w4(pixel) = w4(pixel) + weight4(j)
+                    t0 = real(waferts(if0), DP)
+                    t4r = real(waferts(i4r), DP)
+                    t4i = real(waferts(i4i), DP)
+                    d0(pixel) = d0(pixel)+ t0 * weight0(j)
+                    d4r(pixel) = d4r(pixel) + (c*t4r+s*t4i) * weight4(j)
+                    d4i(pixel) = d4i(pixel) + (s*t4r-c*t4i) * weight4(j)
+                endif
+            enddo
+        enddo
+    end subroutine
+
+    subroutine hwp_accumulate_order_f_sp(d0, d4r, d4i, w0, w4, nhit, &
+    waferi1d, wafercos, wafersin, waferts, weight4, weight0, &
+    npix, nt, nskypix, order, klo, khi)
+        implicit none
+        ! Projection of the samples order(klo:khi) (see bucket_samples_f).
+        ! See tod2map_hwp_f_sp.
+
+        integer, parameter       :: I4B = 4
+        integer, parameter       :: DP = 8
+        integer, parameter       :: SP = 4
+
+        integer(I4B), intent(in) :: npix, nt, nskypix, klo, khi
+        integer(I4B), intent(in) :: waferi1d(0:npix*nt - 1), order(0:npix*nt - 1)
+        real(SP), intent(in)     :: wafercos(0:npix*nt - 1), wafersin(0:npix*nt - 1)
+        real(SP), intent(in)     :: waferts(0:npix*nt*3*2 - 1)
+        real(DP), intent(in)     :: weight0(0:npix - 1), weight4(0:npix - 1)
+
+        real(DP), intent(inout)  :: d0(0:nskypix - 1), d4r(0:nskypix - 1), d4i(0:nskypix - 1)
+        real(DP), intent(inout)  :: w0(0:nskypix - 1), w4(0:nskypix - 1)
+        integer(I4B), intent(inout) :: nhit(0:nskypix - 1)
+
+        integer(I4B)             :: i, j, m, ipix
+        integer(I4B)             :: pixel
+        integer(I4B)             :: if0, i4r, i4i
+        real(DP)                 :: c, s, t0, t4r, t4i
+
+        do m=klo, khi
+            ipix = order(m)
+            j = ipix / nt
+            i = ipix - j*nt
+            pixel = waferi1d(ipix)
+            if0 = i + j*3*nt
+            i4r = i + nt + j*3*nt
+            i4i = i + nt*2 + j*3*nt
+
+            c = real(wafercos(ipix), DP)
+            s = real(wafersin(ipix), DP)
+
+            nhit(pixel) = nhit(pixel) + 1
+
+            w0(pixel) = w0(pixel) + weight0(j)
+            w4(pixel) = w4(pixel) + weight4(j)
+            t0 = real(waferts(if0), DP)
+            t4r = real(waferts(i4r), DP)
+            t4i = real(waferts(i4i), DP)
+            d0(pixel) = d0(pixel)+ t0 * weight0(j)
+            d4r(pixel) = d4r(pixel) + (c*t4r+s*t4i) * weight4(j)
+            d4i(pixel) = d4i(pixel) + (s*t4r-c*t4i) * weight4(j)
+        enddo
+    end subroutine
+
+    subroutine bucket_samples_f(waferi1d, wafermask_pixel, n, nskypix, &
+    nbuckets, offsets, order)
+        implicit none
+        ! Counting sort of the unmasked samples by range of sky pixels
+        ! (samples outside the patch, with pixel -1, are dropped):
+        ! bucket b holds the samples falling into pixels
+        ! [b*nskypix/nbuckets, (b+1)*nskypix/nbuckets[, and its samples
+        ! are order(offsets(b):offsets(b+1) - 1), in increasing order.
+
+        integer, parameter       :: I4B = 4
+        integer, parameter       :: I8B = 8
+
+        integer(I4B), intent(in) :: n, nskypix, nbuckets
+        integer(I4B), intent(in) :: waferi1d(0:n - 1), wafermask_pixel(0:n - 1)
+        integer(I4B), intent(out) :: offsets(0:nbuckets), order(0:n - 1)
+
+        integer(I4B)             :: ipix, b
+        integer(I4B), allocatable :: pos(:)
+
+        offsets = 0
+        do ipix=0, n - 1
+            if (wafermask_pixel(ipix) .gt. 0 .and. waferi1d(ipix) .ge. 0) then
+                b = int(int(waferi1d(ipix), I8B) * nbuckets / nskypix, I4B)
+                offsets(b + 1) = offsets(b + 1) + 1
+            endif
+        enddo
+        do b=1, nbuckets
+            offsets(b) = offsets(b) + offsets(b - 1)
+        enddo
+
+        allocate(pos(0:nbuckets - 1))
+        pos = offsets(0:nbuckets - 1)
+        do ipix=0, n - 1
+            if (wafermask_pixel(ipix) .gt. 0 .and. waferi1d(ipix) .ge. 0) then
+                b = int(int(waferi1d(ipix), I8B) * nbuckets / nskypix, I4B)
+                order(pos(b)) = ipix
+                pos(b) = pos(b) + 1
+            endif
+        enddo
+        deallocate(pos)
+
+    end subroutine
+
+    subroutine local_indices_f(pixels, rings, table, n, nrings, index)
+        implicit none
+        ! Position of full sky pixels (RING ordering) in the sorted array of
+        ! observed pixels, using the ring-offset table of the observed
+        ! pixels (see input_sky.get_ring_offsets). For each ring,
+        ! table(0:5, ring) contains the first pixel of the ring, its number
+        ! of pixels, the offset of the first observed pixel of the range,
+        ! the number of observed pixels, the number of observed pixels
+        ! wrapped at the beginning of the ring, and the position of the
+        ! first observed pixel of the ring. -1 for pixels not observed.
+
+        integer, parameter       :: I4B = 4
+        integer, parameter       :: I8B = 8
+
+        integer(I4B), intent(in) :: n, nrings
+        integer(I8B), intent(in) :: pixels(0:n - 1), rings(0:n - 1)
+        integer(I8B), intent(in) :: table(0:5, 0:nrings - 1)
+        integer(I4B), intent(out) :: index(0:n - 1)
+
+        integer(I4B)             :: ipix
+        integer(I8B)             :: ring, k
+
+        do ipix=0, n - 1
+            ring = rings(ipix)
+            k = pixels(ipix) - table(0, ring)
+            if (k .ge. table(2, ring)) then
+                k = k - table(2, ring)
+                if (k .lt. table(3, ring) - table(4, ring)) then
+                    index(ipix) = int(table(5, ring) + table(4, ring) + k, I4B)
+                else
+                    index(ipix) = -1
+                endif
+            else if (k .lt. table(4, ring)) then
+                index(ipix) = int(table(5, ring) + k, I4B)
+            else
+                index(ipix) = -1
+            endif
+        enddo
+
+    end subroutine
+
 end module
@@ -3,12 +3,58 @@
 # Licensed under the GPL-3.0 License, see LICENSE file for details.
 
 ## A bit wacky... Wheel perhaps?
+import os
+import shutil
+import subprocess
+import tempfile
+
 from setuptools import find_packages
 from numpy.distutils.core import setup
 from numpy.distutils.misc_util import Configuration
 
+def has_openmp(compiler=None):
+    """
+    Check whether the Fortran compiler builds and links OpenMP code.
+
+    Set S4CMB_OPENMP=0 to build serial routines without trying,
+    and F90 to choose the compiler (default gfortran).
+
+    Returns
+    ----------
+    has_omp : bool
+        True if the OpenMP flags can be used.
+    """
+    if os.environ.get('S4CMB_OPENMP', '1') == '0':
+        return False
+    if compiler is None:
+        compiler = os.environ.get('F90', 'gfortran')
+    tmpdir = tempfile.mkdtemp()
+    try:
+        source = os.path.join(tmpdir, 'omp_test.f90')
+        with open(source, 'w') as f:
+            f.write('program omp_test\n'
+                    '  use omp_lib\n'
+                    '  print *, omp_get_max_threads()\n'
+                    'end program omp_test\n')
+        with open(os.devnull, 'w') as devnull:
+            code = subprocess.call(
+                [compiler, '-fopenmp', source, '-o',
+                 os.path.join(tmpdir, 'omp_test')],
+                cwd=tmpdir, stdout=devnull, stderr=devnull)
+        return code == 0
+    except OSError:
+        return False
+    finally:
+        shutil.rmtree(tmpdir)
+
 def configuration(parent_package='', top_path=None):
     config = Configuration('s4cmb', parent_package, top_path)
+
+    ## Threaded tod_f if OpenMP is available, serial otherwise
+    if has_openmp():
+        omp_libraries, omp_flags = ['gomp'], ['-fopenmp']
+    else:
+        omp_libraries, omp_flags = [], []
     config.add_extension('scanning_strategy_f',
                          sources=['s4cmb/scanning_strategy_f.f90'],
                          libraries=[], f2py_options=[],
@@ -25,10 +71,10 @@ def configuration(parent_package='', top_path=None):
                          extra_compile_args=[''], extra_link_args=[''],)
     config.add_extension('tod_f',
                          sources=['s4cmb/tod_f.f90'],
-                         libraries=[], f2py_options=[],
+                         libraries=omp_libraries, f2py_options=[],
                          extra_f90_compile_args=[
                              '-ffixed-line-length-1000',
-                             '-O3'],
+                             '-O3'] + omp_flags,
                          extra_compile_args=[''], extra_link_args=[''],)
     config.add_extension('systematics_f',
                          sources=['s4cmb/systematics_f.f90'],